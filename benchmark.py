@@ -0,0 +1,294 @@
+# Times step1 - step11, ingest_data and ex1 - ex11 on data.csv scaled up by whole copies.
+#
+#   python benchmark.py --scales 1,4 --repeat 5 --output bench.json
+#   python benchmark.py --scales 1,4 --repeat 5 --compare bench.json
+#   python benchmark.py --generate 20000 --seed 7 --output bench.json
+#   python benchmark.py --plans tests/query_plans.json
+#
+# Each sample of a step is one call inside a full step1 - step11 pipeline on a fresh database;
+# each report sample runs on the loaded database with the lookup and result caches cleared
+# first (--warm keeps them). Per benchmark the JSON output holds the latencies (p50, p95, mean,
+# min, in seconds), rows/sec (rows written by a step, rows returned by a report) and the peak
+# RSS in KiB reached while it ran. --compare prints the p50 change against an earlier output
+# and exits with status 1 if any benchmark got slower by more than --threshold. --plans checks
+# the EXPLAIN QUERY PLAN of ex1 - ex11 against a snapshot (written there if missing, or with
+# --update-plans) and exits with status 1 on new table scans or temp B-trees.
+import argparse
+import json
+import math
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import generate_data
+import mini_project2
+
+STEPS = [
+    ('step1', 'step1_create_region_table', 'Region'),
+    ('step2', 'step2_create_region_to_regionid_dictionary', None),
+    ('step3', 'step3_create_country_table', 'Country'),
+    ('step4', 'step4_create_country_to_countryid_dictionary', None),
+    ('step5', 'step5_create_customer_table', 'Customer'),
+    ('step6', 'step6_create_customer_to_customerid_dictionary', None),
+    ('step7', 'step7_create_productcategory_table', 'ProductCategory'),
+    ('step8', 'step8_create_productcategory_to_productcategoryid_dictionary', None),
+    ('step9', 'step9_create_product_table', 'Product'),
+    ('step10', 'step10_create_product_to_productid_dictionary', None),
+    ('step11', 'step11_create_orderdetail_table', 'OrderDetail'),
+]
+
+
+def reset_peak_rss():
+    # Linux lets a process reset its own high-water mark; elsewhere the peak only grows
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    # KiB
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def percentile(samples, p):
+    # Nearest-rank percentile
+    ordered = sorted(samples)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+def summarize(name, scale, samples, rows, rss):
+    p50 = percentile(samples, 50)
+    return {
+        'name': name,
+        'scale': scale,
+        'repeat': len(samples),
+        'p50': p50,
+        'p95': percentile(samples, 95),
+        'mean': sum(samples) / len(samples),
+        'min': min(samples),
+        'rows': rows,
+        'rows_per_sec': rows / p50 if p50 else None,
+        'peak_rss_kib': rss,
+    }
+
+
+def scale_data(data_filename, scale, directory):
+    # Writes `scale` copies of the data lines; copy k > 0 renames its customers "<name> <k>"
+    scaled_filename = os.path.join(directory, 'data_x%d.csv' % scale)
+    with open(data_filename) as f:
+        header = f.readline()
+        lines = [line.rstrip('\n') for line in f if line.strip()]
+    with open(scaled_filename, 'w') as f:
+        f.write(header)
+        for k in range(scale):
+            for line in lines:
+                if k:
+                    name, rest = line.split('\t', 1)
+                    line = '%s %d\t%s' % (name, k, rest)
+                f.write(line + '\n')
+    return scaled_filename
+
+
+def clear_caches():
+    mini_project2.lookup_maps.clear()
+    mini_project2.report_cache.clear()
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def bench_steps(data_filename, directory, scale, warmup, repeat, only):
+    samples = {name: [] for name, _, _ in STEPS}
+    rss = dict.fromkeys(samples, 0)
+    rows = dict.fromkeys(samples, 0)
+    db = os.path.join(directory, 'steps.db')
+    for run in range(warmup + repeat):
+        mini_project2.create_connection(db, delete_db=True).close()
+        clear_caches()
+        for name, function_name, table in STEPS:
+            args = (data_filename, db) if table else (db,)
+            reset_peak_rss()
+            seconds, result = timed(getattr(mini_project2, function_name), *args)
+            if run >= warmup:
+                samples[name].append(seconds)
+                rss[name] = max(rss[name], peak_rss())
+                if table:
+                    conn = sqlite3.connect(db)
+                    rows[name] = conn.execute("SELECT count(*) FROM %s" % table).fetchone()[0]
+                    conn.close()
+                else:
+                    rows[name] = len(result)
+    return [summarize(name, scale, samples[name], rows[name], rss[name]) for name in samples if selected(name, only)]
+
+
+def bench_ingest(data_filename, directory, scale, warmup, repeat):
+    db = os.path.join(directory, 'ingest.db')
+    samples, rss = [], 0
+    for run in range(warmup + repeat):
+        mini_project2.create_connection(db, delete_db=True).close()
+        reset_peak_rss()
+        seconds, _ = timed(mini_project2.ingest_data, data_filename, db)
+        if run >= warmup:
+            samples.append(seconds)
+            rss = max(rss, peak_rss())
+    conn = sqlite3.connect(db)
+    rows = conn.execute("SELECT count(*) FROM OrderDetail").fetchone()[0]
+    conn.close()
+    return [summarize('ingest_data', scale, samples, rows, rss)]
+
+
+def bench_reports(db, scale, warmup, repeat, warm, only):
+    conn = mini_project2.create_connection(db)
+    # ex1/ex2 run for the customer with the most order rows
+    customer = conn.execute("""
+        SELECT c.FirstName || ' ' || c.LastName FROM OrderDetail od JOIN Customer c ON c.CustomerID = od.CustomerID
+        GROUP BY od.CustomerID ORDER BY count(*) DESC, od.CustomerID LIMIT 1""").fetchone()[0]
+    results = []
+    for i in range(1, 12):
+        name = 'ex%d' % i
+        if not selected(name, only):
+            continue
+        args = (customer,) if i <= 2 else ()
+        samples, rss = [], 0
+        for run in range(warmup + repeat):
+            if not warm:
+                clear_caches()
+            reset_peak_rss()
+            seconds, _ = timed(mini_project2.run_report, conn, name, *args)
+            if run >= warmup:
+                samples.append(seconds)
+                rss = max(rss, peak_rss())
+        rows = len(mini_project2.run_report(conn, name, *args))
+        results.append(summarize(name, scale, samples, rows, rss))
+    conn.close()
+    return results
+
+
+def check_plans(db, snapshot, update):
+    # Returns the plan regressions against snapshot, after printing them
+    conn = mini_project2.create_connection(db)
+    try:
+        if update or not os.path.exists(snapshot):
+            mini_project2.save_query_plans(conn, snapshot)
+            print("wrote query plans to %s" % snapshot)
+            return {}
+        regressions = mini_project2.check_query_plans(conn, snapshot)
+    finally:
+        conn.close()
+    for name, issues in regressions.items():
+        for issue in issues:
+            print("%-12s new in query plan: %s" % (name, issue))
+    return regressions
+
+
+def selected(name, only):
+    return not only or name in only
+
+
+def compare(results, baseline_filename, threshold):
+    # Prints the p50 change per benchmark; returns the number of regressions beyond threshold
+    with open(baseline_filename) as f:
+        baseline = {(r['scale'], r['name']): r for r in json.load(f)['results']}
+    regressions = 0
+    print("%-12s %5s %12s %12s %8s" % ('benchmark', 'scale', 'base p50', 'p50', 'change'))
+    for r in results:
+        base = baseline.get((r['scale'], r['name']))
+        if base is None:
+            print("%-12s %5d %12s %12.6f %8s" % (r['name'], r['scale'], '-', r['p50'], 'new'))
+            continue
+        change = (r['p50'] - base['p50']) / base['p50'] if base['p50'] else 0.0
+        flag = ''
+        if change > threshold:
+            regressions += 1
+            flag = '  SLOWER'
+        print("%-12s %5d %12.6f %12.6f %+7.1f%%%s" % (r['name'], r['scale'], base['p50'], r['p50'], change * 100, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline steps and reports.')
+    parser.add_argument('--data', default='data.csv', help='source data file (default: data.csv)')
+    parser.add_argument('--generate', type=int, metavar='CUSTOMERS',
+                        help='benchmark on generate_data.py output with this many customers instead of --data')
+    parser.add_argument('--seed', type=int, default=0, help='seed for --generate (default: 0)')
+    parser.add_argument('--scales', default='1', help='comma-separated copies of the data to run on (default: 1)')
+    parser.add_argument('--warmup', type=int, default=1, help='untimed runs per benchmark (default: 1)')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per benchmark (default: 5)')
+    parser.add_argument('--only', default='', help='comma-separated benchmarks to run, e.g. step11,ex8')
+    parser.add_argument('--warm', action='store_true', help='keep the lookup and result caches between report runs')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', help='JSON output of an earlier run to compare against')
+    parser.add_argument('--plans', help='query plan snapshot to check the report plans against')
+    parser.add_argument('--update-plans', action='store_true', help='rewrite the --plans snapshot')
+    parser.add_argument('--threshold', type=float, default=0.10, help='p50 slowdown counted as a regression (default: 0.10)')
+    args = parser.parse_args(argv)
+    only = set(filter(None, args.only.split(',')))
+
+    directory = tempfile.mkdtemp(prefix='benchmark')
+    results = []
+    plan_regressions = {}
+    try:
+        if args.generate:
+            args.data = os.path.join(directory, 'generated.csv')
+            with open(args.data, 'w') as f:
+                generate_data.generate(f, customers=args.generate, seed=args.seed)
+        for scale in [int(s) for s in args.scales.split(',')]:
+            data_filename = scale_data(args.data, scale, directory)
+            results += bench_steps(data_filename, directory, scale, args.warmup, args.repeat, only)
+            if selected('ingest_data', only):
+                results += bench_ingest(data_filename, directory, scale, args.warmup, args.repeat)
+            results += bench_reports(os.path.join(directory, 'steps.db'), scale, args.warmup, args.repeat, args.warm, only)
+            if args.plans and not plan_regressions:
+                plan_regressions = check_plans(os.path.join(directory, 'steps.db'), args.plans, args.update_plans)
+            for r in results:
+                if r['scale'] == scale:
+                    print("%-12s x%-4d p50 %10.6fs  p95 %10.6fs  %12s rows/s  %8d KiB" % (
+                        r['name'], scale, r['p50'], r['p95'],
+                        '%.0f' % r['rows_per_sec'] if r['rows_per_sec'] else '-', r['peak_rss_kib']))
+    finally:
+        mini_project2.close_all_pools()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'data': 'generate_data.py --customers %d --seed %d' % (args.generate, args.seed) if args.generate else os.path.abspath(args.data),
+            'warmup': args.warmup,
+            'repeat': args.repeat,
+            'warm_caches': args.warm,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    status = 1 if plan_regressions else 0
+    if args.compare and compare(results, args.compare, args.threshold):
+        status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,175 @@
+# Writes a synthetic data.csv in the format read by step1 - step11: one tab separated line per
+# customer, the order detail columns joined by ';'.
+#
+#   python generate_data.py --customers 100000 --orders-per-customer 20 --seed 7 -o big.csv
+#
+# The output is streamed one customer at a time and depends only on the arguments, so the same
+# seed always gives the same file. Popularity is skewed: countries and products are drawn from
+# Zipf-like weights (exponent --skew, most popular first after a seeded shuffle), and the number
+# of orders per customer is log-normal around --orders-per-customer, so a few customers place
+# most of the orders.
+import argparse
+import itertools
+import math
+import random
+import sys
+from datetime import date, timedelta
+
+HEADER = "Name\tAddress\tCity\tCountry\tRegion\tProductName\tProductCategory\tProductCategoryDescription\tProductUnitPrice\tQuantityOrderded\tOrderDate"
+
+REGIONS = ['Western Europe', 'North America', 'South America', 'British Isles', 'Southern Europe',
+           'Central America', 'Scandinavia', 'Northern Europe', 'Eastern Europe']
+COUNTRIES = [('Germany', 'Western Europe'), ('USA', 'North America'), ('Brazil', 'South America'),
+             ('France', 'Western Europe'), ('UK', 'British Isles'), ('Spain', 'Southern Europe'),
+             ('Mexico', 'Central America'), ('Venezuela', 'South America'), ('Italy', 'Southern Europe'),
+             ('Canada', 'North America'), ('Argentina', 'South America'), ('Austria', 'Western Europe'),
+             ('Belgium', 'Western Europe'), ('Sweden', 'Northern Europe'), ('Finland', 'Scandinavia'),
+             ('Denmark', 'Scandinavia'), ('Portugal', 'Southern Europe'), ('Switzerland', 'Western Europe'),
+             ('Norway', 'Scandinavia'), ('Ireland', 'British Isles'), ('Poland', 'Eastern Europe')]
+CATEGORIES = [('Beverages', 'Soft drinks, coffees, teas, beers, and ales'),
+              ('Condiments', 'Sweet and savory sauces, relishes, spreads, and seasonings'),
+              ('Confections', 'Desserts, candies, and sweet breads'),
+              ('Dairy Products', 'Cheeses'),
+              ('Grains/Cereals', 'Breads, crackers, pasta, and cereal'),
+              ('Meat/Poultry', 'Prepared meats'),
+              ('Produce', 'Dried fruit and bean curd'),
+              ('Seafood', 'Seaweed and fish')]
+FIRST_NAMES = ['Maria', 'Ana', 'Antonio', 'Thomas', 'Christina', 'Hanna', 'Frederique', 'Martin', 'Laurence',
+               'Elizabeth', 'Victoria', 'Patricio', 'Francisco', 'Yang', 'Pedro', 'Aria', 'Diego', 'Peter',
+               'Carine', 'Paolo', 'Lino', 'Liz', 'Karl', 'Jose', 'Helen', 'Manuel', 'Rene', 'Yoshi']
+LAST_NAMES = ['Anders', 'Trujillo', 'Moreno', 'Hardy', 'Berglund', 'Moos', 'Citeaux', 'Sommer', 'Lebihan',
+              'Lincoln', 'Ashworth', 'Simpson', 'Chang', 'Wang', 'Afonso', 'Cruz', 'Roel', 'Franken',
+              'Schmitt', 'Accorti', 'Rodriguez', 'Nixon', 'Jablonski', 'Pedro Freyre', 'Bennett', 'Pereira',
+              'Phillips', 'Tannamuri', 'Pavarotti', 'Kloss', 'Ottlieb', 'Karttunen']
+STREETS = ['Obere Str.', 'Avda. de la Constitucion', 'Mataderos', 'Hanover Sq.', 'Berguvsvagen', 'Forsterstr.',
+           'place Kleber', 'C/ Araquil', 'rue des Bouchers', 'Fauntleroy Circus', 'Hauptstr.', 'Gran Via']
+PRODUCT_WORDS = ['Chai', 'Chang', 'Aniseed', 'Cajun', 'Gumbo', 'Boysenberry', 'Pear', 'Mishi', 'Ikura', 'Konbu',
+                 'Tofu', 'Pavlova', 'Alice', 'Carnarvon', 'Teatime', 'Sasquatch', 'Steeleye', 'Gravad',
+                 'Cote', 'Chocolade', 'Maxilaku', 'Valkoinen', 'Manjimup', 'Filo', 'Perth', 'Tourtiere',
+                 'Gnocchi', 'Ravioli', 'Escargots', 'Raclette', 'Camembert', 'Gorgonzola', 'Mascarpone',
+                 'Geitost', 'Gudbrandsdalsost', 'Flotemysost', 'Mozzarella', 'Rhonbrau', 'Lakkalikoori']
+PRODUCT_KINDS = ['Syrup', 'Seasoning', 'Sauce', 'Spread', 'Pears', 'Crab Meat', 'Biscuits', 'Porter',
+                 'Lax', 'Chocolate', 'Dried Apples', 'Sausage', 'Pasta', 'Cheese', 'Tea', 'Coffee', 'Lager']
+
+
+def zipf_cum_weights(n, skew):
+    return list(itertools.accumulate(1 / (k + 1) ** skew for k in range(n)))
+
+
+def make_regions(n):
+    return (REGIONS + ['Region %d' % k for k in range(len(REGIONS) + 1, n + 1)])[:n]
+
+
+def make_countries(n, regions):
+    # Known countries keep their real region when it was generated; the rest are spread round-robin
+    countries = []
+    for k in range(n):
+        if k < len(COUNTRIES):
+            country, region = COUNTRIES[k]
+            if region not in regions:
+                region = regions[k % len(regions)]
+        else:
+            country, region = 'Country %d' % (k + 1), regions[k % len(regions)]
+        countries.append((country, region))
+    return countries
+
+
+def make_categories(n):
+    extra = [('Category %d' % k, 'Assorted goods %d' % k) for k in range(len(CATEGORIES) + 1, n + 1)]
+    return (CATEGORIES + extra)[:n]
+
+
+def make_products(n, categories, r):
+    # (name, category, description, unit price); a product keeps one category and price everywhere
+    names = ('%s %s' % pair for pair in itertools.product(PRODUCT_WORDS, PRODUCT_KINDS))
+    products = []
+    for k in range(n):
+        name = next(names, None) or 'Product %d' % (k + 1)
+        category, description = categories[k % len(categories)]
+        price = min(max(r.lognormvariate(math.log(20), 0.8), 2.5), 263.5)
+        products.append((name, category, description, '%.2f' % price))
+    return products
+
+
+def customer_name(k):
+    # Unique for every k; the first name never contains a space
+    first, rest = FIRST_NAMES[k % len(FIRST_NAMES)], k // len(FIRST_NAMES)
+    last, copy = LAST_NAMES[rest % len(LAST_NAMES)], rest // len(LAST_NAMES)
+    return '%s %s' % (first, last) if copy == 0 else '%s %s %d' % (first, last, copy + 1)
+
+
+def generate(out, customers=1000, products=77, categories=8, countries=21, regions=9,
+             start=date(2012, 1, 1), end=date(2016, 12, 31), orders_per_customer=10, lines_per_order=3,
+             skew=1.1, seed=0):
+    # Inputs: out is a text file object; counts as described by main()
+    # Output: number of order detail rows written
+    r = random.Random(seed)
+    region_names = make_regions(regions)
+    country_rows = make_countries(countries, region_names)
+    product_rows = make_products(products, make_categories(categories), r)
+    r.shuffle(country_rows)
+    r.shuffle(product_rows)
+    country_weights = zipf_cum_weights(len(country_rows), skew)
+    product_weights = zipf_cum_weights(len(product_rows), skew)
+    days = (end - start).days + 1
+    sigma = 1.0
+    mu = math.log(orders_per_customer) - sigma * sigma / 2
+
+    out.write(HEADER + "\n")
+    written = 0
+    for k in range(customers):
+        country, region = r.choices(country_rows, cum_weights=country_weights)[0]
+        items, quantities, dates = [], [], []
+        for _ in range(max(1, round(r.lognormvariate(mu, sigma)))):
+            order_date = (start + timedelta(days=r.randrange(days))).strftime('%Y%m%d')
+            lines = 1 + min(int(r.expovariate(1 / (lines_per_order - 0.5))) if lines_per_order > 1 else 0, 24)
+            items += r.choices(product_rows, cum_weights=product_weights, k=lines)
+            quantities += (str(1 + min(int(r.expovariate(0.1)), 119)) for _ in range(lines))
+            dates += [order_date] * lines
+        out.write('\t'.join([
+            customer_name(k), '%d %s' % (1 + r.randrange(999), r.choice(STREETS)), 'City %d' % (k % 997 + 1),
+            country, region,
+            ';'.join(p[0] for p in items), ';'.join(p[1] for p in items), ';'.join(p[2] for p in items),
+            ';'.join(p[3] for p in items), ';'.join(quantities), ';'.join(dates)]) + "\n")
+        written += len(items)
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write a synthetic data.csv.')
+    parser.add_argument('-o', '--output', default='-', help="output file, '-' for stdout (default)")
+    parser.add_argument('--customers', type=int, default=1000, help='customers, one line each (default: 1000)')
+    parser.add_argument('--products', type=int, default=77, help='distinct products (default: 77)')
+    parser.add_argument('--categories', type=int, default=8, help='product categories (default: 8)')
+    parser.add_argument('--countries', type=int, default=21, help='countries (default: 21)')
+    parser.add_argument('--regions', type=int, default=9, help='regions (default: 9)')
+    parser.add_argument('--start', default='2012-01-01', help='first order date (default: 2012-01-01)')
+    parser.add_argument('--end', default='2016-12-31', help='last order date (default: 2016-12-31)')
+    parser.add_argument('--orders-per-customer', type=float, default=10, help='mean orders per customer (default: 10)')
+    parser.add_argument('--lines-per-order', type=float, default=3, help='mean products per order (default: 3)')
+    parser.add_argument('--skew', type=float, default=1.1, help='Zipf exponent of country and product popularity (default: 1.1)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default: 0)')
+    args = parser.parse_args(argv)
+    if min(args.customers, args.products, args.categories, args.countries, args.regions) < 1:
+        parser.error('counts must be at least 1')
+    if args.orders_per_customer <= 0 or args.lines_per_order < 1:
+        parser.error('--orders-per-customer must be positive and --lines-per-order at least 1')
+    start, end = date.fromisoformat(args.start), date.fromisoformat(args.end)
+    if end < start:
+        parser.error('--end is before --start')
+
+    kwargs = dict(customers=args.customers, products=args.products, categories=args.categories,
+                  countries=args.countries, regions=args.regions, start=start, end=end,
+                  orders_per_customer=args.orders_per_customer, lines_per_order=args.lines_per_order,
+                  skew=args.skew, seed=args.seed)
+    if args.output == '-':
+        written = generate(sys.stdout, **kwargs)
+    else:
+        with open(args.output, 'w', buffering=1 << 20) as f:
+            written = generate(f, **kwargs)
+    print('%d customers, %d order lines' % (args.customers, written), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
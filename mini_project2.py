@@ -1,16 +1,37 @@
 ### Utility Functions
+import asyncio
+import atexit
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import itertools
+import json
+import math
+import multiprocessing
+import numpy as np
+import os
 import pandas as pd
+import queue
+import re
 import sqlite3
+import threading
+import time
+from datetime import datetime
 from sqlite3 import Error
 
-def create_connection(db_file, delete_db=False):
-    import os
-    if delete_db and os.path.exists(db_file):
-        os.remove(db_file)
+def create_connection(db_file, delete_db=False, **connect_kwargs):
+    # Extra keyword arguments go to sqlite3.connect (e.g. check_same_thread, cached_statements)
+    if delete_db:
+        close_pool(db_file)
+        for path in (db_file, db_file + '-wal', db_file + '-shm'):
+            if os.path.exists(path):
+                os.remove(path)
 
     conn = None
     try:
-        conn = sqlite3.connect(db_file)
+        conn = sqlite3.connect(db_file, **connect_kwargs)
         conn.execute("PRAGMA foreign_keys = 1")
     except Error as e:
         print(e)
@@ -41,235 +62,912 @@ def execute_sql_statement(sql_statement, conn):
 
     return rows
 
+### Bulk-load profile
+
+# Applied while loading. Durability is traded for speed (a crash mid-load means reloading),
+# and per-row foreign key enforcement is replaced by one foreign_key_check at the end.
+BULK_LOAD_PRAGMAS = {
+    'journal_mode': 'MEMORY',
+    'synchronous': 'OFF',
+    'cache_size': -262144,
+    'temp_store': 'MEMORY',
+    'foreign_keys': 0,
+}
+
+# Applied by bulk_load(durable=True), for writes into data that cannot simply be reloaded
+# (append_data, the in-place storage conversions): the journal mode is kept and synchronous
+# is raised to at least NORMAL, since a crash mid-transaction without a journal on disk can
+# corrupt the whole file; only the deferred foreign key check is kept.
+DURABLE_LOAD_PRAGMAS = {
+    'cache_size': -262144,
+    'temp_store': 'MEMORY',
+    'foreign_keys': 0,
+}
+
+
+class ForeignKeyCheckError(Error):
+    # Raised after a bulk load when PRAGMA foreign_key_check reports violations.
+    # violations is a list of dicts with the table, rowid, parent and fkid of each bad row.
+
+    def __init__(self, violations):
+        self.violations = violations
+        tables = sorted({v['table'] for v in violations})
+        super().__init__("%d foreign key violation(s) in %s" % (len(violations), ", ".join(tables)))
+
+
+def foreign_key_check(conn):
+    rows = execute_sql_statement("PRAGMA foreign_key_check", conn)
+    return [dict(zip(('table', 'rowid', 'parent', 'fkid'), row)) for row in rows]
+
+
+def _foreign_key_check_since(conn, table, rowid):
+    # foreign_key_check of table limited to its rows after rowid (single-column keys), so a
+    # batched load checks each batch without rescanning the rows it already committed
+    violations = []
+    for fkid, _, parent, column, parent_column in (row[:5] for row in execute_sql_statement("PRAGMA foreign_key_list(%s)" % table, conn)):
+        sql = ("SELECT t.rowid FROM %s t WHERE t.rowid > ? AND t.%s IS NOT NULL "
+               "AND NOT EXISTS (SELECT 1 FROM %s p WHERE p.%s = t.%s)" % (table, column, parent, parent_column, column))
+        violations += [{'table': table, 'rowid': r, 'parent': parent, 'fkid': fkid} for r, in conn.execute(sql, (rowid,))]
+    return violations
+
+
+@contextlib.contextmanager
+def bulk_load(conn, durable=False, **pragmas):
+    # Usage: with bulk_load(conn): ...inserts...
+    # Keyword arguments override BULK_LOAD_PRAGMAS (DURABLE_LOAD_PRAGMAS with durable=True, which
+    # also opens the transaction up front so DDL in the body is part of it). The load is
+    # committed only if the body finishes and the data passes foreign_key_check; otherwise the
+    # open transaction is rolled back (ForeignKeyCheckError for broken foreign keys). The
+    # previous settings are restored either way.
+    conn.commit()
+    settings = dict(DURABLE_LOAD_PRAGMAS if durable else BULK_LOAD_PRAGMAS, **pragmas)
+    if durable and conn.execute("PRAGMA synchronous").fetchone()[0] < 1:
+        settings.setdefault('synchronous', 'NORMAL')
+    previous = {name: conn.execute("PRAGMA %s" % name).fetchone()[0] for name in settings}
+    if previous.get('journal_mode') == 'wal':
+        # WAL is already cheap to write and switching away needs exclusive access
+        settings.pop('journal_mode')
+        previous.pop('journal_mode')
+    for name, value in settings.items():
+        conn.execute("PRAGMA %s = %s" % (name, value))
+    try:
+        if durable:
+            conn.execute("BEGIN")
+        yield conn
+        violations = foreign_key_check(conn)
+        if violations:
+            raise ForeignKeyCheckError(violations)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        for name, value in previous.items():
+            conn.execute("PRAGMA %s = %s" % (name, value))
+
+### Connection pool
+
+class ConnectionPool:
+    # One writer and at most `readers` read connections for one database file. Connections are
+    # opened lazily through create_connection, reused across calls and usable from any thread;
+    # the writer is serialized by a lock. reader() waits up to `timeout` seconds (None: forever)
+    # for a free connection and raises sqlite3.OperationalError when none frees up. Extra keyword
+    # arguments go to sqlite3.connect, e.g. cached_statements for report-heavy pools.
+    # Every checkout compares the file's (st_dev, st_ino) with the one the connections were
+    # opened on; when the file was deleted or replaced behind the pool's back they are released
+    # and fresh ones opened.
+
+    def __init__(self, db_file, readers=4, timeout=None, **connect_kwargs):
+        self.db_file = db_file
+        self.connect_kwargs = dict(connect_kwargs, check_same_thread=False)
+        self.readers = readers
+        self.timeout = timeout
+        self.closed = False
+        self._writer = None
+        self._writer_generation = 0
+        self._writer_lock = threading.Lock()
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(readers)
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._identity = None
+
+    def _file_identity(self):
+        try:
+            st = os.stat(self.db_file)
+        except OSError:
+            return None
+        return st.st_dev, st.st_ino
+
+    def _connect(self):
+        if self.closed:
+            raise Error("connection pool for %s is closed" % self.db_file)
+        conn = create_connection(self.db_file, **self.connect_kwargs)
+        with self._lock:
+            if self._identity is None:
+                self._identity = self._file_identity()
+        return conn
+
+    @staticmethod
+    def _discard(conn):
+        lookup_maps.forget(conn)
+        report_cache.forget(conn)
+        conn.close()
+
+    def _check_file(self):
+        with self._lock:
+            identity = self._file_identity()
+            if identity == self._identity:
+                return
+            self._identity = identity
+        self.release()
+
+    @contextlib.contextmanager
+    def writer(self):
+        with self._writer_lock:
+            self._check_file()
+            if self._writer is not None and self._writer_generation != self._generation:
+                self._discard(self._writer)
+                self._writer = None
+            if self._writer is None:
+                self._writer_generation = self._generation
+                self._writer = self._connect()
+            try:
+                with _instrumented_connection(self._writer):
+                    yield self._writer
+            except BaseException:
+                self._writer.rollback()
+                raise
+            finally:
+                if self._writer_generation != self._generation:
+                    # released while in use
+                    self._discard(self._writer)
+                    self._writer = None
+
+    @contextlib.contextmanager
+    def reader(self):
+        if not self._slots.acquire(timeout=-1 if self.timeout is None else self.timeout):
+            raise sqlite3.OperationalError("no read connection free for %s after %ss" % (self.db_file, self.timeout))
+        try:
+            self._check_file()
+            while True:
+                try:
+                    generation, conn = self._idle.get_nowait()
+                except queue.Empty:
+                    generation = self._generation
+                    conn = self._connect()
+                    break
+                if generation == self._generation:
+                    break
+                self._discard(conn)
+            try:
+                with _instrumented_connection(conn):
+                    yield conn
+            finally:
+                conn.rollback()
+                if generation != self._generation:
+                    self._discard(conn)
+                else:
+                    self._idle.put((generation, conn))
+        finally:
+            self._slots.release()
+
+    def release(self):
+        # Closes the writer and idle readers; the pool stays usable and reopens connections on
+        # demand. Connections in use are closed when returned.
+        with self._lock:
+            self._generation += 1
+        while True:
+            try:
+                _, conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+        if self._writer_lock.acquire(blocking=False):
+            try:
+                if self._writer is not None:
+                    self._discard(self._writer)
+                    self._writer = None
+            finally:
+                self._writer_lock.release()
+
+    def close(self):
+        # Releases the connections and refuses new checkouts
+        self.closed = True
+        self.release()
+
+
+# Shared pools, most recently used last; beyond POOL_CACHE_SIZE the oldest is dropped and
+# releases its connections (anyone still holding it can keep using it)
+POOL_CACHE_SIZE = 8
+_pools = collections.OrderedDict()
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_file, readers=4, timeout=None, **connect_kwargs):
+    # Shared pool per database file; the settings only apply when the pool is first created
+    key = os.path.abspath(db_file)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None or pool.closed:
+            pool = _pools[key] = ConnectionPool(db_file, readers, timeout, **connect_kwargs)
+        _pools.move_to_end(key)
+        evicted = [_pools.popitem(last=False)[1] for _ in range(len(_pools) - POOL_CACHE_SIZE)]
+    for old in evicted:
+        old.release()
+    return pool
+
+
+def close_pool(db_file):
+    with _pools_lock:
+        pool = _pools.pop(os.path.abspath(db_file), None)
+    if pool is not None:
+        pool.close()
+
+
+@atexit.register
+def close_all_pools():
+    for db_file in list(_pools):
+        close_pool(db_file)
+
+### Instrumentation
+
+class Metrics:
+    # Collects timings while instrument() is active. Every record is a dict: the step functions,
+    # ingest_data and append_data record kind 'step', ex1 - ex11 kind 'report', each with its wall
+    # time in seconds, depth (0 unless called from another instrumented function) and the rows
+    # parsed from data files, written (sqlite3 total_changes, so trigger writes count too) and
+    # returned by report queries, inclusive of nested calls, plus per-second rates. With SQL
+    # tracing on, each step and report also records kind 'sql' per statement shape (literals
+    # replaced by ?) it ran: calls, seconds from each statement's start until the next statement
+    # on its connection (or the end of the step) and vm_steps counted by the progress handler.
+    # log is a path (appended to) or text file that receives every record as a JSON line.
+
+    COUNTS = ['rows_parsed', 'rows_written', 'rows_returned', 'rows_skipped']
+
+    def __init__(self, log=None):
+        self.records = []
+        self._lock = threading.Lock()
+        self._log = log
+        self._owns_log = isinstance(log, (str, os.PathLike))
+        if self._owns_log:
+            self._log = open(log, 'a', buffering=1)
+
+    def record(self, **fields):
+        with self._lock:
+            self.records.append(fields)
+            if self._log is not None:
+                self._log.write(json.dumps(fields) + "\n")
+
+    def summary(self):
+        # DataFrame with one row per (kind, name): calls, total seconds, counts and rates
+        columns = ['kind', 'name', 'calls', 'seconds'] + self.COUNTS + ['vm_steps']
+        with self._lock:
+            df = pd.DataFrame(self.records, columns=columns)
+        df['calls'] = df['calls'].fillna(1)
+        df = df.fillna(0).groupby(['kind', 'name'], sort=False, as_index=False)[columns[2:]].sum()
+        for count in self.COUNTS:
+            df[count + '_per_sec'] = df[count] / df['seconds'].where(df['seconds'] > 0)
+        return df
+
+    def clear(self):
+        with self._lock:
+            self.records = []
+
+    def close(self):
+        if self._owns_log and self._log is not None:
+            self._log.close()
+            self._log = None
+
+
+_metrics = None
+_metrics_options = {}
+_instrumentation = threading.local()
+_tracers = {}
+_tracers_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def instrument(metrics=None, log=None, sql=True, progress_ops=1000):
+    # Inputs: Metrics to record into (default: a new one writing to log)
+    # Optional: sql=False skips the per-statement trace and progress callbacks, which cost a
+    #           Python call per statement executed (per row for executemany)
+    # Output: the Metrics, as the context value
+    global _metrics, _metrics_options
+    if metrics is None:
+        metrics = Metrics(log)
+    previous = _metrics, _metrics_options
+    _metrics, _metrics_options = metrics, {'sql': sql, 'progress_ops': progress_ops}
+    try:
+        yield metrics
+    finally:
+        _metrics, _metrics_options = previous
+        if log is not None:
+            metrics.close()
+
+
+def _add_counts(**counts):
+    # Adds to the innermost instrumented call on this thread, if any
+    frames = getattr(_instrumentation, 'frames', None)
+    if frames:
+        frame = frames[-1][1]
+        for count, n in counts.items():
+            frame[count] += n
+
+
+def _statement_shape(sql_statement):
+    # Bound values come back expanded in the trace; fold them (and NULL values) back to ?
+    sql_statement = re.sub(r"'(?:[^']|'')*'|\b\d+(?:\.\d*)?(?:[eE][-+]?\d+)?\b|\bx'[0-9a-fA-F]*'", '?', sql_statement)
+    sql_statement = re.sub(r"([(,=]\s*)NULL\b", r"\1?", sql_statement)
+    return _normalize_sql(sql_statement)
+
+
+class _StatementTracer:
+    # Trace and progress callbacks on one connection; close() records the statement totals
+
+    def __init__(self, conn, metrics, progress_ops):
+        self.conn = conn
+        self.metrics = metrics
+        self.progress_ops = progress_ops
+        self.totals = {}
+        self.current = None
+        self.started = 0.0
+        self.vm_steps = 0
+        conn.set_trace_callback(self._trace)
+        conn.set_progress_handler(self._progress, progress_ops)
+
+    def _trace(self, sql_statement):
+        now = time.perf_counter()
+        self._finish(now)
+        self.current, self.started = sql_statement, now
+
+    def _progress(self):
+        self.vm_steps += self.progress_ops
+        return 0
+
+    def _finish(self, now):
+        if self.current is not None:
+            totals = self.totals.setdefault(_statement_shape(self.current), [0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += now - self.started
+            totals[2] += self.vm_steps
+        self.current, self.vm_steps = None, 0
+
+    def close(self):
+        self._finish(time.perf_counter())
+        self.conn.set_trace_callback(None)
+        self.conn.set_progress_handler(None, 0)
+        frames = getattr(_instrumentation, 'frames', None)
+        step = frames[-1][0] if frames else None
+        for shape, (calls, seconds, vm_steps) in self.totals.items():
+            self.metrics.record(kind='sql', name=shape, step=step, calls=calls, seconds=seconds, vm_steps=vm_steps)
+
+
+@contextlib.contextmanager
+def _instrumented_connection(conn):
+    # Wraps connection use (pool connections, report connections): counts the rows written and,
+    # with SQL tracing on, installs a _StatementTracer unless one is already on this connection
+    metrics, options = _metrics, _metrics_options
+    if metrics is None:
+        yield conn
+        return
+    tracer = None
+    if options['sql']:
+        with _tracers_lock:
+            if id(conn) not in _tracers:
+                tracer = _tracers[id(conn)] = _StatementTracer(conn, metrics, options['progress_ops'])
+    total_changes = conn.total_changes
+    try:
+        yield conn
+    finally:
+        _add_counts(rows_written=conn.total_changes - total_changes)
+        if tracer is not None:
+            with _tracers_lock:
+                del _tracers[id(conn)]
+            tracer.close()
+
+
+@contextlib.contextmanager
+def _instrumented_call(kind, name, conn=None):
+    # Records the enclosed call as a Metrics record while instrument() is active
+    metrics = _metrics
+    if metrics is None or getattr(_report_mode, 'sql_only', False):
+        yield
+        return
+    frames = _instrumentation.__dict__.setdefault('frames', [])
+    frame = dict.fromkeys(Metrics.COUNTS, 0)
+    frames.append((name, frame))
+    start = time.perf_counter()
+    try:
+        if conn is None:
+            yield
+        else:
+            with _instrumented_connection(conn):
+                yield
+    finally:
+        seconds = time.perf_counter() - start
+        frames.pop()
+        if frames:
+            for count, n in frame.items():
+                frames[-1][1][count] += n
+        rates = {count + '_per_sec': n / seconds for count, n in frame.items() if n and seconds}
+        metrics.record(kind=kind, name=name, started=time.time() - seconds, seconds=seconds,
+                       depth=len(frames), **frame, **rates)
+
+
+def _instrumented(kind):
+    # Decorator form of _instrumented_call; a leading connection argument is traced too
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _metrics is None:
+                return function(*args, **kwargs)
+            conn = args[0] if args and isinstance(args[0], sqlite3.Connection) else None
+            with _instrumented_call(kind, function.__name__, conn):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+### Lookup maps
+
+def _data_token(conn):
+    # Moves whenever the database changes: data_version after commits from other connections,
+    # schema_version after DDL, total_changes after writes through this connection
+    data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+    schema_version = conn.execute("PRAGMA schema_version").fetchone()[0]
+    return (data_version, schema_version, conn.total_changes)
+
+
+class LookupRegistry:
+    # Caches the name -> ID maps of the dimension tables per connection and rebuilds a map only
+    # when the connection's _data_token has moved. Connections are held (LRU, at most
+    # max_connections) so their ids cannot be reused while cached; forget() drops one early.
+    # Returned maps are shared: treat them as read-only.
+
+    QUERIES = {
+        'Region': "SELECT Region, RegionID FROM Region ORDER BY RegionID",
+        'Country': "SELECT Country, CountryID FROM Country ORDER BY CountryID",
+        'Customer': "SELECT FirstName || ' ' || LastName, CustomerID FROM Customer ORDER BY CustomerID",
+        'ProductCategory': "SELECT ProductCategory, ProductCategoryID FROM ProductCategory ORDER BY ProductCategoryID",
+        'Product': "SELECT ProductName, ProductID FROM Product ORDER BY ProductID",
+    }
+
+    def __init__(self, max_connections=32):
+        self.max_connections = max_connections
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, conn, table):
+        token = _data_token(conn)
+        with self._lock:
+            entry = self._entries.get(id(conn))
+            if entry is None or entry[0] is not conn:
+                entry = (conn, {})
+                self._entries[id(conn)] = entry
+                while len(self._entries) > self.max_connections:
+                    self._entries.popitem(last=False)
+            self._entries.move_to_end(id(conn))
+            cached = entry[1].get(table)
+            if cached is not None and cached[0] == token:
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+        d = {name: i for name, i in execute_sql_statement(self.QUERIES[table], conn)}
+        with self._lock:
+            entry[1][table] = (token, d)
+        return d
+
+    def forget(self, conn):
+        with self._lock:
+            self._entries.pop(id(conn), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'connections': len(self._entries)}
+
+
+lookup_maps = LookupRegistry()
+
+
+def _lookup_dictionary(normalized_database_filename, table):
+    # Backs step2/4/6/8/10, which accept a database filename (read through its pool) or an open connection
+    if isinstance(normalized_database_filename, sqlite3.Connection):
+        return dict(lookup_maps.get(normalized_database_filename, table))
+    with get_pool(normalized_database_filename).reader() as conn:
+        return dict(lookup_maps.get(conn, table))
+
+### Result cache
+
+def _normalize_sql(sql_statement):
+    # Collapses whitespace outside string literals and drops a trailing ';', so the same
+    # statement written with different layout shares one cache key
+    sql_statement = re.sub(r"('(?:[^']|'')*')|\s+", lambda m: m.group(1) or ' ', sql_statement).strip()
+    return sql_statement.rstrip(';').rstrip()
+
+
+class ResultCache:
+    # Caches report DataFrames per connection, keyed on normalized SQL plus parameters. An entry
+    # is served only while the connection's _data_token is unchanged, so any commit (a load,
+    # append_data, or another process) invalidates it. Entries are evicted least recently used
+    # once their total memory_usage exceeds max_bytes; a single result larger than that is not
+    # cached. Callers get a copy, so mutating a result cannot corrupt the cache.
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.nbytes = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def read_sql_query(self, sql_statement, conn, params=None):
+        # Drop-in for pd.read_sql_query(sql_statement, conn, params=params)
+        key = (id(conn), _normalize_sql(sql_statement), tuple(params or ()))
+        token = _data_token(conn)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is conn and entry[1] == token:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                _add_counts(rows_returned=len(entry[2]))
+                return entry[2].copy()
+            if entry is not None:
+                self._remove(key)
+                self.invalidations += 1
+            self.misses += 1
+        df = pd.read_sql_query(sql_statement, conn, params=params)
+        _add_counts(rows_returned=len(df))
+        nbytes = int(df.memory_usage(index=True, deep=True).sum())
+        if nbytes <= self.max_bytes:
+            with self._lock:
+                if key in self._entries:
+                    self._remove(key)
+                self._entries[key] = (conn, token, df.copy(), nbytes)
+                self.nbytes += nbytes
+                while self.nbytes > self.max_bytes:
+                    self._remove(next(iter(self._entries)))
+                    self.evictions += 1
+        return df
+
+    def _remove(self, key):
+        self.nbytes -= self._entries.pop(key)[3]
+
+    def forget(self, conn):
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if entry[0] is conn]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        calls = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'entries': len(self._entries),
+            'bytes': self.nbytes,
+            'max_bytes': self.max_bytes,
+            'hit_rate': self.hits / calls if calls else 0.0,
+        }
+
+
+report_cache = ResultCache()
+
+### Schema
+
+REGION_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS Region (
+        RegionID INTEGER NOT NULL PRIMARY KEY,
+        Region TEXT NOT NULL
+    )
+"""
+
+COUNTRY_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS Country (
+        CountryID INTEGER NOT NULL PRIMARY KEY,
+        Country TEXT NOT NULL,RegionID INTEGER NOT NULL,
+        FOREIGN KEY (RegionID) REFERENCES Region (RegionID)
+    );
+"""
+
+CUSTOMER_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS Customer (
+        CustomerID INTEGER NOT NULL PRIMARY KEY,
+        FirstName TEXT NOT NULL,LastName TEXT NOT NULL,
+        Address TEXT NOT NULL,City TEXT NOT NULL,
+        CountryID INTEGER NOT NULL,FOREIGN KEY (CountryID) REFERENCES Country (CountryID)
+    );
+"""
+
+PRODUCTCATEGORY_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS ProductCategory (
+        ProductCategoryID INTEGER NOT NULL PRIMARY KEY,ProductCategory TEXT NOT NULL,ProductCategoryDescription TEXT NOT NULL
+    );
+"""
+
+PRODUCT_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS Product (
+        ProductID INTEGER NOT NULL PRIMARY KEY,
+        ProductName TEXT NOT NULL,
+        ProductUnitPrice REAL NOT NULL,
+        ProductCategoryID INTEGER NOT NULL,
+        FOREIGN KEY (ProductCategoryID) REFERENCES ProductCategory (ProductCategoryID)
+    );
+"""
+
+ORDERDETAIL_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS OrderDetail (
+        OrderID INTEGER NOT NULL PRIMARY KEY,CustomerID INTEGER NOT NULL,
+        ProductID INTEGER NOT NULL,OrderDate TEXT NOT NULL,QuantityOrdered INTEGER NOT NULL,
+        FOREIGN KEY (CustomerID) REFERENCES Customer (CustomerID),FOREIGN KEY (ProductID) REFERENCES Product (ProductID)
+    );
+"""
+
+# Secondary indexes on OrderDetail. Loaders build them after the bulk insert (cheaper than
+# maintaining them row by row) and a full reload drops them with the table; append_data keeps
+# them and lets SQLite maintain them. The CustomerID index turns the per-customer reports into
+# index seeks and also backs the foreign keys, as does the ProductID one. A wider covering index
+# such as (CustomerID, OrderDate, ProductID, QuantityOrdered) is deliberately not declared: the
+# planner would scan it for the aggregate reports and sum each group in (OrderDate, ProductID)
+# order instead of OrderID order, which can move ROUND()ed float totals by a unit. A
+# single-column index keeps OrderID order within each customer, so totals are unchanged.
+INDEXES = [
+    ('idx_OrderDetail_CustomerID', "CREATE INDEX IF NOT EXISTS idx_OrderDetail_CustomerID ON OrderDetail (CustomerID)"),
+    # Covers ex11's per-customer walk in OrderDate order. Kept separate from the CustomerID index:
+    # reports scanning that one sum in OrderID order within a customer.
+    ('idx_OrderDetail_CustomerID_OrderDate', "CREATE INDEX IF NOT EXISTS idx_OrderDetail_CustomerID_OrderDate ON OrderDetail (CustomerID, OrderDate)"),
+    ('idx_OrderDetail_ProductID', "CREATE INDEX IF NOT EXISTS idx_OrderDetail_ProductID ON OrderDetail (ProductID)"),
+]
+
+
+def create_indexes(conn):
+    cur = conn.cursor()
+    for _, create_index_sql in INDEXES:
+        cur.execute(create_index_sql)
+    conn.commit()
+
+
+def drop_indexes(conn):
+    cur = conn.cursor()
+    for index_name, _ in INDEXES:
+        cur.execute("DROP INDEX IF EXISTS %s" % index_name)
+    conn.commit()
+
+
+# One row per incremental load (see append_data); a full rebuild starts the history over.
+LOADWATERMARK_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS LoadWatermark (
+        LoadID INTEGER NOT NULL PRIMARY KEY,
+        SourceHash TEXT NOT NULL UNIQUE,
+        SourceFile TEXT NOT NULL,
+        MaxOrderDate TEXT,
+        RowsAppended INTEGER NOT NULL,
+        RowsSkipped INTEGER NOT NULL DEFAULT 0,
+        LoadedAt TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+
+# Parent tables first; drop in the reverse order so foreign keys never dangle.
+TABLES = [
+    ('Region', REGION_TABLE_SQL),
+    ('Country', COUNTRY_TABLE_SQL),
+    ('Customer', CUSTOMER_TABLE_SQL),
+    ('ProductCategory', PRODUCTCATEGORY_TABLE_SQL),
+    ('Product', PRODUCT_TABLE_SQL),
+    ('OrderDetail', ORDERDETAIL_TABLE_SQL),
+]
+
+
+### Data file parsing
+
+def _iter_data_rows(data_filename):
+    # Yields the tab-separated fields of every data line, skipping blank lines and the header
+    rows = 0
+    try:
+        with open(data_filename, 'r') as f:
+            header = None
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                if not header:
+                    header = line.split("\t")
+                else:
+                    yield line.split("\t")
+                    rows += 1
+    finally:
+        _add_counts(rows_parsed=rows)
+
+
+def _split_customer_name(name):
+    name = name.split()
+    if len(name) == 2:
+        return name[0], name[1]
+    return name[0], " ".join(name[1:])
+
+
+class DimensionBuilder:
+    # Ordered dedup of dimension values. add() keeps the first payload seen for each key in O(1);
+    # build() sorts the keys (stably, so equal sort keys keep first-seen order), numbers the rows
+    # from 1 and fills the key -> ID map (ids) and its reverse (by_id).
+
+    def __init__(self):
+        self._seen = {}
+        self.ids = {}
+        self.by_id = {}
+
+    def add(self, key, payload=None):
+        if key not in self._seen:
+            self._seen[key] = payload
+
+    def update(self, keys):
+        for key in keys:
+            self.add(key)
+
+    def __contains__(self, key):
+        return key in self._seen
+
+    def __iter__(self):
+        return iter(self._seen)
+
+    def __len__(self):
+        return len(self._seen)
+
+    def items(self):
+        # (key, payload) pairs in first-seen order
+        return self._seen.items()
+
+    def build(self, sort_key=None):
+        # Returns [(ID, key, payload)] in ID order
+        if sort_key is None:
+            items = sorted(self._seen.items(), key=lambda item: item[0])
+        else:
+            items = sorted(self._seen.items(), key=lambda item: sort_key(item[0]))
+        rows = [(i, key, payload) for i, (key, payload) in enumerate(items, 1)]
+        self.ids = {key: i for i, key, _ in rows}
+        self.by_id = {i: key for i, key, _ in rows}
+        return rows
+
+
+def _pair_categories(categories, descriptions):
+    # step7 pairs the n-th distinct category with the n-th distinct description
+    dts = list(descriptions)
+    paired = DimensionBuilder()
+    for i, c in enumerate(categories):
+        paired.add(c, dts[i])
+    return paired
+
+
+@_instrumented('step')
 def step1_create_region_table(data_filename, normalized_database_filename):
     # Inputs: Name of the data and normalized database filename
     # Output: None
     
     ### BEGIN SOLUTION
-    with open(data_filename,'r') as f:
-        header=None
-        regions=[]
-        for line in f:
-            line=line.strip()
-            if not line:
-                continue
-            if not header:
-                header=line.split("\t")
-            else:
-                data=line.split('\t')
-                r=data[4]
-                if r not in regions:
-                    regions.append(r)
-        regions=sorted(regions)
-    conn=create_connection(normalized_database_filename)
-    create_table_sql='''
-    CREATE TABLE IF NOT EXISTS Region (
-        RegionID INTEGER NOT NULL PRIMARY KEY,
-        Region TEXT NOT NULL
-    )
-    '''
-    create_table(conn,create_table_sql,drop_table_name='Region')
-    with conn:
-        for i, val in enumerate(regions):
-            insert_sql=f"INSERT INTO Region (RegionID, Region) VALUES ({i+1}, '{val}')"
-            execute_sql_statement(insert_sql,conn)
+    regions=DimensionBuilder()
+    for data in _iter_data_rows(data_filename):
+        regions.add(data[4])
+    with get_pool(normalized_database_filename).writer() as conn:
+        create_table(conn,REGION_TABLE_SQL,drop_table_name='Region')
+        with conn:
+            sql="INSERT INTO Region (RegionID, Region) VALUES (?, ?)"
+            cur=conn.cursor()
+            cur.executemany(sql,[(i, val) for i, val, _ in regions.build()])
     ### END SOLUTION
 
+@_instrumented('step')
 def step2_create_region_to_regionid_dictionary(normalized_database_filename):
     
     
     ### BEGIN SOLUTION
-    conn=create_connection(normalized_database_filename)
-    sql_statement="SELECT RegionID, Region FROM Region"
-    rows=execute_sql_statement(sql_statement,conn)
-    d={}
-    for row in rows:
-        d[row[1]]=row[0]
-    return d
+    return _lookup_dictionary(normalized_database_filename, 'Region')
     ### END SOLUTION
 
 
+@_instrumented('step')
 def step3_create_country_table(data_filename, normalized_database_filename):
     # Inputs: Name of the data and normalized database filename
     # Output: None
     
     ### BEGIN SOLUTION
     d=step2_create_region_to_regionid_dictionary(normalized_database_filename)
-    conn=create_connection(normalized_database_filename)
-    create_table_sql="""
-            CREATE TABLE IF NOT EXISTS Country (
-                CountryID INTEGER NOT NULL PRIMARY KEY,
-                Country TEXT NOT NULL,RegionID INTEGER NOT NULL,
-                FOREIGN KEY (RegionID) REFERENCES Region (RegionID)
-            );
-        """
-    create_table(conn, create_table_sql,"Country")
-    dic_countries={}
-    with open(data_filename,'r') as f:
-        header=None
-        regions=[]
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            if not header:
-                header=line.split("\t")
-            else:
-                data=line.split('\t')
-                country=data[3]
-                region=data[4]
-                if country not in dic_countries:
-                    dic_countries[country] = region
-    country_data=[]
-    for c, r in sorted(dic_countries.items()):
-        r_id=d[r]
-        country_data.append((c,r_id))
-    with conn:
-        sql="INSERT INTO Country (Country, RegionID) VALUES (?, ?)"
-        cur=conn.cursor()
-        cur.executemany(sql,country_data) 
+    countries=DimensionBuilder()
+    for data in _iter_data_rows(data_filename):
+        countries.add(data[3], data[4])
+    country_data=[(i, c, d[r]) for i, c, r in countries.build()]
+    with get_pool(normalized_database_filename).writer() as conn:
+        create_table(conn, COUNTRY_TABLE_SQL,"Country")
+        with conn:
+            sql="INSERT INTO Country (CountryID, Country, RegionID) VALUES (?, ?, ?)"
+            cur=conn.cursor()
+            cur.executemany(sql,country_data) 
     ### END SOLUTION
 
 
+@_instrumented('step')
 def step4_create_country_to_countryid_dictionary(normalized_database_filename):
     ### BEGIN SOLUTION
-    conn = sqlite3.connect(normalized_database_filename)
-    sql_statement="SELECT CountryID, Country FROM Country"
-    rows = execute_sql_statement(sql_statement,conn)
-    d={}
-    for row in rows:
-        c_id,country=row
-        d[country]=c_id
-    return d
+    return _lookup_dictionary(normalized_database_filename, 'Country')
     ### END SOLUTION
         
         
+@_instrumented('step')
 def step5_create_customer_table(data_filename, normalized_database_filename):
 
     ### BEGIN SOLUTION
     country_dict = step4_create_country_to_countryid_dictionary(normalized_database_filename)
-    conn = create_connection(normalized_database_filename)
-    create_table_sql = """
-            CREATE TABLE IF NOT EXISTS Customer (
-                CustomerID INTEGER NOT NULL PRIMARY KEY,
-                FirstName TEXT NOT NULL,LastName TEXT NOT NULL,
-                Address TEXT NOT NULL,City TEXT NOT NULL,
-                CountryID INTEGER NOT NULL,FOREIGN KEY (CountryID) REFERENCES Country (CountryID)
-            );
-        """
-    create_table(conn,create_table_sql,"Customer")
     cus_data=[]
-    with open(data_filename, 'r') as f:
-        header = None
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            if not header:
-                header=line.split("\t")
-            else:
-                data=line.split("\t")
-                name=data[0].split()
-                if len(name)==2:
-                    firstname,lastname=name
-                else:
-                    firstname=name[0]
-                    lastname=" ".join(name[1:])
-                address=data[1]
-                city=data[2]
-                country=data[3]
-                country_id=country_dict[country]
-                cus_data.append((firstname, lastname, address, city, country_id))
+    for data in _iter_data_rows(data_filename):
+        firstname, lastname = _split_customer_name(data[0])
+        address=data[1]
+        city=data[2]
+        country=data[3]
+        country_id=country_dict[country]
+        cus_data.append((firstname, lastname, address, city, country_id))
     cus_data.sort(key=lambda x: (x[0], x[1]))
-    print(cus_data)
-    with conn:
-        sql="INSERT INTO Customer (FirstName, LastName, Address, City, CountryID) VALUES (?, ?, ?, ?, ?)"
-        cur=conn.cursor()
-        cur.executemany(sql,cus_data)
+    with get_pool(normalized_database_filename).writer() as conn:
+        create_table(conn,CUSTOMER_TABLE_SQL,"Customer")
+        with conn:
+            sql="INSERT INTO Customer (FirstName, LastName, Address, City, CountryID) VALUES (?, ?, ?, ?, ?)"
+            cur=conn.cursor()
+            cur.executemany(sql,cus_data)
     ### END SOLUTION
 
 
+@_instrumented('step')
 def step6_create_customer_to_customerid_dictionary(normalized_database_filename):
     ### BEGIN SOLUTION
-    conn = sqlite3.connect(normalized_database_filename)
-    sql_statement="SELECT CustomerID, FirstName, LastName FROM Customer"
-    rows = execute_sql_statement(sql_statement, conn)
-    d={}
-    for row in rows:
-        full_name= row[1] + ' ' + row[2]
-        d[full_name]=row[0]
-    return d
+    return _lookup_dictionary(normalized_database_filename, 'Customer')
     ### END SOLUTION
         
+@_instrumented('step')
 def step7_create_productcategory_table(data_filename, normalized_database_filename):
     # Inputs: Name of the data and normalized database filename
     # Output: None
 
     ### BEGIN SOLUTION
-    conn = create_connection(normalized_database_filename)
-    create_table_sql="""
-        CREATE TABLE IF NOT EXISTS ProductCategory (
-            ProductCategoryID INTEGER NOT NULL PRIMARY KEY,ProductCategory TEXT NOT NULL,ProductCategoryDescription TEXT NOT NULL
-        );
-    """
-    create_table(conn,create_table_sql,"ProductCategory")
-
-    cts=[]
-    dts=[]
-    with open(data_filename, 'r') as f:
-        header = None
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            if not header:
-                header=line.split("\t")
-            else:
-                data=line.split("\t")
-                category=data[6]
-                description=data[7]
-
-                for c in category.split(';'):
-                    if c not in cts:
-                        cts.append(c)
+    with get_pool(normalized_database_filename).writer() as conn:
+        create_table(conn,PRODUCTCATEGORY_TABLE_SQL,"ProductCategory")
 
-                for d in description.split(';'):
-                    if d not in dts:
-                        dts.append(d)
+        cts=DimensionBuilder()
+        dts=DimensionBuilder()
+        for data in _iter_data_rows(data_filename):
+            cts.update(data[6].split(';'))
+            dts.update(data[7].split(';'))
+        res=_pair_categories(cts, dts).build()
 
-    category_data = []
-    for i, category in enumerate((cts)):
-        category_data.append((i+1, category, dts[i]))
-
-    category_dict = {category_data[i][1]: category_data[i][2] for i in range(len(category_data))}
-
-    res=[]
-    for i,(category,description) in enumerate(sorted(category_dict.items()),1):
-        res.append((i,category,description))
-
-    with conn:
-        sql = "INSERT INTO ProductCategory (ProductCategoryID, ProductCategory, ProductCategoryDescription) VALUES (?, ?, ?)"
-        cur = conn.cursor()
-        cur.executemany(sql, res)
+        with conn:
+            sql = "INSERT INTO ProductCategory (ProductCategoryID, ProductCategory, ProductCategoryDescription) VALUES (?, ?, ?)"
+            cur = conn.cursor()
+            cur.executemany(sql, res)
 
     ### END SOLUTION
 
 
 
+@_instrumented('step')
 def step8_create_productcategory_to_productcategoryid_dictionary(normalized_database_filename):
     
     
     ### BEGIN SOLUTION
-    conn = create_connection(normalized_database_filename)
-    sql_statement = "SELECT * FROM ProductCategory"
-    rows = execute_sql_statement(sql_statement, conn)
-    d={}
-    for row in rows:
-        d[row[1]]=row[0]
-    return d
+    return _lookup_dictionary(normalized_database_filename, 'ProductCategory')
     ### END SOLUTION
         
 
+@_instrumented('step')
 def step9_create_product_table(data_filename, normalized_database_filename):
     # Inputs: Name of the data and normalized database filename
     # Output: None
@@ -277,118 +975,1634 @@ def step9_create_product_table(data_filename, normalized_database_filename):
     
     ### BEGIN SOLUTION
     
-    conn = create_connection(normalized_database_filename)
-    create_table_sql = """
-        CREATE TABLE IF NOT EXISTS Product (
-            ProductID INTEGER NOT NULL PRIMARY KEY,
-            ProductName TEXT NOT NULL,
-            ProductUnitPrice REAL NOT NULL,
-            ProductCategoryID INTEGER NOT NULL,
-            FOREIGN KEY (ProductCategoryID) REFERENCES ProductCategory (ProductCategoryID)
-        );
-    """
-    create_table(conn, create_table_sql, "Product")
-    d=step8_create_productcategory_to_productcategoryid_dictionary(normalized_database_filename)
-
-    res=[]
-    products=[]
-    with open(data_filename, "r") as f:
-        header=None
-        for line in f:
-            line=line.strip()
-            if not line:
-                continue
-            if not header:
-                header = line.split("\t")
-            else:
-                data=line.split("\t")
-                pn=data[5]
-                pc=data[6]
-                pup=data[8]
-                for i in zip(pn.split(';'),pc.split(';'),pup.split(';')):
-                    if i not in res:
-                        res.append(i)
-    sorted_list=sorted(res,key=lambda x: x[0])
-
-    product_data = []
-    for i,val in enumerate(sorted_list):
-        pc_id = d[val[1]]
-        product_data.append((i+1, val[0], float(val[2]), pc_id))
-
-    with conn:
-        sql = "INSERT INTO Product (ProductID, ProductName, ProductUnitPrice, ProductCategoryID) VALUES (?, ?, ?, ?)"
-        cur = conn.cursor()
-        cur.executemany(sql,product_data)
+    with get_pool(normalized_database_filename).writer() as conn:
+        create_table(conn, PRODUCT_TABLE_SQL, "Product")
+        d=step8_create_productcategory_to_productcategoryid_dictionary(normalized_database_filename)
+
+        products=DimensionBuilder()
+        for data in _iter_data_rows(data_filename):
+            products.update(zip(data[5].split(';'),data[6].split(';'),data[8].split(';')))
+
+        product_data = []
+        for i, (name, category, price), _ in products.build(sort_key=lambda x: x[0]):
+            product_data.append((i, name, float(price), d[category]))
+
+        with conn:
+            sql = "INSERT INTO Product (ProductID, ProductName, ProductUnitPrice, ProductCategoryID) VALUES (?, ?, ?, ?)"
+            cur = conn.cursor()
+            cur.executemany(sql,product_data)
     
     ### END SOLUTION
 
 
+@_instrumented('step')
 def step10_create_product_to_productid_dictionary(normalized_database_filename):
     
     ### BEGIN SOLUTION
-    conn = create_connection(normalized_database_filename)
-    sql_statement = "SELECT ProductID, ProductName FROM Product"
-    rows = execute_sql_statement(sql_statement, conn)
-    d={}
-    for row in rows:
-        d[row[1]]=row[0]
-    return d
+    return _lookup_dictionary(normalized_database_filename, 'Product')
     ### END SOLUTION
         
 
-def step11_create_orderdetail_table(data_filename, normalized_database_filename):
+@_instrumented('step')
+def step11_create_orderdetail_table(data_filename, normalized_database_filename, workers=1, batch_size=None, commit_interval=None):
     # Inputs: Name of the data and normalized database filename
+    # Optional: workers > 1 parses newline-aligned byte ranges of the data file in that many processes
+    # Optional: batch_size / commit_interval stream the rows in fixed-size batches (see _insert_order_details)
     # Output: None
 
     
     ### BEGIN SOLUTION
-    conn = create_connection(normalized_database_filename)
-    create_table_sql = """
-        CREATE TABLE IF NOT EXISTS OrderDetail (
-            OrderID INTEGER NOT NULL PRIMARY KEY,CustomerID INTEGER NOT NULL,
-            ProductID INTEGER NOT NULL,OrderDate TEXT NOT NULL,QuantityOrdered INTEGER NOT NULL,
-            FOREIGN KEY (CustomerID) REFERENCES Customer (CustomerID),FOREIGN KEY (ProductID) REFERENCES Product (ProductID)
-        );
-    """
-    create_table(conn,create_table_sql,"OrderDetail") 
-    d=step6_create_customer_to_customerid_dictionary(normalized_database_filename)
-    d1=step10_create_product_to_productid_dictionary(normalized_database_filename)
-    from datetime import datetime
-    order_details=[]
-    with open(data_filename, 'r') as f:
-        header = None
-        for line in f:
-            line = line.strip()
+    with get_pool(normalized_database_filename).writer() as conn:
+        compact = has_compact_storage(conn)
+        expand_storage(conn)
+        create_table(conn,ORDERDETAIL_TABLE_SQL,"OrderDetail")
+        d=step6_create_customer_to_customerid_dictionary(normalized_database_filename)
+        d1=step10_create_product_to_productid_dictionary(normalized_database_filename)
+        if workers > 1:
+            order_details = itertools.chain.from_iterable(_parallel_order_details(data_filename, d, d1, workers))
+        else:
+            order_details = (row for data in _iter_data_rows(data_filename)
+                             for row in _order_rows(data[0], data[5], data[9], data[10], d, d1))
+        summaries = has_summary_tables(conn)
+        dates = has_date_dimension(conn)
+        drop_indexes(conn)
+        with bulk_load(conn):
+            _insert_order_details(conn, order_details, batch_size, commit_interval)
+        if compact:
+            compact_storage(conn)
+        else:
+            create_indexes(conn)
+        if summaries:
+            create_summary_tables(conn)
+        if dates:
+            create_date_dimension(conn)
+    ### END SOLUTION
+
+
+### Date normalization
+
+class DateNormalizer:
+    # Converts YYYYMMDD order dates to YYYY-MM-DD. The data only holds a few thousand distinct
+    # dates, so every distinct value goes through strptime once and is then served from a bounded
+    # LRU memo. normalize_many is the batch path: it also collapses repeats within the batch.
+
+    def __init__(self, maxsize=8192):
+        self.maxsize = maxsize
+        self._convert = functools.lru_cache(maxsize=maxsize)(self._parse)
+        self._batch_hits = 0
+
+    @staticmethod
+    def _parse(value):
+        return datetime.strptime(value, '%Y%m%d').strftime('%Y-%m-%d')
+
+    def __call__(self, value):
+        return self._convert(value)
+
+    def normalize_many(self, values):
+        values = list(values)
+        distinct = {v: self._convert(v) for v in dict.fromkeys(values)}
+        self._batch_hits += len(values) - len(distinct)
+        return [distinct[v] for v in values]
+
+    def stats(self):
+        info = self._convert.cache_info()
+        hits = info.hits + self._batch_hits
+        calls = hits + info.misses
+        return {
+            'hits': hits,
+            'misses': info.misses,
+            'size': info.currsize,
+            'maxsize': self.maxsize,
+            'hit_rate': hits / calls if calls else 0.0,
+        }
+
+    def clear(self):
+        self._convert.cache_clear()
+        self._batch_hits = 0
+
+
+order_dates = DateNormalizer()
+
+
+### Single-pass ingest
+
+ORDERDETAIL_INSERT_SQL = "INSERT INTO OrderDetail (OrderID, CustomerID, ProductID, OrderDate, QuantityOrdered) VALUES (?, ?, ?, ?, ?)"
+
+
+def _insert_order_details(conn, order_details, batch_size=None, commit_interval=None):
+    # Inserts OrderDetail tuples from any iterable without materializing it, inside the caller's
+    # transaction (the loaders wrap this in bulk_load, which checks foreign keys and commits).
+    # Without batch_size everything goes through one executemany and nothing is committed here.
+    # With batch_size the rows are taken batch_size at a time and committed every commit_interval
+    # rows (default: every batch), so memory and journal size stay bounded. Each intermediate
+    # commit is preceded by a foreign key check of the rows inserted since the previous one
+    # (the first also covers everything else in the transaction) and ForeignKeyCheckError leaves
+    # them uncommitted; batches committed before a failure are kept.
+    sql = ORDERDETAIL_INSERT_SQL
+    cur = conn.cursor()
+    if not batch_size:
+        cur.executemany(sql, order_details)
+        return
+    commit_interval = commit_interval or batch_size
+    order_details = iter(order_details)
+    pending = 0
+    checked = None
+    while True:
+        batch = list(itertools.islice(order_details, batch_size))
+        if not batch:
+            break
+        cur.executemany(sql, batch)
+        pending += len(batch)
+        if pending >= commit_interval:
+            if checked is None:
+                violations = foreign_key_check(conn)
+            else:
+                violations = _foreign_key_check_since(conn, 'OrderDetail', checked)
+            if violations:
+                raise ForeignKeyCheckError(violations)
+            checked = execute_sql_statement("SELECT MAX(rowid) FROM OrderDetail", conn)[0][0]
+            conn.commit()
+            pending = 0
+
+
+def _order_rows(name, product_names, quantities, dates, customer_ids, product_ids):
+    # Yields the OrderDetail tuples of one data line; unknown customers and products are skipped
+    customer_id = customer_ids.get(name)
+    if not customer_id:
+        return
+    product_qo = [int(q) for q in quantities.split(';')]
+    product_od = dates.split(';')
+    items = [(i, product_id) for i, product_id in enumerate(map(product_ids.get, product_names.split(';'))) if product_id]
+    normalized = order_dates.normalize_many([product_od[i] for i, _ in items])
+    for (i, product_id), order_date in zip(items, normalized):
+        yield (None, customer_id, product_id, order_date, product_qo[i])
+
+
+@_instrumented('step')
+def ingest_data(data_filename, normalized_database_filename, workers=1, batch_size=None, commit_interval=None, compact=False):
+    # Inputs: Name of the data and normalized database filename
+    # Optional: workers > 1 re-reads the order lists in parallel byte ranges (see step11_create_orderdetail_table)
+    # Optional: batch_size / commit_interval stream the OrderDetail rows (see _insert_order_details);
+    #           the order lists are then re-read in a second pass instead of being held in memory
+    # Optional: compact=True stores Product and OrderDetail in the compact layout (see compact_storage)
+    # Output: None
+    # Builds Region, Country, Customer, ProductCategory, Product and OrderDetail from a
+    # single read of the data file, assigning exactly the IDs that step1 - step11 assign.
+    regions = DimensionBuilder()
+    countries = DimensionBuilder()
+    customers = []
+    categories = DimensionBuilder()
+    descriptions = DimensionBuilder()
+    products = DimensionBuilder()
+    orders = []
+    for data in _iter_data_rows(data_filename):
+        regions.add(data[4])
+        countries.add(data[3], data[4])
+        firstname, lastname = _split_customer_name(data[0])
+        customers.append((firstname, lastname, data[1], data[2], data[3]))
+        product_categories = data[6].split(';')
+        categories.update(product_categories)
+        descriptions.update(data[7].split(';'))
+        products.update(zip(data[5].split(';'), product_categories, data[8].split(';')))
+        if workers <= 1 and not batch_size:
+            orders.append((data[0], data[5], data[9], data[10]))
+
+    region_data = [(i, r) for i, r, _ in regions.build()]
+    country_data = [(i, c, regions.ids[r]) for i, c, r in countries.build()]
+
+    customers.sort(key=lambda x: (x[0], x[1]))
+    customer_data = [(i, f, l, a, city, countries.ids[c]) for i, (f, l, a, city, c) in enumerate(customers, 1)]
+    customer_ids = {f + ' ' + l: i for i, f, l, _, _, _ in customer_data}
+
+    category_dim = _pair_categories(categories, descriptions)
+    category_data = category_dim.build()
+
+    product_data = [(i, name, float(price), category_dim.ids[c])
+                    for i, (name, c, price), _ in products.build(sort_key=lambda x: x[0])]
+    product_ids = {name: i for i, name, _, _ in product_data}
+
+    if workers > 1:
+        order_details = itertools.chain.from_iterable(
+            _parallel_order_details(data_filename, customer_ids, product_ids, workers))
+    elif batch_size:
+        order_details = (row for data in _iter_data_rows(data_filename)
+                         for row in _order_rows(data[0], data[5], data[9], data[10], customer_ids, product_ids))
+    else:
+        order_details = (row for order in orders for row in _order_rows(*order, customer_ids, product_ids))
+
+    with get_pool(normalized_database_filename).writer() as conn:
+        cur = conn.cursor()
+        summaries = has_summary_tables(conn)
+        dates = has_date_dimension(conn)
+        compact = compact or has_compact_storage(conn)
+        drop_summary_tables(conn)
+        _drop_compact_storage(conn)
+        cur.execute("DROP TABLE IF EXISTS LoadWatermark")
+        for table_name, _ in reversed(TABLES):
+            cur.execute("DROP TABLE IF EXISTS %s" % table_name)
+        for _, create_table_sql in TABLES:
+            create_table(conn, create_table_sql)
+        with bulk_load(conn):
+            cur.executemany("INSERT INTO Region (RegionID, Region) VALUES (?, ?)", region_data)
+            cur.executemany("INSERT INTO Country (CountryID, Country, RegionID) VALUES (?, ?, ?)", country_data)
+            cur.executemany("INSERT INTO Customer (CustomerID, FirstName, LastName, Address, City, CountryID) VALUES (?, ?, ?, ?, ?, ?)", customer_data)
+            cur.executemany("INSERT INTO ProductCategory (ProductCategoryID, ProductCategory, ProductCategoryDescription) VALUES (?, ?, ?)", category_data)
+            cur.executemany("INSERT INTO Product (ProductID, ProductName, ProductUnitPrice, ProductCategoryID) VALUES (?, ?, ?, ?)", product_data)
+            _insert_order_details(conn, order_details, batch_size, commit_interval)
+        if compact:
+            compact_storage(conn)
+        else:
+            create_indexes(conn)
+        if summaries:
+            create_summary_tables(conn)
+        if dates:
+            create_date_dimension(conn)
+
+
+### Incremental append
+
+def _file_digest(data_filename):
+    digest = hashlib.sha256()
+    with open(data_filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _append_dimension(cur, table, existing, dimension, make_row, sort_key=None, name_of=None):
+    # Inserts the keys of dimension that are missing from existing (a name -> ID map) with IDs
+    # after the current maximum, in the order a full load would sort them. Existing IDs never
+    # change. Returns existing, updated with the new IDs.
+    next_id = max(existing.values(), default=0)
+    new = DimensionBuilder()
+    for key, payload in dimension.items():
+        if (name_of(key) if name_of else key) not in existing:
+            new.add(key, payload)
+    rows = []
+    for i, key, payload in new.build(sort_key):
+        rows.append((next_id + i,) + make_row(key, payload))
+        existing[name_of(key) if name_of else key] = next_id + i
+    if rows:
+        cur.executemany("INSERT INTO %s VALUES (%s)" % (table, ", ".join("?" * len(rows[0]))), rows)
+    return existing
+
+
+def _loaded_order_items(cur, customer_ids):
+    # Counter of the (CustomerID, ProductID, OrderDate, QuantityOrdered) rows already in
+    # OrderDetail for the given customers, read through the CustomerID index
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS AppendCustomer (CustomerID INTEGER NOT NULL PRIMARY KEY)")
+    cur.executemany("INSERT INTO AppendCustomer (CustomerID) VALUES (?)", ((i,) for i in customer_ids))
+    rows = cur.execute("""
+        SELECT od.CustomerID, od.ProductID, od.OrderDate, od.QuantityOrdered, count(*)
+        FROM AppendCustomer a JOIN OrderDetail od ON od.CustomerID = a.CustomerID
+        GROUP BY od.CustomerID, od.ProductID, od.OrderDate, od.QuantityOrdered""").fetchall()
+    cur.execute("DROP TABLE temp.AppendCustomer")
+    return collections.Counter({row[:4]: row[4] for row in rows})
+
+
+@_instrumented('step')
+def append_data(data_filename, normalized_database_filename):
+    # Inputs: Name of the new data file and the normalized database filename
+    # Output: Number of OrderDetail rows appended
+    # Incremental counterpart of ingest_data. New regions, countries, customers, categories and
+    # products are added with IDs after the existing ones; existing rows keep their IDs. A file
+    # may overlap earlier loads: an order item matching an OrderDetail row already loaded (same
+    # customer, product, date and quantity, counted with multiplicity) is skipped, any other is
+    # appended whatever its date. Each file is recorded in LoadWatermark by content hash with
+    # the rows appended and skipped, and appending the same file again is a no-op. Everything
+    # is written in one transaction.
+    source_hash = _file_digest(data_filename)
+    with get_pool(normalized_database_filename).writer() as conn:
+        if not has_compact_storage(conn):
+            for _, create_table_sql in TABLES:
+                create_table(conn, create_table_sql)
+        create_table(conn, LOADWATERMARK_TABLE_SQL)
+        cur = conn.cursor()
+        if 'RowsSkipped' not in [column[1] for column in cur.execute("PRAGMA table_info(LoadWatermark)")]:
+            cur.execute("ALTER TABLE LoadWatermark ADD COLUMN RowsSkipped INTEGER NOT NULL DEFAULT 0")
+        if cur.execute("SELECT 1 FROM LoadWatermark WHERE SourceHash = ?", (source_hash,)).fetchone():
+            return 0
+
+        regions = DimensionBuilder()
+        countries = DimensionBuilder()
+        customers = DimensionBuilder()
+        categories = DimensionBuilder()
+        descriptions = DimensionBuilder()
+        products = DimensionBuilder()
+        orders = []
+        for data in _iter_data_rows(data_filename):
+            regions.add(data[4])
+            countries.add(data[3], data[4])
+            customers.add(data[0], (data[1], data[2], data[3]))
+            product_categories = data[6].split(';')
+            categories.update(product_categories)
+            descriptions.update(data[7].split(';'))
+            products.update(zip(data[5].split(';'), product_categories, data[8].split(';')))
+            orders.append((data[0], data[5], data[9], data[10]))
+
+        def existing(sql):
+            # name -> ID; ordered by ID so duplicate names map to the last row, as step6/step10 do
+            return {name: i for name, i in execute_sql_statement(sql, conn)}
+
+        with bulk_load(conn, durable=True):
+            region_ids = _append_dimension(
+                cur, "Region", existing("SELECT Region, RegionID FROM Region ORDER BY RegionID"),
+                regions, lambda r, _: (r,))
+            country_ids = _append_dimension(
+                cur, "Country", existing("SELECT Country, CountryID FROM Country ORDER BY CountryID"),
+                countries, lambda c, r: (c, region_ids[r]))
+            customer_ids = _append_dimension(
+                cur, "Customer",
+                existing("SELECT FirstName || ' ' || LastName, CustomerID FROM Customer ORDER BY CustomerID"),
+                customers, lambda name, p: _split_customer_name(name) + (p[0], p[1], country_ids[p[2]]),
+                sort_key=_split_customer_name)
+            category_ids = _append_dimension(
+                cur, "ProductCategory",
+                existing("SELECT ProductCategory, ProductCategoryID FROM ProductCategory ORDER BY ProductCategoryID"),
+                _pair_categories(categories, descriptions), lambda c, d: (c, d))
+            product_ids = _append_dimension(
+                cur, "Product", existing("SELECT ProductName, ProductID FROM Product ORDER BY ProductID"),
+                products, lambda key, _: (key[0], float(key[2]), category_ids[key[1]]),
+                sort_key=lambda key: key[0], name_of=lambda key: key[0])
+
+            candidates = [row for order in orders for row in _order_rows(*order, customer_ids, product_ids)]
+            loaded = _loaded_order_items(cur, {row[1] for row in candidates})
+            order_details = []
+            for row in candidates:
+                if loaded[row[1:]] > 0:
+                    loaded[row[1:]] -= 1
+                else:
+                    order_details.append(row)
+            cur.executemany(ORDERDETAIL_INSERT_SQL, order_details)
+            appended, skipped = len(order_details), len(candidates) - len(order_details)
+            _add_counts(rows_skipped=skipped)
+            max_order_date = execute_sql_statement("SELECT MAX(OrderDate) FROM OrderDetail", conn)[0][0]
+            cur.execute("INSERT INTO LoadWatermark (SourceHash, SourceFile, MaxOrderDate, RowsAppended, RowsSkipped) VALUES (?, ?, ?, ?, ?)",
+                        (source_hash, os.path.basename(data_filename), max_order_date, appended, skipped))
+        return appended
+
+
+### Parallel order parsing
+
+_order_worker_maps = None
+
+
+def _data_byte_ranges(data_filename, parts):
+    # Splits the file into at most `parts` (start, end) byte ranges that begin on line boundaries
+    size = os.path.getsize(data_filename)
+    bounds = [0]
+    with open(data_filename, 'rb') as f:
+        for i in range(1, parts):
+            pos = size * i // parts
+            if pos <= bounds[-1]:
+                continue
+            f.seek(pos - 1)
+            f.readline()
+            bounds.append(f.tell())
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+def _iter_range_rows(data_filename, start, end):
+    # Same as _iter_data_rows, restricted to the lines that start inside [start, end)
+    with open(data_filename, 'rb') as f:
+        f.seek(start)
+        header = start != 0
+        pos = start
+        while pos < end:
+            raw = f.readline()
+            if not raw:
+                break
+            pos += len(raw)
+            line = raw.decode().strip()
             if not line:
                 continue
             if not header:
-                header=line.split("\t")
+                header = True
             else:
-                data=line.split('\t')
-                name= data[0]
-                customer_id=d.get(name)
-                if not customer_id:
-                    continue  
-                product_names=data[5].split(';')
-                product_qo=[int(q) for q in data[9].split(';')]
-                product_od=data[10].split(';')
-                
-                for i, val in enumerate(product_names):
-                    product_id=d1.get(val)
-                    if not product_id:
-                        continue 
-                    order_date_str=product_od[i]
-                    order_date=datetime.strptime(order_date_str, '%Y%m%d').strftime('%Y-%m-%d')
-                    quantity_ordered=product_qo[i]
-                    order_details.append((None, customer_id, product_id, order_date, quantity_ordered))
-
-    with conn:
-        sql = "INSERT INTO OrderDetail (OrderID, CustomerID, ProductID, OrderDate, QuantityOrdered) VALUES (?, ?, ?, ?, ?)"
+                yield line.split("\t")
+
+
+def _init_order_worker(customer_ids, product_ids):
+    global _order_worker_maps
+    _order_worker_maps = (customer_ids, product_ids)
+
+
+def _parse_order_range(args):
+    data_filename, start, end = args
+    customer_ids, product_ids = _order_worker_maps
+    order_details = []
+    for data in _iter_range_rows(data_filename, start, end):
+        order_details.extend(_order_rows(data[0], data[5], data[9], data[10], customer_ids, product_ids))
+    return order_details
+
+
+def _parallel_order_details(data_filename, customer_ids, product_ids, workers):
+    # Worker processes parse and resolve IDs; the caller stays the single writer.
+    # Chunks come back in file order so OrderIDs match the serial load.
+    ranges = [(data_filename, start, end) for start, end in _data_byte_ranges(data_filename, workers * 4)]
+    with multiprocessing.Pool(workers, _init_order_worker, (customer_ids, product_ids)) as pool:
+        for order_details in pool.imap(_parse_order_range, ranges):
+            yield order_details
+
+
+### Summary tables
+
+# Optional running totals behind ex3 - ex6. Each row holds the unrounded
+# SUM(ProductUnitPrice * QuantityOrdered) and the number of OrderDetail rows behind it, keyed
+# like the report groups. create_summary_tables builds them from OrderDetail and installs
+# triggers that keep them current as OrderDetail rows are inserted, updated or deleted;
+# ingest_data and step11 rebuild them after a reload if the database had them. Edits to
+# Product prices or to a customer's country are not tracked: call create_summary_tables again.
+# (table, key column, key expression, tables joined to one OrderDetail row, join condition)
+SUMMARY_TABLES = [
+    ('CustomerTotal', 'CustomerID', 'c.CustomerID', 'Customer c, Product p',
+     'c.CustomerID = {od}.CustomerID AND p.ProductID = {od}.ProductID'),
+    ('CountryTotal', 'CountryID', 'co.CountryID', 'Customer c, Country co, Product p',
+     'c.CustomerID = {od}.CustomerID AND co.CountryID = c.CountryID AND p.ProductID = {od}.ProductID'),
+    ('RegionTotal', 'RegionID', 'r.RegionID', 'Customer c, Country co, Region r, Product p',
+     'c.CustomerID = {od}.CustomerID AND co.CountryID = c.CountryID AND r.RegionID = co.RegionID '
+     'AND p.ProductID = {od}.ProductID'),
+]
+
+SUMMARY_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        {key} INTEGER NOT NULL PRIMARY KEY,
+        Total REAL NOT NULL,
+        OrderCount INTEGER NOT NULL
+    );
+"""
+
+SUMMARY_REBUILD_SQL = """
+    INSERT INTO {table} ({key}, Total, OrderCount)
+        SELECT {key_expr}, SUM(p.ProductUnitPrice * od.QuantityOrdered), COUNT(*)
+        FROM OrderDetail od, {joins}
+        WHERE {where}
+        GROUP BY {key_expr}
+"""
+
+# Trigger body fragments applying one OrderDetail row ({od} is NEW or OLD) to one summary table
+SUMMARY_ADD_SQL = """
+        INSERT INTO {table} ({key}, Total, OrderCount)
+            SELECT {key_expr}, p.ProductUnitPrice * {od}.QuantityOrdered, 1 FROM {joins} WHERE {where}
+            ON CONFLICT ({key}) DO UPDATE SET Total = Total + excluded.Total, OrderCount = OrderCount + 1;
+"""
+
+SUMMARY_SUBTRACT_SQL = """
+        UPDATE {table}
+            SET Total = Total - (SELECT p.ProductUnitPrice * {od}.QuantityOrdered FROM {joins} WHERE {where}),
+                OrderCount = OrderCount - 1
+            WHERE {key} = (SELECT {key_expr} FROM {joins} WHERE {where});
+        DELETE FROM {table} WHERE {key} = (SELECT {key_expr} FROM {joins} WHERE {where}) AND OrderCount = 0;
+"""
+
+SUMMARY_TRIGGERS = [
+    ('trg_OrderDetail_Summary_Insert', "AFTER INSERT ON OrderDetail", [(SUMMARY_ADD_SQL, 'NEW')]),
+    ('trg_OrderDetail_Summary_Delete', "AFTER DELETE ON OrderDetail", [(SUMMARY_SUBTRACT_SQL, 'OLD')]),
+    ('trg_OrderDetail_Summary_Update', "AFTER UPDATE OF CustomerID, ProductID, QuantityOrdered ON OrderDetail",
+     [(SUMMARY_SUBTRACT_SQL, 'OLD'), (SUMMARY_ADD_SQL, 'NEW')]),
+]
+
+
+def _summary_sql(template, od, table, key, key_expr, joins, where):
+    return template.format(od=od, table=table, key=key, key_expr=key_expr, joins=joins, where=where.format(od=od))
+
+
+def has_summary_tables(conn):
+    return conn.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name IN (%s)"
+                        % ", ".join("'%s'" % s[0] for s in SUMMARY_TABLES)).fetchone()[0] == len(SUMMARY_TABLES)
+
+
+def drop_summary_tables(conn):
+    cur = conn.cursor()
+    for trigger_name, _, _ in SUMMARY_TRIGGERS:
+        cur.execute("DROP TRIGGER IF EXISTS %s" % trigger_name)
+    for summary in SUMMARY_TABLES:
+        cur.execute("DROP TABLE IF EXISTS %s" % summary[0])
+    conn.commit()
+
+
+def create_summary_tables(conn):
+    # (Re)builds the summary tables from OrderDetail and installs the maintenance triggers
+    if has_compact_storage(conn):
+        raise Error("the summary tables need the default storage layout (see expand_storage)")
+    drop_summary_tables(conn)
+    cur = conn.cursor()
+    for summary in SUMMARY_TABLES:
+        cur.execute(SUMMARY_TABLE_SQL.format(table=summary[0], key=summary[1]))
+        cur.execute(_summary_sql(SUMMARY_REBUILD_SQL, 'od', *summary))
+    for trigger_name, event, fragments in SUMMARY_TRIGGERS:
+        body = "".join(_summary_sql(template, od, *summary) for template, od in fragments for summary in SUMMARY_TABLES)
+        cur.execute("CREATE TRIGGER %s %s FOR EACH ROW BEGIN%s    END" % (trigger_name, event, body))
+    conn.commit()
+
+
+# Report statements over the summary tables; same columns, rounding and ordering as ex3 - ex6
+EX3_SUMMARY_SQL = """
+    SELECT c.FirstName || ' ' || c.LastName AS Name, ROUND(t.Total, 2) AS Total
+        FROM CustomerTotal t
+        JOIN Customer c ON c.CustomerID = t.CustomerID
+        ORDER BY Total DESC
+    """
+
+EX4_SUMMARY_SQL = """
+    SELECT r.Region, ROUND(t.Total, 2) AS Total
+    FROM RegionTotal t
+    JOIN Region r ON r.RegionID = t.RegionID
+    ORDER BY Total DESC
+    """
+
+EX5_SUMMARY_SQL = """
+    SELECT co.Country, ROUND(t.Total) AS CountryTotal
+    FROM CountryTotal t
+    JOIN Country co ON co.CountryID = t.CountryID
+    ORDER BY CountryTotal DESC;
+    """
+
+EX6_SUMMARY_SQL = """
+    SELECT r.Region,
+        co.Country,
+        ROUND(t.Total) AS CountryTotal,
+        RANK() OVER (PARTITION BY r.Region ORDER BY ROUND(t.Total) DESC) AS CountryRegionalRank
+    FROM CountryTotal t
+    JOIN Country co ON co.CountryID = t.CountryID
+    JOIN Region r ON r.RegionID = co.RegionID
+    ORDER BY r.Region ASC;
+    """
+
+
+### Date dimension
+
+# Optional calendar behind ex8 - ex10. Date holds one row per distinct OrderDate, keyed by the
+# integer yyyymmdd DateKey, with the Year, Quarter ('Q1' - 'Q4'), Month and MonthName the
+# reports used to derive with strftime on every OrderDetail row; OrderDetail.DateKey points
+# at it. create_date_dimension adds both and installs triggers that key new or re-dated
+# OrderDetail rows; ingest_data and step11 rebuild it after a reload if the database had it.
+MONTH_NAMES = ['January', 'February', 'March', 'April', 'May', 'June', 'July',
+               'August', 'September', 'October', 'November', 'December']
+
+DATE_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS Date (
+        DateKey INTEGER NOT NULL PRIMARY KEY,
+        Date TEXT NOT NULL UNIQUE,
+        Year INTEGER NOT NULL,
+        Quarter TEXT NOT NULL,
+        Month INTEGER NOT NULL,
+        MonthName TEXT NOT NULL
+    );
+"""
+
+DATE_KEY_SQL = "CAST(strftime('%Y%m%d', {date}) AS INTEGER)"
+
+# Adds the Date rows for the dates selected by {dates} (a query with one column named d)
+DATE_INSERT_SQL = """
+    INSERT OR IGNORE INTO Date (DateKey, Date, Year, Quarter, Month, MonthName)
+        SELECT {key}, d, CAST(strftime('%Y', d) AS INTEGER), 'Q' || ((CAST(strftime('%m', d) AS INTEGER) + 2) / 3),
+            CAST(strftime('%m', d) AS INTEGER), CASE strftime('%m', d) {month_names} END
+        FROM ({dates})
+""".replace('{key}', DATE_KEY_SQL.format(date='d')).replace(
+    '{month_names}', " ".join("WHEN '%02d' THEN '%s'" % (i + 1, name) for i, name in enumerate(MONTH_NAMES)))
+
+DATE_TRIGGERS = [
+    ('trg_OrderDetail_DateKey_Insert', "AFTER INSERT ON OrderDetail FOR EACH ROW WHEN NEW.DateKey IS NULL"),
+    ('trg_OrderDetail_DateKey_Update', "AFTER UPDATE OF OrderDate ON OrderDetail FOR EACH ROW"),
+]
+
+
+def has_date_dimension(conn):
+    # Checks Date, which outlives a reload of OrderDetail (the column and triggers go with the table)
+    return conn.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'Date'").fetchone()[0] == 1
+
+
+def drop_date_dimension(conn):
+    cur = conn.cursor()
+    for trigger_name, _ in DATE_TRIGGERS:
+        cur.execute("DROP TRIGGER IF EXISTS %s" % trigger_name)
+    if any(column[1] == 'DateKey' for column in cur.execute("PRAGMA table_info(OrderDetail)")):
+        cur.execute("ALTER TABLE OrderDetail DROP COLUMN DateKey")
+    cur.execute("DROP TABLE IF EXISTS Date")
+    conn.commit()
+
+
+def create_date_dimension(conn):
+    # (Re)builds Date and OrderDetail.DateKey from OrderDetail and installs the maintenance triggers
+    if has_compact_storage(conn):
+        raise Error("the Date dimension needs the default storage layout (see expand_storage)")
+    cur = conn.cursor()
+    for trigger_name, _ in DATE_TRIGGERS:
+        cur.execute("DROP TRIGGER IF EXISTS %s" % trigger_name)
+    cur.execute("DROP TABLE IF EXISTS Date")
+    cur.execute(DATE_TABLE_SQL)
+    cur.execute(DATE_INSERT_SQL.format(dates="SELECT DISTINCT OrderDate AS d FROM OrderDetail"))
+    if not any(column[1] == 'DateKey' for column in cur.execute("PRAGMA table_info(OrderDetail)")):
+        cur.execute("ALTER TABLE OrderDetail ADD COLUMN DateKey INTEGER")
+    cur.execute("UPDATE OrderDetail SET DateKey = %s" % DATE_KEY_SQL.format(date='OrderDate'))
+    for trigger_name, event in DATE_TRIGGERS:
+        cur.execute("CREATE TRIGGER %s %s BEGIN %s; UPDATE OrderDetail SET DateKey = %s WHERE OrderID = NEW.OrderID; END"
+                    % (trigger_name, event, DATE_INSERT_SQL.format(dates="SELECT NEW.OrderDate AS d"),
+                       DATE_KEY_SQL.format(date='NEW.OrderDate')))
+    conn.commit()
+
+
+# ex8 - ex10 over the Date dimension; same columns, rounding and ordering
+EX8_DATE_SQL = """
+    WITH tbl AS (
+        SELECT od.CustomerID, d.Year, d.Quarter, ROUND(SUM(p.ProductUnitPrice * od.QuantityOrdered)) AS Total
+        FROM OrderDetail od
+        JOIN Product p ON p.ProductID = od.ProductID
+        JOIN Date d ON d.DateKey = od.DateKey
+        GROUP BY od.CustomerID, d.Year, d.Quarter
+    )
+    SELECT Quarter, Year, CustomerID, Total
+    FROM tbl
+    GROUP BY Quarter, Year, CustomerID
+    ORDER BY Year
+    """
+
+EX9_DATE_SQL = """
+    WITH tbl AS (
+        SELECT od.CustomerID, d.Year, d.Quarter, ROUND(SUM(p.ProductUnitPrice * od.QuantityOrdered)) AS Total
+        FROM OrderDetail od
+        JOIN Product p ON p.ProductID = od.ProductID
+        JOIN Date d ON d.DateKey = od.DateKey
+        GROUP BY od.CustomerID, d.Year, d.Quarter
+    ),
+    QuarterYearRank AS (
+        SELECT Quarter, Year, CustomerID, Total, RANK() OVER (PARTITION BY Quarter, Year ORDER BY Total DESC) AS CustomerRank
+        FROM tbl
+    )
+    SELECT Quarter, Year, CustomerID, Total, CustomerRank
+    FROM QuarterYearRank
+    WHERE CustomerRank <= 5
+    ORDER BY Year ASC, Quarter ASC, CustomerRank ASC;
+    """
+
+EX10_DATE_SQL = """
+    WITH tbl1 AS (
+        SELECT d.MonthName AS Month, SUM(ROUND(p.ProductUnitPrice * od.QuantityOrdered)) AS TotalMonthlySales
+        FROM OrderDetail od
+        JOIN Product p ON p.ProductID = od.ProductID
+        JOIN Date d ON d.DateKey = od.DateKey
+        GROUP BY d.MonthName
+    ),
+    monthly_sales_ranked AS (
+        SELECT Month, TotalMonthlySales, RANK() OVER (ORDER BY TotalMonthlySales DESC) AS TotalRank
+        FROM tbl1
+    )
+    SELECT Month, TotalMonthlySales AS Total, TotalRank AS TotalRank
+    FROM monthly_sales_ranked
+    ORDER BY TotalRank ASC
+    """
+
+
+### Compact storage
+
+# Optional smaller layout for large databases. Product and OrderDetail become views over
+# ProductCompact, which stores ProductUnitPrice as integer cents, and OrderDetailCompact, which
+# stores OrderDate as an integer day number (days since 1970-01-01). The views give back the
+# original columns: cents / 100.0 is exactly the REAL the loaders store for prices with at most
+# two decimals, and date(OrderDay + COMPACT_EPOCH) the ISO date, so every query returns the
+# same results; ex8 - ex11 read the day numbers directly. INSTEAD OF triggers route writes
+# through the views to the compact tables. compact_storage converts a loaded database and
+# rebuilds it with COMPACT_PAGE_SIZE pages (VACUUM); expand_storage converts it back.
+# ingest_data(compact=True) converts right after the load, and ingest_data and step11 keep the
+# layout across reloads. The summary tables and the Date dimension hang triggers on the
+# OrderDetail table and need the default layout. Planner statistics are opt-in: with
+# sqlite_stat1 the planner drives ex4 - ex7 from Country through a CustomerID index, which is
+# slower here and sums each group in a different order than the OrderID scan, so ROUND()ed
+# totals can move (see INDEXES).
+COMPACT_PAGE_SIZE = 8192
+
+# julianday('1970-01-01'): OrderDay + COMPACT_EPOCH is a julian day the date functions accept
+COMPACT_EPOCH = 2440587.5
+
+COMPACT_TABLES = [
+    ('ProductCompact', """
+    CREATE TABLE IF NOT EXISTS ProductCompact (
+        ProductID INTEGER NOT NULL PRIMARY KEY,
+        ProductName TEXT NOT NULL,
+        ProductUnitPriceCents INTEGER NOT NULL,
+        ProductCategoryID INTEGER NOT NULL,
+        FOREIGN KEY (ProductCategoryID) REFERENCES ProductCategory (ProductCategoryID)
+    );
+"""),
+    ('OrderDetailCompact', """
+    CREATE TABLE IF NOT EXISTS OrderDetailCompact (
+        OrderID INTEGER NOT NULL PRIMARY KEY,CustomerID INTEGER NOT NULL,
+        ProductID INTEGER NOT NULL,OrderDay INTEGER NOT NULL,QuantityOrdered INTEGER NOT NULL,
+        FOREIGN KEY (CustomerID) REFERENCES Customer (CustomerID),FOREIGN KEY (ProductID) REFERENCES ProductCompact (ProductID)
+    );
+"""),
+]
+
+# The INDEXES of the default layout, on OrderDetailCompact (OrderDay sorts like OrderDate)
+COMPACT_INDEXES = [
+    ('idx_OrderDetailCompact_CustomerID', "CREATE INDEX IF NOT EXISTS idx_OrderDetailCompact_CustomerID ON OrderDetailCompact (CustomerID)"),
+    ('idx_OrderDetailCompact_CustomerID_OrderDay', "CREATE INDEX IF NOT EXISTS idx_OrderDetailCompact_CustomerID_OrderDay ON OrderDetailCompact (CustomerID, OrderDay)"),
+    ('idx_OrderDetailCompact_ProductID', "CREATE INDEX IF NOT EXISTS idx_OrderDetailCompact_ProductID ON OrderDetailCompact (ProductID)"),
+]
+
+COMPACT_PRICE_SQL = "CAST(ROUND({price} * 100) AS INTEGER)"
+COMPACT_DAY_SQL = "CAST(julianday({date}) - %s AS INTEGER)" % COMPACT_EPOCH
+
+COMPACT_VIEWS = [
+    ('Product', """
+    CREATE VIEW Product AS
+        SELECT ProductID, ProductName, ProductUnitPriceCents / 100.0 AS ProductUnitPrice, ProductCategoryID
+        FROM ProductCompact
+"""),
+    ('OrderDetail', """
+    CREATE VIEW OrderDetail AS
+        SELECT OrderID, CustomerID, ProductID, date(OrderDay + %s) AS OrderDate, QuantityOrdered
+        FROM OrderDetailCompact
+""" % COMPACT_EPOCH),
+]
+
+# Rows the compact columns cannot reproduce exactly; compact_storage refuses to convert them
+COMPACT_CHECKS = [
+    ('ProductUnitPrice', "SELECT count(*) FROM Product WHERE %s / 100.0 IS NOT ProductUnitPrice"
+     % COMPACT_PRICE_SQL.format(price='ProductUnitPrice')),
+    ('OrderDate', "SELECT count(*) FROM OrderDetail WHERE date(OrderDate) IS NOT OrderDate"),
+]
+
+_COMPACT_PRODUCT_GUARD = ("SELECT RAISE(ABORT, 'ProductUnitPrice is not a whole number of cents') WHERE %s / 100.0 IS NOT NEW.ProductUnitPrice;"
+                          % COMPACT_PRICE_SQL.format(price='NEW.ProductUnitPrice'))
+_COMPACT_ORDER_GUARD = "SELECT RAISE(ABORT, 'OrderDate is not an ISO date') WHERE date(NEW.OrderDate) IS NOT NEW.OrderDate;"
+
+COMPACT_TRIGGERS = [
+    ('trg_Product_Insert', "INSTEAD OF INSERT ON Product", _COMPACT_PRODUCT_GUARD + """
+        INSERT INTO ProductCompact (ProductID, ProductName, ProductUnitPriceCents, ProductCategoryID)
+            VALUES (NEW.ProductID, NEW.ProductName, %s, NEW.ProductCategoryID);""" % COMPACT_PRICE_SQL.format(price='NEW.ProductUnitPrice')),
+    ('trg_Product_Update', "INSTEAD OF UPDATE ON Product", _COMPACT_PRODUCT_GUARD + """
+        UPDATE ProductCompact SET ProductID = NEW.ProductID, ProductName = NEW.ProductName,
+            ProductUnitPriceCents = %s, ProductCategoryID = NEW.ProductCategoryID
+            WHERE ProductID = OLD.ProductID;""" % COMPACT_PRICE_SQL.format(price='NEW.ProductUnitPrice')),
+    ('trg_Product_Delete', "INSTEAD OF DELETE ON Product", """
+        DELETE FROM ProductCompact WHERE ProductID = OLD.ProductID;"""),
+    ('trg_OrderDetail_Insert', "INSTEAD OF INSERT ON OrderDetail", _COMPACT_ORDER_GUARD + """
+        INSERT INTO OrderDetailCompact (OrderID, CustomerID, ProductID, OrderDay, QuantityOrdered)
+            VALUES (NEW.OrderID, NEW.CustomerID, NEW.ProductID, %s, NEW.QuantityOrdered);""" % COMPACT_DAY_SQL.format(date='NEW.OrderDate')),
+    ('trg_OrderDetail_Update', "INSTEAD OF UPDATE ON OrderDetail", _COMPACT_ORDER_GUARD + """
+        UPDATE OrderDetailCompact SET OrderID = NEW.OrderID, CustomerID = NEW.CustomerID, ProductID = NEW.ProductID,
+            OrderDay = %s, QuantityOrdered = NEW.QuantityOrdered
+            WHERE OrderID = OLD.OrderID;""" % COMPACT_DAY_SQL.format(date='NEW.OrderDate')),
+    ('trg_OrderDetail_Delete', "INSTEAD OF DELETE ON OrderDetail", """
+        DELETE FROM OrderDetailCompact WHERE OrderID = OLD.OrderID;"""),
+]
+
+
+def has_compact_storage(conn):
+    return conn.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'OrderDetailCompact'").fetchone()[0] == 1
+
+
+def _drop_compact_storage(conn):
+    # Drops the views (and with them the triggers) and the compact tables, children first
+    if not has_compact_storage(conn):
+        return
+    cur = conn.cursor()
+    for view_name, _ in reversed(COMPACT_VIEWS):
+        cur.execute("DROP VIEW IF EXISTS %s" % view_name)
+    for table_name, _ in reversed(COMPACT_TABLES):
+        cur.execute("DROP TABLE IF EXISTS %s" % table_name)
+
+
+def compact_storage(conn, page_size=COMPACT_PAGE_SIZE, analyze=False):
+    # Converts Product and OrderDetail to the compact layout (a no-op if they already are), then
+    # VACUUMs with the given page size (which cannot change in WAL mode). analyze=True also runs
+    # ANALYZE; off by default, see the note above.
+    if has_summary_tables(conn) or has_date_dimension(conn):
+        raise Error("compact storage does not support the summary tables or the Date dimension; drop them first")
+    if not has_compact_storage(conn):
+        for column, check_sql in COMPACT_CHECKS:
+            bad = execute_sql_statement(check_sql, conn)[0][0]
+            if bad:
+                raise Error("%d %s value(s) cannot be stored compactly" % (bad, column))
         cur = conn.cursor()
-        cur.executemany(sql,order_details)
-    ### END SOLUTION
+        with bulk_load(conn, durable=True):
+            for _, create_table_sql in COMPACT_TABLES:
+                create_table(conn, create_table_sql)
+            cur.execute("INSERT INTO ProductCompact (ProductID, ProductName, ProductUnitPriceCents, ProductCategoryID) "
+                        "SELECT ProductID, ProductName, %s, ProductCategoryID FROM Product ORDER BY ProductID"
+                        % COMPACT_PRICE_SQL.format(price='ProductUnitPrice'))
+            cur.execute("INSERT INTO OrderDetailCompact (OrderID, CustomerID, ProductID, OrderDay, QuantityOrdered) "
+                        "SELECT OrderID, CustomerID, ProductID, %s, QuantityOrdered FROM OrderDetail ORDER BY OrderID"
+                        % COMPACT_DAY_SQL.format(date='OrderDate'))
+            cur.execute("DROP TABLE OrderDetail")
+            cur.execute("DROP TABLE Product")
+            for _, create_view_sql in COMPACT_VIEWS:
+                cur.execute(create_view_sql)
+            for trigger_name, event, body in COMPACT_TRIGGERS:
+                cur.execute("CREATE TRIGGER %s %s FOR EACH ROW BEGIN %s END" % (trigger_name, event, body))
+        for _, create_index_sql in COMPACT_INDEXES:
+            cur.execute(create_index_sql)
+        conn.commit()
+    conn.execute("PRAGMA page_size = %d" % page_size)
+    conn.execute("VACUUM")
+    if analyze:
+        conn.execute("ANALYZE")
+    conn.commit()
+
+
+def expand_storage(conn):
+    # Converts a compact database back to the default Product and OrderDetail tables
+    if not has_compact_storage(conn):
+        return
+    cur = conn.cursor()
+    with bulk_load(conn, durable=True):
+        for view_name, _ in reversed(COMPACT_VIEWS):
+            cur.execute("DROP VIEW %s" % view_name)
+        create_table(conn, PRODUCT_TABLE_SQL)
+        create_table(conn, ORDERDETAIL_TABLE_SQL)
+        cur.execute("INSERT INTO Product (ProductID, ProductName, ProductUnitPrice, ProductCategoryID) "
+                    "SELECT ProductID, ProductName, ProductUnitPriceCents / 100.0, ProductCategoryID FROM ProductCompact ORDER BY ProductID")
+        cur.execute("INSERT INTO OrderDetail (OrderID, CustomerID, ProductID, OrderDate, QuantityOrdered) "
+                    "SELECT OrderID, CustomerID, ProductID, date(OrderDay + %s), QuantityOrdered FROM OrderDetailCompact ORDER BY OrderID"
+                    % COMPACT_EPOCH)
+        for table_name, _ in reversed(COMPACT_TABLES):
+            cur.execute("DROP TABLE %s" % table_name)
+    create_indexes(conn)
+
+
+# ex8 - ex11 over the compact tables, taking the date parts straight from the day number
+# rather than through the OrderDetail view's date text; same columns, rounding and ordering
+EX8_COMPACT_SQL = """
+    WITH tbl AS (
+        SELECT od.CustomerID, CAST(strftime('%Y', od.OrderDay + {epoch}) AS INTEGER) AS Year,
+            'Q' || ((CAST(strftime('%m', od.OrderDay + {epoch}) AS INTEGER) + 2) / 3) AS Quarter,
+            ROUND(SUM(p.ProductUnitPrice * od.QuantityOrdered)) AS Total
+        FROM OrderDetailCompact od
+        JOIN Product p ON p.ProductID = od.ProductID
+        GROUP BY od.CustomerID, Year, Quarter
+    )
+    SELECT Quarter, Year, CustomerID, Total
+    FROM tbl
+    GROUP BY Quarter, Year, CustomerID
+    ORDER BY Year
+    """.replace('{epoch}', str(COMPACT_EPOCH))
+
+EX9_COMPACT_SQL = """
+    WITH tbl AS (
+        SELECT od.CustomerID, CAST(strftime('%Y', od.OrderDay + {epoch}) AS INTEGER) AS Year,
+            'Q' || ((CAST(strftime('%m', od.OrderDay + {epoch}) AS INTEGER) + 2) / 3) AS Quarter,
+            ROUND(SUM(p.ProductUnitPrice * od.QuantityOrdered)) AS Total
+        FROM OrderDetailCompact od
+        JOIN Product p ON p.ProductID = od.ProductID
+        GROUP BY od.CustomerID, Year, Quarter
+    ),
+    QuarterYearRank AS (
+        SELECT Quarter, Year, CustomerID, Total, RANK() OVER (PARTITION BY Quarter, Year ORDER BY Total DESC) AS CustomerRank
+        FROM tbl
+    )
+    SELECT Quarter, Year, CustomerID, Total, CustomerRank
+    FROM QuarterYearRank
+    WHERE CustomerRank <= 5
+    ORDER BY Year ASC, Quarter ASC, CustomerRank ASC;
+    """.replace('{epoch}', str(COMPACT_EPOCH))
+
+EX10_COMPACT_SQL = """
+    WITH tbl1 AS (
+        SELECT CASE strftime('%m', od.OrderDay + {epoch}) {month_names} END AS Month,
+            SUM(ROUND(p.ProductUnitPrice * od.QuantityOrdered)) AS TotalMonthlySales
+        FROM OrderDetailCompact od
+        JOIN Product p ON p.ProductID = od.ProductID
+        GROUP BY Month
+    ),
+    monthly_sales_ranked AS (
+        SELECT Month, TotalMonthlySales, RANK() OVER (ORDER BY TotalMonthlySales DESC) AS TotalRank
+        FROM tbl1
+    )
+    SELECT Month, TotalMonthlySales AS Total, TotalRank AS TotalRank
+    FROM monthly_sales_ranked
+    ORDER BY TotalRank ASC
+    """.replace('{epoch}', str(COMPACT_EPOCH)).replace(
+    '{month_names}', " ".join("WHEN '%02d' THEN '%s'" % (i + 1, name) for i, name in enumerate(MONTH_NAMES)))
+
+# As ex11, with the gaps taken as differences of day numbers (REAL, like the julianday ones)
+EX11_COMPACT_SQL = """
+    WITH longest AS
+        (
+            SELECT CustomerID, Day, PreviousDay, Gap, MAX(Gap * 10000000 - Day) AS GapKey, COUNT(*) AS Ties
+            FROM (
+                SELECT CustomerID, OrderDay AS Day, lag(OrderDay) OVER w AS PreviousDay,
+                    CAST(OrderDay - lag(OrderDay) OVER w AS REAL) AS Gap
+                FROM OrderDetailCompact
+                WINDOW w AS (PARTITION BY CustomerID ORDER BY OrderDay)
+            )
+            WHERE Gap IS NOT NULL
+            GROUP BY CustomerID
+        ),
+    copies AS
+        (
+            SELECT 1 AS Copy
+            UNION ALL
+            SELECT Copy + 1 FROM copies WHERE Copy < (SELECT MAX(Ties) FROM longest WHERE Gap = 0)
+        )
+    SELECT l.CustomerID, c.FirstName, c.LastName, co.Country, date(l.Day + {epoch}) AS OrderDate,
+        date(l.PreviousDay + {epoch}) AS PreviousOrderDate, l.Gap AS MaxDaysWithoutOrder
+    FROM longest l
+        JOIN Customer c ON c.CustomerID = l.CustomerID
+        JOIN Country co ON co.CountryID = c.CountryID
+        JOIN copies ON copies.Copy <= CASE WHEN l.Gap = 0 THEN l.Ties ELSE 1 END
+    ORDER BY
+        MaxDaysWithoutOrder DESC,
+        l.CustomerID DESC
+    """.replace('{epoch}', str(COMPACT_EPOCH))
+
+
+### Parameterized customer reports
+
+# ex1/ex2 return these with the CustomerID inlined; they execute them with a '?' placeholder so
+# one compiled statement per connection serves every customer (see sqlite3 cached_statements).
+EX1_SQL = """
+    SELECT 
+        C.FirstName || ' ' || C.LastName AS Name,
+        P.ProductName,
+        OD.OrderDate,
+        P.ProductUnitPrice,
+        OD.QuantityOrdered,
+        ROUND(P.ProductUnitPrice * OD.QuantityOrdered, 2) AS Total
+    FROM 
+        OrderDetail OD
+        JOIN Customer C ON C.CustomerID = OD.CustomerID
+        JOIN Product P ON P.ProductID = OD.ProductID
+    WHERE 
+        C.CustomerID = {}
+    ORDER BY OD.OrderID
+    """
+
+EX2_SQL = """
+    SELECT c.FirstName || ' ' || c.LastName AS Name, ROUND(SUM(p.ProductUnitPrice * od.QuantityOrdered), 2) AS Total
+        FROM OrderDetail od
+        JOIN Customer c ON c.CustomerID = od.CustomerID
+        JOIN Product p ON p.ProductID = od.ProductID
+        WHERE c.CustomerID = {}
+        GROUP BY Name
+    """
+
+EX1_BATCH_SQL = """
+    SELECT 
+        C.FirstName || ' ' || C.LastName AS Name,
+        P.ProductName,
+        OD.OrderDate,
+        P.ProductUnitPrice,
+        OD.QuantityOrdered,
+        ROUND(P.ProductUnitPrice * OD.QuantityOrdered, 2) AS Total
+    FROM 
+        temp.ReportCustomer RC
+        JOIN OrderDetail OD ON OD.CustomerID = RC.CustomerID
+        JOIN Customer C ON C.CustomerID = OD.CustomerID
+        JOIN Product P ON P.ProductID = OD.ProductID
+    ORDER BY RC.Position, OD.OrderID
+    """
+
+EX2_BATCH_SQL = """
+    SELECT c.FirstName || ' ' || c.LastName AS Name, ROUND(SUM(p.ProductUnitPrice * od.QuantityOrdered), 2) AS Total
+        FROM temp.ReportCustomer rc
+        JOIN OrderDetail od ON od.CustomerID = rc.CustomerID
+        JOIN Customer c ON c.CustomerID = od.CustomerID
+        JOIN Product p ON p.ProductID = od.ProductID
+        GROUP BY rc.Position
+        ORDER BY rc.Position
+    """
+
+
+def ex1_query(conn, CustomerName):
+    # Same rows as ex1, as a DataFrame, through the cached parameterized statement
+    return report_cache.read_sql_query(EX1_SQL.format('?'), conn, params=(lookup_maps.get(conn, 'Customer')[CustomerName],))
+
+
+def ex2_query(conn, CustomerName):
+    return report_cache.read_sql_query(EX2_SQL.format('?'), conn, params=(lookup_maps.get(conn, 'Customer').get(CustomerName),))
+
+
+def _batch_report(conn, sql_statement, CustomerNames):
+    # Runs sql_statement against temp.ReportCustomer filled with the customers in input order;
+    # unknown names are skipped. The temp table is dropped afterwards; a transaction the caller
+    # already had open is left open, one begun here (by the insert) is committed.
+    d = lookup_maps.get(conn, 'Customer')
+    began = not conn.in_transaction
+    cur = conn.cursor()
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS ReportCustomer (Position INTEGER NOT NULL PRIMARY KEY, CustomerID INTEGER NOT NULL)")
+    try:
+        cur.executemany("INSERT INTO temp.ReportCustomer (Position, CustomerID) VALUES (?, ?)",
+                        [(i, d[name]) for i, name in enumerate(CustomerNames) if name in d])
+        return pd.read_sql_query(sql_statement, conn)
+    finally:
+        cur.execute("DROP TABLE temp.ReportCustomer")
+        if began:
+            conn.commit()
+
+
+def ex1_batch(conn, CustomerNames):
+    # ex1 rows for many customers in one join, grouped by customer in input order
+    return _batch_report(conn, EX1_BATCH_SQL, CustomerNames)
+
+
+def ex2_batch(conn, CustomerNames):
+    # ex2 totals for many customers in one join, one row per known customer in input order
+    return _batch_report(conn, EX2_BATCH_SQL, CustomerNames)
+
+
+### Report bundles
+
+def run_report(conn, name, *args):
+    # DataFrame of report name ('ex1' ... 'ex11'), through report_cache; args follow conn
+    with _instrumented_call('report', name, conn):
+        sql_statement, params = report_sql(conn, name, *args)
+        return report_cache.read_sql_query(sql_statement, conn, params)
+
+
+def enable_wal(normalized_database_filename):
+    # Switches the database to write-ahead logging (persistent), so readers run alongside each
+    # other and alongside a writer. Returns the resulting journal mode.
+    with get_pool(normalized_database_filename).writer() as conn:
+        return conn.execute("PRAGMA journal_mode = WAL").fetchone()[0]
 
 
+def _bundle_key(entry):
+    # 'ex4' -> 'ex4'; ('ex1', ['Maria Anders']) -> ('ex1', ('Maria Anders',))
+    return entry if isinstance(entry, str) else (entry[0], tuple(entry[1]))
+
+
+def _timed_report(conn, key):
+    name, args = (key, ()) if isinstance(key, str) else key
+    start = time.perf_counter()
+    df = run_report(conn, name, *args)
+    return key, df, time.perf_counter() - start
+
+
+def _init_report_worker(normalized_database_filename):
+    global _report_worker_conn
+    _report_worker_conn = create_connection(normalized_database_filename)
+
+
+def _run_bundle_report(key):
+    return _timed_report(_report_worker_conn, key)
+
+
+def run_report_bundle(normalized_database_filename, reports=None, workers=None, processes=False, wal=True):
+    # Inputs: database filename; reports, a list of 'exN' names or (name, args) pairs for the
+    #         reports taking arguments (default: ex3 - ex11)
+    # Optional: workers (default: one per report, at most the CPU count); processes=True runs
+    #           each report in a worker process with its own connection instead of on a thread
+    #           holding a reader of the file's shared pool (so at most its reader count run at
+    #           once); wal=False leaves the journal mode alone
+    # Output: ({key: DataFrame}, {key: seconds}), keyed by report name, or by (name, args tuple)
+    #         for the reports given with arguments
+    if reports is None:
+        reports = ['ex%d' % i for i in range(3, 12)]
+    reports = [_bundle_key(entry) for entry in reports]
+    workers = workers or min(len(reports), os.cpu_count() or 1)
+    if wal:
+        enable_wal(normalized_database_filename)
+    if processes:
+        with multiprocessing.Pool(workers, _init_report_worker, (normalized_database_filename,)) as pool:
+            results = pool.map(_run_bundle_report, reports)
+    else:
+        pool = get_pool(normalized_database_filename)
+
+        def run(key):
+            with pool.reader() as conn:
+                return _timed_report(conn, key)
+
+        with concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix='report') as executor:
+            results = list(executor.map(run, reports))
+    return {key: df for key, df, _ in results}, {key: seconds for key, _, seconds in results}
+
+
+### Streaming reports
+
+_report_mode = threading.local()
+
+
+def _run_report_sql(sql_statement, conn):
+    # What ex3 - ex11 run their statement through; skipped while report_sql only wants the SQL
+    if getattr(_report_mode, 'sql_only', False):
+        return None
+    return report_cache.read_sql_query(sql_statement, conn)
+
+
+def report_sql(conn, name, *args):
+    # (sql_statement, params) that report name ('ex1' ... 'ex11') runs for these args, without
+    # running it
+    if name == 'ex1':
+        return EX1_SQL.format('?'), (lookup_maps.get(conn, 'Customer')[args[0]],)
+    if name == 'ex2':
+        return EX2_SQL.format('?'), (lookup_maps.get(conn, 'Customer').get(args[0]),)
+    _report_mode.sql_only = True
+    try:
+        return globals()[name](conn, *args), ()
+    finally:
+        _report_mode.sql_only = False
+
+
+def iter_report(conn, name, *args, chunksize=10000, frames=True):
+    # Inputs: connection, report name ('ex1' ... 'ex11') and its arguments
+    # Optional: chunksize rows per chunk; frames=False yields lists of row tuples instead of
+    #           DataFrames
+    # Output: iterator over the report's rows in order, at most chunksize at a time, so memory
+    #         stays bounded however large the report is. Results are not cached.
+    sql_statement, params = report_sql(conn, name, *args)
+    if frames:
+        yield from pd.read_sql_query(sql_statement, conn, params=params, chunksize=chunksize)
+        return
+    cur = conn.execute(sql_statement, params)
+    try:
+        for rows in iter(lambda: cur.fetchmany(chunksize), []):
+            yield rows
+    finally:
+        cur.close()
+
+
+### Partitioned aggregation
+
+# Each entry describes one aggregate report: the group-key expressions, the joins they need, the
+# digits its totals are rounded to, and a final query that rebuilds the report's output
+# (rounding, RANK, ordering) from the merged sums. The final query reads table Partial, one row
+# per group with the sum as Amount, loaded in group-key order: the order the grouped rows reach
+# the original ORDER BY.
+QUARTER_KEYS = [
+    "od.CustomerID",
+    "CAST(strftime('%Y', od.OrderDate) AS INTEGER) AS Year",
+    """CASE
+            WHEN CAST(strftime('%m', od.OrderDate) AS INTEGER)<=3 THEN 'Q1'
+            WHEN CAST(strftime('%m', od.OrderDate) AS INTEGER)<=6 THEN 'Q2'
+            WHEN CAST(strftime('%m', od.OrderDate) AS INTEGER)<=9 THEN 'Q3'
+            ELSE 'Q4'
+        END AS Quarter""",
+]
+
+COUNTRY_TABLES_SQL = """OrderDetail od
+    JOIN Product p ON p.ProductID = od.ProductID
+    JOIN Customer c ON c.CustomerID = od.CustomerID
+    JOIN Country co ON c.CountryID = co.CountryID
+    JOIN Region r ON co.RegionID = r.RegionID"""
+
+PARTITIONED_REPORTS = {
+    'ex3': (["od.CustomerID", "c.FirstName || ' ' || c.LastName AS Name"], """OrderDetail od
+    JOIN Customer c ON c.CustomerID = od.CustomerID
+    JOIN Product p ON p.ProductID = od.ProductID""", 2, """
+    SELECT Name, ROUND(Amount, 2) AS Total FROM Partial ORDER BY Total DESC
+    """),
+    'ex4': (["r.Region"], COUNTRY_TABLES_SQL, 2, """
+    SELECT Region, ROUND(Amount, 2) AS Total FROM Partial ORDER BY Total DESC
+    """),
+    'ex5': (["co.Country"], COUNTRY_TABLES_SQL, 0, """
+    SELECT Country, ROUND(Amount) AS CountryTotal FROM Partial ORDER BY CountryTotal DESC
+    """),
+    'ex6': (["r.Region", "co.Country"], COUNTRY_TABLES_SQL, 0, """
+    SELECT Region, Country, ROUND(Amount) AS CountryTotal,
+        RANK() OVER (PARTITION BY Region ORDER BY ROUND(Amount) DESC) AS CountryRegionalRank
+    FROM Partial
+    ORDER BY Region ASC
+    """),
+    'ex7': (["r.Region", "co.Country"], COUNTRY_TABLES_SQL, 0, """
+    WITH tbl AS (
+    SELECT Region, Country, ROUND(Amount) AS CountryTotal,
+           RANK() OVER (PARTITION BY Region ORDER BY Amount DESC) AS CountryRegionalRank
+    FROM Partial
+    )
+    SELECT Region, Country, CountryTotal, CountryRegionalRank
+    FROM tbl
+    WHERE CountryRegionalRank=1
+    ORDER BY Region ASC
+    """),
+    'ex8': (QUARTER_KEYS, "OrderDetail od JOIN Product p ON od.ProductID = p.ProductID", 0, """
+    WITH tbl AS (SELECT CustomerID, Year, Quarter, ROUND(Amount) AS Total FROM Partial)
+    SELECT Quarter, Year, CustomerID, Total
+    FROM tbl
+    GROUP BY Quarter, Year, CustomerID
+    ORDER BY Year
+    """),
+    'ex9': (QUARTER_KEYS, "OrderDetail od JOIN Product p ON od.ProductID = p.ProductID", 0, """
+    WITH tbl AS (SELECT CustomerID, Year, Quarter, ROUND(Amount) AS Total FROM Partial),
+    QuarterYearRank AS (
+        SELECT Quarter, Year, CustomerID, Total, RANK() OVER (PARTITION BY Quarter, Year ORDER BY Total DESC) AS CustomerRank
+        FROM tbl)
+    SELECT Quarter, Year, CustomerID, Total, CustomerRank
+    FROM QuarterYearRank
+    WHERE CustomerRank<=5
+    ORDER BY Year ASC, Quarter ASC, CustomerRank ASC
+    """),
+}
+
+# Per OrderID range: the sum per group, and the individual terms of the given groups
+PARTIAL_SUM_SQL = """
+    SELECT {keys}, SUM(p.ProductUnitPrice * od.QuantityOrdered) AS Amount
+    FROM {tables}
+    WHERE od.OrderID BETWEEN ? AND ?
+    GROUP BY {positions}
+"""
+
+PARTIAL_TERMS_SQL = """
+    SELECT {columns}, Amount FROM (
+        SELECT od.OrderID, {keys}, p.ProductUnitPrice * od.QuantityOrdered AS Amount
+        FROM {tables}
+        WHERE od.OrderID BETWEEN ? AND ?
+    )
+    WHERE ({columns}) IN (SELECT * FROM temp.PartialGroup)
+    ORDER BY OrderID
+"""
+
+
+def _orderid_ranges(conn, partitions):
+    low, high = conn.execute("SELECT MIN(OrderID), MAX(OrderID) FROM OrderDetail").fetchone()
+    if low is None:
+        return [(0, -1)]
+    step = -(-(high - low + 1) // partitions)
+    return [(start, min(start + step - 1, high)) for start in range(low, high + 1, step)]
+
+
+def _run_partial(args):
+    sql_statement, low, high, groups = args
+    conn = _report_worker_conn
+    if groups is None:
+        cur = conn.execute(sql_statement, (low, high))
+        return [d[0] for d in cur.description], cur.fetchall()
+    conn.execute("CREATE TEMP TABLE PartialGroup (%s)" % ", ".join("k%d" % i for i in range(len(groups[0]))))
+    try:
+        conn.executemany("INSERT INTO temp.PartialGroup VALUES (%s)" % ", ".join("?" * len(groups[0])), groups)
+        return None, conn.execute(sql_statement, (low, high)).fetchall()
+    finally:
+        conn.execute("DROP TABLE temp.PartialGroup")
+        conn.commit()
+
+
+def _near_rounding_boundary(amount, digits):
+    # True when amount is close enough to a ROUND() half-way point that a different summation
+    # order could land it on the other side
+    scaled = abs(amount) * 10 ** digits
+    return abs(scaled - math.floor(scaled) - 0.5) <= 1e-9 * max(scaled, 1.0)
+
+
+def partitioned_report(normalized_database_filename, name, workers=None, partitions=None):
+    # Inputs: database filename and a report in PARTITIONED_REPORTS ('ex3' ... 'ex9')
+    # Optional: workers processes (default: CPU count), each with its own read connection;
+    #           partitions, the number of OrderID ranges (default: one per worker)
+    # Output: DataFrame with the report's columns, rounding, ranks and row order
+    # Workers sum their OrderID range per group; the sums are merged in range order. Float
+    # addition is not associative, so a merged sum may differ from SQLite's running sum in its
+    # last bits. Groups whose merged sum is near a rounding half-way point are therefore summed
+    # again term by term in OrderID order, the order SQLite adds them in, so the rounded
+    # totals match the SQL report.
+    keys, tables, digits, final_sql = PARTITIONED_REPORTS[name]
+    workers = workers or os.cpu_count() or 1
+    with get_pool(normalized_database_filename).reader() as conn:
+        ranges = _orderid_ranges(conn, partitions or workers)
+    with multiprocessing.Pool(min(workers, len(ranges)), _init_report_worker, (normalized_database_filename,)) as pool:
+        partial_sql = PARTIAL_SUM_SQL.format(keys=", ".join(keys), tables=tables,
+                                             positions=", ".join(str(i + 1) for i in range(len(keys))))
+        partials = pool.map(_run_partial, [(partial_sql, low, high, None) for low, high in ranges])
+        columns = partials[0][0]
+        merged = {}
+        for _, rows in partials:
+            for row in rows:
+                merged[row[:-1]] = merged.get(row[:-1], 0.0) + row[-1]
+        groups = [key for key, amount in merged.items() if _near_rounding_boundary(amount, digits)]
+        if groups:
+            terms_sql = PARTIAL_TERMS_SQL.format(keys=", ".join(keys), tables=tables, columns=", ".join(columns[:-1]))
+            resummed = dict.fromkeys(groups, 0.0)
+            for _, rows in pool.map(_run_partial, [(terms_sql, low, high, groups) for low, high in ranges]):
+                for row in rows:
+                    resummed[row[:-1]] += row[-1]
+            merged.update(resummed)
+
+    return _final_report(final_sql, columns, merged.items())
+
+
+### Columnar snapshot
+
+# Final queries for the reports the columnar engine serves beyond PARTITIONED_REPORTS
+EX10_FINAL_SQL = """
+    WITH monthly_sales_ranked AS (
+        SELECT Month, Amount AS TotalMonthlySales, RANK() OVER (ORDER BY Amount DESC) AS TotalRank
+        FROM Partial
+    )
+    SELECT Month, TotalMonthlySales AS Total, TotalRank AS TotalRank
+    FROM monthly_sales_ranked
+    ORDER BY TotalRank ASC
+"""
+
+# One row per OrderDetail row in OrderID order; Day counts days since 1970-01-01
+SNAPSHOT_SQL = """
+    SELECT od.OrderID, od.CustomerID, od.ProductID, c.CountryID, co.RegionID,
+           CAST(julianday(od.OrderDate) - 2440587.5 AS INTEGER) AS Day,
+           od.QuantityOrdered, p.ProductUnitPrice
+    FROM OrderDetail od
+    JOIN Product p ON p.ProductID = od.ProductID
+    JOIN Customer c ON c.CustomerID = od.CustomerID
+    JOIN Country co ON co.CountryID = c.CountryID
+    JOIN Region r ON r.RegionID = co.RegionID
+    ORDER BY od.OrderID
+"""
+
+SNAPSHOT_COLUMNS = [
+    ('OrderID', np.int64),
+    ('CustomerID', np.int32),
+    ('ProductID', np.int32),
+    ('CountryID', np.int32),
+    ('RegionID', np.int32),
+    ('Day', np.int32),
+    ('QuantityOrdered', np.int32),
+    ('ProductUnitPrice', np.float64),
+]
+
+# Names by ID (index 0 and gaps hold '')
+SNAPSHOT_LABELS = {
+    'CustomerName': "SELECT CustomerID, FirstName || ' ' || LastName FROM Customer",
+    'Country': "SELECT CountryID, Country FROM Country",
+    'Region': "SELECT RegionID, Region FROM Region",
+}
+
+def _final_report(final_sql, columns, groups):
+    # Runs a report's final query over table Partial holding groups, (key tuple, Amount) pairs,
+    # in key order
+    conn = sqlite3.connect(":memory:")
+    try:
+        conn.execute("CREATE TABLE Partial (%s)" % ", ".join(columns))
+        conn.executemany("INSERT INTO Partial VALUES (%s)" % ", ".join("?" * len(columns)),
+                         [key + (amount,) for key, amount in sorted(groups)])
+        return pd.read_sql_query(final_sql, conn)
+    finally:
+        conn.close()
+
+
+def export_snapshot(normalized_database_filename, directory):
+    # Inputs: database filename and the directory to write the snapshot to
+    # Output: ColumnarSnapshot over the written files
+    # Writes one .npy file per SNAPSHOT_COLUMNS column plus the name arrays of SNAPSHOT_LABELS.
+    # The snapshot is a copy: export again after loading new data.
+    os.makedirs(directory, exist_ok=True)
+    with get_pool(normalized_database_filename).reader() as conn:
+        rows = conn.execute(SNAPSHOT_SQL).fetchall()
+        labels = {name: conn.execute(sql_statement).fetchall() for name, sql_statement in SNAPSHOT_LABELS.items()}
+    values = list(zip(*rows)) or [()] * len(SNAPSHOT_COLUMNS)
+    for (column, dtype), data in zip(SNAPSHOT_COLUMNS, values):
+        np.save(os.path.join(directory, column + '.npy'), np.array(data, dtype=dtype))
+    for name, pairs in labels.items():
+        names = np.full(max((i for i, _ in pairs), default=0) + 1, '', dtype=object)
+        for i, label in pairs:
+            names[i] = label
+        np.save(os.path.join(directory, name + '.npy'), names.astype(str))
+    return ColumnarSnapshot(directory)
+
+
+class ColumnarSnapshot:
+    # OrderDetail joined with the product price and the customer's country and region, held as
+    # NumPy arrays (memory-mapped .npy files by default; see export_snapshot). report(name)
+    # computes ex3 - ex10 with np.bincount and returns the same DataFrame as the SQL report:
+    # bincount adds each group's float64 terms in array order, which is OrderID order, the
+    # order SQLite's SUM adds them in, and the final rounding, RANK and ordering run as SQL.
+
+    def __init__(self, directory, mmap=True):
+        mmap_mode = 'r' if mmap else None
+        for column, _ in SNAPSHOT_COLUMNS:
+            setattr(self, column, np.load(os.path.join(directory, column + '.npy'), mmap_mode=mmap_mode))
+        self.labels = {name: np.load(os.path.join(directory, name + '.npy')) for name in SNAPSHOT_LABELS}
+        self.Amount = self.ProductUnitPrice * self.QuantityOrdered
+        dates = self.Day.astype('datetime64[D]')
+        self.Year = dates.astype('datetime64[Y]').astype(np.int64) + 1970
+        self.Month = dates.astype('datetime64[M]').astype(np.int64) % 12
+
+    def __len__(self):
+        return len(self.OrderID)
+
+    def _sum_by(self, ids, weights=None):
+        # {id: sum of weights} for the ids that occur, summed in array order
+        weights = self.Amount if weights is None else weights
+        counts = np.bincount(ids)
+        sums = np.bincount(ids, weights=weights, minlength=len(counts))
+        present = np.flatnonzero(counts)
+        return zip(present.tolist(), sums[present].tolist())
+
+    def groups(self, name):
+        # (columns, [(key tuple, Amount)]) at the grain of the report's GROUP BY
+        customer, country, region = self.labels['CustomerName'], self.labels['Country'], self.labels['Region']
+        if name == 'ex3':
+            return ['CustomerID', 'Name', 'Amount'], [((i, str(customer[i])), s) for i, s in self._sum_by(self.CustomerID)]
+        if name == 'ex4':
+            return ['Region', 'Amount'], [((str(region[i]),), s) for i, s in self._sum_by(self.RegionID)]
+        if name == 'ex5':
+            return ['Country', 'Amount'], [((str(country[i]),), s) for i, s in self._sum_by(self.CountryID)]
+        if name in ('ex6', 'ex7'):
+            country_region = np.zeros(len(country), dtype=np.int64)
+            country_region[self.CountryID] = self.RegionID
+            return ['Region', 'Country', 'Amount'], [((str(region[country_region[i]]), str(country[i])), s)
+                                                     for i, s in self._sum_by(self.CountryID)]
+        if name in ('ex8', 'ex9'):
+            first_year = int(self.Year.min()) if len(self) else 0
+            years = int(self.Year.max()) - first_year + 1 if len(self) else 1
+            ids = (self.CustomerID.astype(np.int64) * years + (self.Year - first_year)) * 4 + self.Month // 3
+            return ['CustomerID', 'Year', 'Quarter', 'Amount'], [
+                ((i // 4 // years, first_year + i // 4 % years, 'Q%d' % (i % 4 + 1)), s) for i, s in self._sum_by(ids)]
+        if name == 'ex10':
+            # SQLite's ROUND(x) for each item: x + 0.5 truncated toward zero, sign kept
+            rounded = np.copysign(np.trunc(np.abs(self.Amount) + 0.5), self.Amount)
+            return ['Month', 'Amount'], [((MONTH_NAMES[i],), s) for i, s in self._sum_by(self.Month, rounded)]
+        raise KeyError(name)
+
+    def report(self, name):
+        columns, groups = self.groups(name)
+        final_sql = EX10_FINAL_SQL if name == 'ex10' else PARTITIONED_REPORTS[name][3]
+        return _final_report(final_sql, columns, groups)
+
+
+### Query plans
+#
+# EXPLAIN QUERY PLAN of every report, normalized to indented detail lines: subquery numbers are
+# dropped and pre-3.36 "SCAN TABLE x AS y" / "SEARCH TABLE x" wording is folded into "SCAN y" /
+# "SEARCH x", so snapshots compare across runs and SQLite versions. plan_issues() picks out the
+# lines worth watching: scans of tables (not of the query's own CTEs, views materialized by the
+# plan or subqueries) and temp B-trees for sorting or grouping. plan_regressions() reports the
+# issues a plan has that its snapshot did not.
+
+REPORT_NAMES = ['ex%d' % i for i in range(1, 12)]
+
+
+def _plan_sql(conn, name):
+    if name == 'ex1':
+        return EX1_SQL.format('?'), (None,)
+    if name == 'ex2':
+        return EX2_SQL.format('?'), (None,)
+    return report_sql(conn, name)
+
+
+def explain_report(conn, name):
+    sql_statement, params = _plan_sql(conn, name)
+    # EXPLAIN never notices schema changes, so a statement cached by sqlite3 would keep
+    # describing dropped indexes; the schema version in the text makes each schema its own entry
+    schema_version = conn.execute("PRAGMA schema_version").fetchone()[0]
+    explain = "EXPLAIN QUERY PLAN /* schema %d */ %s" % (schema_version, sql_statement)
+    depth = {0: -1}
+    plan = []
+    for node, parent, _, detail in conn.execute(explain, params):
+        depth[node] = depth.get(parent, -1) + 1
+        detail = re.sub(r"^(SCAN|SEARCH) TABLE (?:\S+ AS )?", r"\1 ", detail)
+        detail = re.sub(r"\(subquery-\d+\)|\b(SUBQUERY) \d+", lambda m: m.group(1) or '(subquery)', detail)
+        plan.append('  ' * depth[node] + detail)
+    return plan
+
+
+def query_plans(conn, reports=None):
+    return {name: explain_report(conn, name) for name in reports or REPORT_NAMES}
+
+
+def plan_issues(plan):
+    own = {m.group(2) for m in (re.match(r"(CO-ROUTINE|MATERIALIZE) (\S+)$", line.strip()) for line in plan) if m}
+    issues = []
+    for line in plan:
+        line = line.strip()
+        scan = re.match(r"SCAN (\S+)", line)
+        if scan and scan.group(1) not in own and scan.group(1) not in ('(subquery)', 'CONSTANT'):
+            issues.append(line)
+        elif line.startswith("USE TEMP B-TREE"):
+            issues.append(line)
+    return issues
+
+
+def plan_regressions(baseline, plans):
+    # Inputs: {report: plan} snapshot and current plans
+    # Output: {report: issue lines not in the snapshot plan}, only for reports that have any
+    regressions = {}
+    for name, plan in plans.items():
+        new = collections.Counter(plan_issues(plan)) - collections.Counter(plan_issues(baseline.get(name, [])))
+        if new:
+            regressions[name] = sorted(new.elements())
+    return regressions
+
+
+def save_query_plans(conn, filename, reports=None):
+    with open(filename, 'w') as f:
+        json.dump({'sqlite_version': sqlite3.sqlite_version, 'plans': query_plans(conn, reports)}, f, indent=2)
+        f.write("\n")
+
+
+def check_query_plans(conn, filename, reports=None):
+    # plan_regressions of the current plans against a save_query_plans snapshot
+    with open(filename) as f:
+        baseline = json.load(f)['plans']
+    return plan_regressions(baseline, query_plans(conn, reports or list(baseline)))
+
+### Async reports
+
+class AsyncReports:
+    # asyncio facade over a ConnectionPool's readers, e.g. `await reports.ex4()` or
+    # `await reports.ex1('Maria Anders')`, returning the report DataFrame. Each call runs on a
+    # worker thread holding one pool reader with query_only set, so the event loop never blocks
+    # on SQLite. max_concurrency (default: the pool's reader count) caps the queries in flight;
+    # further calls queue. timeout bounds queueing plus execution: on expiry the running
+    # statement is interrupted and asyncio.TimeoutError is raised. db may be a ConnectionPool or
+    # a database filename (its shared pool).
+
+    def __init__(self, db, max_concurrency=None, timeout=None):
+        self.pool = db if isinstance(db, ConnectionPool) else get_pool(db)
+        self.timeout = timeout
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_concurrency or self.pool.readers, thread_name_prefix='report')
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _run(self, work, timeout=None, deadline=True):
+        # Runs work(conn) on a read-only pool reader in a worker thread; deadline=False runs it
+        # without a time limit (the caller cancels it instead)
+        timeout = None if not deadline else self.timeout if timeout is None else timeout
+        state = {'conn': None, 'cancelled': False}
+
+        def call():
+            with self.pool.reader() as conn:
+                state['conn'] = conn
+                conn.execute("PRAGMA query_only = 1")
+                # interrupt() is lost on a connection between statements, so a progress handler
+                # also aborts once cancelled (forwarding to an instrumentation tracer's handler)
+                tracer = _tracers.get(id(conn))
+                progress_ops = tracer.progress_ops if tracer is not None else 1000
+                conn.set_progress_handler(
+                    lambda: 1 if state['cancelled'] else tracer._progress() if tracer is not None else 0, progress_ops)
+                try:
+                    if state['cancelled']:
+                        raise sqlite3.OperationalError("interrupted")
+                    return work(conn)
+                finally:
+                    state['conn'] = None
+                    conn.set_progress_handler(tracer._progress if tracer is not None else None, progress_ops)
+                    conn.execute("PRAGMA query_only = 0")
+
+        future = asyncio.get_running_loop().run_in_executor(self._executor, call)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            state['cancelled'] = True
+            conn = state['conn']
+            if conn is not None:
+                conn.interrupt()
+            raise
+
+    async def query(self, sql_statement, params=None, timeout=None):
+        return await self._run(lambda conn: report_cache.read_sql_query(sql_statement, conn, params), timeout)
+
+    async def report(self, name, *args, timeout=None):
+        # name is 'ex1' ... 'ex11'; args follow the conn argument of that function
+        return await self._run(lambda conn: run_report(conn, name, *args), timeout)
+
+    def __getattr__(self, name):
+        if re.fullmatch(r'ex\d+', name) and name in globals():
+            return functools.partial(self.report, name)
+        raise AttributeError(name)
+
+    async def stream(self, sql_statement, params=None, chunk_size=1000, timeout=None):
+        # Async generator of DataFrame chunks of at most chunk_size rows. The worker thread stays
+        # at most two chunks ahead of the consumer; timeout bounds the wait for each chunk, not
+        # the whole query, so a slow consumer can read any number of chunks. Leaving the loop
+        # early interrupts the query and returns the connection.
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue(maxsize=2)
+        stop = threading.Event()
+
+        def put(item):
+            asyncio.run_coroutine_threadsafe(chunks.put(item), loop).result()
+
+        def work(conn):
+            # Nothing is queued once the consumer has stopped listening
+            try:
+                cur = conn.execute(sql_statement, params or ())
+                columns = [d[0] for d in cur.description]
+                for rows in iter(lambda: cur.fetchmany(chunk_size), []):
+                    if stop.is_set():
+                        return
+                    put(pd.DataFrame.from_records(rows, columns=columns))
+            except Exception as e:
+                if not stop.is_set():
+                    put(e)
+                return
+            if not stop.is_set():
+                put(None)
+
+        task = asyncio.ensure_future(self._run(work, deadline=False))
+        try:
+            while True:
+                chunk = await asyncio.wait_for(chunks.get(), self.timeout if timeout is None else timeout)
+                if chunk is None:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            stop.set()
+            while not chunks.empty():
+                chunks.get_nowait()
+            if not task.done():
+                task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+
+@_instrumented('report')
 def ex1(conn, CustomerName):
     
     # Simply, you are fetching all the rows for a given CustomerName. 
@@ -403,26 +2617,14 @@ def ex1(conn, CustomerName):
     # HINT: USE customer_to_customerid_dict to map customer name to customer id and then use where clause with CustomerID
     
     ### BEGIN SOLUTION
-    d=step6_create_customer_to_customerid_dictionary('normalized.db')
-    sql_statement = """
-    SELECT 
-        C.FirstName || ' ' || C.LastName AS Name,
-        P.ProductName,
-        OD.OrderDate,
-        P.ProductUnitPrice,
-        OD.QuantityOrdered,
-        ROUND(P.ProductUnitPrice * OD.QuantityOrdered, 2) AS Total
-    FROM 
-        OrderDetail OD
-        JOIN Customer C ON C.CustomerID = OD.CustomerID
-        JOIN Product P ON P.ProductID = OD.ProductID
-    WHERE 
-        C.CustomerID = {}
-    """.format(d[CustomerName])
+    d=lookup_maps.get(conn, 'Customer')
+    customer_id=d[CustomerName]
+    sql_statement = EX1_SQL.format(customer_id)
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
+    df = report_cache.read_sql_query(EX1_SQL.format('?'), conn, params=(customer_id,))
     return sql_statement
 
+@_instrumented('report')
 def ex2(conn, CustomerName):
     
     # Simply, you are summing the total for a given CustomerName. 
@@ -433,20 +2635,14 @@ def ex2(conn, CustomerName):
     # HINT: USE customer_to_customerid_dict to map customer name to customer id and then use where clause with CustomerID
     
     ### BEGIN SOLUTION
-    d=step6_create_customer_to_customerid_dictionary('normalized.db')
+    d=lookup_maps.get(conn, 'Customer')
     customer_id=d.get(CustomerName)
-    sql_statement = """
-    SELECT c.FirstName || ' ' || c.LastName AS Name, ROUND(SUM(p.ProductUnitPrice * od.QuantityOrdered), 2) AS Total
-        FROM OrderDetail od
-        JOIN Customer c ON c.CustomerID = od.CustomerID
-        JOIN Product p ON p.ProductID = od.ProductID
-        WHERE c.CustomerID = {}
-        GROUP BY Name
-    """.format(customer_id)
+    sql_statement = EX2_SQL.format(customer_id)
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
+    df = report_cache.read_sql_query(EX2_SQL.format('?'), conn, params=(customer_id,))
     return sql_statement
 
+@_instrumented('report')
 def ex3(conn):
     
     # Simply, find the total for all the customers
@@ -464,10 +2660,13 @@ def ex3(conn):
         GROUP BY od.CustomerID
         ORDER BY Total DESC
     """
+    if has_summary_tables(conn):
+        sql_statement = EX3_SUMMARY_SQL
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
+    df = _run_report_sql(sql_statement, conn)
     return sql_statement
 
+@_instrumented('report')
 def ex4(conn):
     
     # Simply, find the total for all the region
@@ -489,10 +2688,13 @@ def ex4(conn):
     GROUP BY r.Region
     ORDER BY Total DESC
     """
+    if has_summary_tables(conn):
+        sql_statement = EX4_SUMMARY_SQL
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
+    df = _run_report_sql(sql_statement, conn)
     return sql_statement
 
+@_instrumented('report')
 def ex5(conn):
     
      # Simply, find the total for all the countries
@@ -512,11 +2714,14 @@ def ex5(conn):
     GROUP BY co.Country
     ORDER BY CountryTotal DESC;
     """
+    if has_summary_tables(conn):
+        sql_statement = EX5_SUMMARY_SQL
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
+    df = _run_report_sql(sql_statement, conn)
     return sql_statement
 
 
+@_instrumented('report')
 def ex6(conn):
     
     # Rank the countries within a region based on order total
@@ -544,12 +2749,15 @@ def ex6(conn):
     FROM CountryTotal
     ORDER BY CountryTotal.Region ASC;
     """
+    if has_summary_tables(conn):
+        sql_statement = EX6_SUMMARY_SQL
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
+    df = _run_report_sql(sql_statement, conn)
     return sql_statement
 
 
 
+@_instrumented('report')
 def ex7(conn):
     
    # Rank the countries within a region based on order total, BUT only select the TOP country, meaning rank = 1!
@@ -576,9 +2784,10 @@ def ex7(conn):
     ORDER BY Region ASC;
     """
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
+    df = _run_report_sql(sql_statement, conn)
     return sql_statement
 
+@_instrumented('report')
 def ex8(conn):
     
     # Sum customer sales by Quarter and year
@@ -609,10 +2818,15 @@ def ex8(conn):
 	GROUP BY Quarter, Year, CustomerID
     ORDER BY  Year
     """
+    if has_date_dimension(conn):
+        sql_statement = EX8_DATE_SQL
+    if has_compact_storage(conn):
+        sql_statement = EX8_COMPACT_SQL
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
+    df = _run_report_sql(sql_statement, conn)
     return sql_statement
 
+@_instrumented('report')
 def ex9(conn):
     
     # Rank the customer sales by Quarter and year, but only select the top 5 customers!
@@ -647,10 +2861,15 @@ def ex9(conn):
     WHERE CustomerRank<=5
     ORDER BY Year ASC, Quarter ASC, CustomerRank ASC;
     """
+    if has_date_dimension(conn):
+        sql_statement = EX9_DATE_SQL
+    if has_compact_storage(conn):
+        sql_statement = EX9_COMPACT_SQL
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
+    df = _run_report_sql(sql_statement, conn)
     return sql_statement
 
+@_instrumented('report')
 def ex10(conn):
     
     # Rank the monthly sales
@@ -689,10 +2908,15 @@ def ex10(conn):
     FROM monthly_sales_ranked
     ORDER BY TotalRank ASC
     """
+    if has_date_dimension(conn):
+        sql_statement = EX10_DATE_SQL
+    if has_compact_storage(conn):
+        sql_statement = EX10_COMPACT_SQL
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
+    df = _run_report_sql(sql_statement, conn)
     return sql_statement
 
+@_instrumented('report')
 def ex11(conn):
     
     # Find the MaxDaysWithoutOrder for each customer 
@@ -710,36 +2934,40 @@ def ex11(conn):
 
     ### BEGIN SOLUTION
 
+    # One ordered pass: lag() over each customer's rows in OrderDate order gives every gap, and
+    # the GROUP BY keeps the row with the largest gap, earliest OrderDate first on ties (MAX of
+    # Gap * 10^7 - julian day; bare columns come from the row holding the MAX). A customer
+    # whose rows all share one date has only zero gaps and, as before, one output row per gap
+    # (Ties); copies repeats those rows.
     sql_statement = """
-    WITH tbl AS  
-        (
-            SELECT b.CustomerID,b.FirstName,b.LastName,c.Country,a.OrderDate,lag(a.OrderDate) OVER(PARTITION BY a.CustomerID ORDER BY a.OrderDate) AS PreviousOrderDate
-            FROM OrderDetail a 
-            JOIN Customer b ON a.CustomerID=b.CustomerID 
-            JOIN Country c ON b.CountryID=c.CountryID
-        ),
-    tbl2 AS
+    WITH longest AS
         (
-            SELECT *,(julianday(OrderDate) - julianday(PreviousOrderDate)) AS MaxDaysWithoutOrder
-            FROM tbl WHERE PreviousOrderDate IS NOT NULL
+            SELECT CustomerID, OrderDate, PreviousOrderDate, Gap, MAX(Gap * 10000000 - Day) AS GapKey, COUNT(*) AS Ties
+            FROM (
+                SELECT CustomerID, OrderDate, Day, lag(OrderDate) OVER w AS PreviousOrderDate, Day - lag(Day) OVER w AS Gap
+                FROM (SELECT CustomerID, OrderDate, julianday(OrderDate) AS Day FROM OrderDetail)
+                WINDOW w AS (PARTITION BY CustomerID ORDER BY OrderDate)
+            )
+            WHERE Gap IS NOT NULL
+            GROUP BY CustomerID
         ),
-    max_days_without_order AS
+    copies AS
         (
-            SELECT CustomerID,MAX(MaxDaysWithoutOrder) AS MaxDaysWithoutOrder
-            FROM tbl2
-            GROUP BY CustomerID
+            SELECT 1 AS Copy
+            UNION ALL
+            SELECT Copy + 1 FROM copies WHERE Copy < (SELECT MAX(Ties) FROM longest WHERE Gap = 0)
         )
-    SELECT tbl2.CustomerID,tbl2.FirstName,tbl2.LastName,tbl2.Country,tbl2.OrderDate, tbl2.PreviousOrderDate,tbl2.MaxDaysWithoutOrder AS MaxDaysWithoutOrder
-    FROM tbl2
-        JOIN max_days_without_order ON tbl2.CustomerID = max_days_without_order.CustomerID
-            AND tbl2.MaxDaysWithoutOrder = max_days_without_order.MaxDaysWithoutOrder
-            AND tbl2.OrderDate = (SELECT MIN(OrderDate) FROM tbl2 t WHERE t.CustomerID = tbl2.CustomerID AND t.MaxDaysWithoutOrder = max_days_without_order.MaxDaysWithoutOrder)
-    ORDER BY 
-        tbl2.MaxDaysWithoutOrder DESC,
-        tbl2.CustomerID DESC;
-
-
+    SELECT l.CustomerID, c.FirstName, c.LastName, co.Country, l.OrderDate, l.PreviousOrderDate, l.Gap AS MaxDaysWithoutOrder
+    FROM longest l
+        JOIN Customer c ON c.CustomerID = l.CustomerID
+        JOIN Country co ON co.CountryID = c.CountryID
+        JOIN copies ON copies.Copy <= CASE WHEN l.Gap = 0 THEN l.Ties ELSE 1 END
+    ORDER BY
+        MaxDaysWithoutOrder DESC,
+        l.CustomerID DESC
     """
+    if has_compact_storage(conn):
+        sql_statement = EX11_COMPACT_SQL
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
+    df = _run_report_sql(sql_statement, conn)
     return sql_statement
\ No newline at end of file
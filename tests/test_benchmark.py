@@ -0,0 +1,48 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import benchmark
+from tests.test_ingest import LINES, write_data_file
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_percentile(self):
+        samples = [0.5, 0.1, 0.4, 0.2, 0.3]
+        assert benchmark.percentile(samples, 50) == 0.3
+        assert benchmark.percentile(samples, 95) == 0.5
+        assert benchmark.percentile([0.7], 95) == 0.7
+
+    def test_scale_data(self):
+        data_filename = write_data_file(self.directory)
+        scaled_filename = benchmark.scale_data(data_filename, 3, self.directory)
+        with open(scaled_filename) as f:
+            lines = f.read().splitlines()
+        assert len(lines) == 1 + 3 * len(LINES)
+        assert lines[1 + len(LINES)].startswith("Maria Anders 1\t")
+        assert len({line.split('\t')[0] for line in lines[1:]}) == 3 * len(LINES)
+
+    def test_run_and_compare(self):
+        data_filename = write_data_file(self.directory)
+        output = os.path.join(self.directory, 'bench.json')
+        args = ['--data', data_filename, '--warmup', '0', '--repeat', '2', '--only', 'step11,ex3', '--output', output]
+        assert benchmark.main(args) == 0
+        with open(output) as f:
+            results = json.load(f)['results']
+        assert [(r['name'], r['scale'], r['repeat']) for r in results] == [('step11', 1, 2), ('ex3', 1, 2)]
+        assert results[0]['rows'] == 15 and results[0]['p50'] <= results[0]['p95']
+        assert benchmark.compare(results, output, 0.1) == 0
+        slower = [dict(r, p50=r['p50'] * 2) for r in results]
+        assert benchmark.compare(slower, output, 0.1) == 2
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import generate_data
+import mini_project2
+from tests.test_ingest import HEADER
+
+
+class TestGenerateData(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def generate(self, **kwargs):
+        out = io.StringIO()
+        written = generate_data.generate(out, **kwargs)
+        return written, out.getvalue()
+
+    def test_deterministic(self):
+        assert self.generate(customers=50, seed=3) == self.generate(customers=50, seed=3)
+        assert self.generate(customers=50, seed=3)[1] != self.generate(customers=50, seed=4)[1]
+
+    def test_format(self):
+        written, content = self.generate(customers=200, products=900, countries=30, regions=12, seed=1)
+        lines = content.splitlines()
+        assert lines[0] == HEADER and len(lines) == 201
+        products, countries, names = {}, {}, set()
+        for line in lines[1:]:
+            fields = line.split('\t')
+            assert len(fields) == 11
+            details = [field.split(';') for field in fields[5:]]
+            assert len({len(column) for column in details}) == 1
+            for product in zip(*details[:4]):
+                assert products.setdefault(product[0], product) == product
+            assert countries.setdefault(fields[3], fields[4]) == fields[4]
+            names.add(fields[0])
+            written -= len(details[0])
+        assert written == 0 and len(names) == 200
+        assert generate_data.customer_name(28 * 32) == 'Maria Anders 2'
+
+    def test_ingest(self):
+        data_filename = os.path.join(self.directory, 'data.csv')
+        with open(data_filename, 'w') as f:
+            written = generate_data.generate(f, customers=100, orders_per_customer=3, seed=2)
+        normalized_database_filename = os.path.join(self.directory, 'normalized.db')
+        mini_project2.ingest_data(data_filename, normalized_database_filename)
+        conn = mini_project2.create_connection(normalized_database_filename)
+        assert conn.execute("SELECT count(*) FROM OrderDetail").fetchone()[0] == written
+        assert conn.execute("SELECT count(*) FROM Customer").fetchone()[0] == 100
+        conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
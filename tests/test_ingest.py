@@ -0,0 +1,360 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+import pandas as pd
+import mini_project2
+
+HEADER = "Name\tAddress\tCity\tCountry\tRegion\tProductName\tProductCategory\tProductCategoryDescription\tProductUnitPrice\tQuantityOrderded\tOrderDate"
+LINES = [
+    "Maria Anders\tObere Str. 57\tBerlin\tGermany\tWestern Europe\tChai;Ikura;Tofu;Chai\tBeverages;Seafood;Produce;Beverages\tSoft drinks;Fish;Dried fruit;Soft drinks\t18.0;31.0;23.25;18.0\t3;10;1;4\t20120814;20120814;20130102;20140620",
+    "Ana Trujillo\tAvda. 2222\tMexico D.F.\tMexico\tCentral America\tTofu;Konbu\tProduce;Seafood\tDried fruit;Fish\t23.25;6.0\t2;7\t20121105;20150301",
+    "Jose Pedro Freyre\tC/ Romero 33\tSevilla\tSpain\tSouthern Europe\tIkura;Chai;Konbu;Pavlova\tSeafood;Beverages;Seafood;Confections\tFish;Soft drinks;Fish;Sweets\t31.0;18.0;6.0;17.45\t5;1;12;6\t20120101;20120911;20120911;20161224",
+    "Thomas Hardy\t120 Hanover Sq.\tLondon\tUK\tBritish Isles\tPavlova;Tofu\tConfections;Produce\tSweets;Dried fruit\t17.45;23.25\t9;2\t20130707;20130708",
+    "Yang Wang\tHauptstr. 29\tBern\tSwitzerland\tWestern Europe\tChai;Chai;Ikura\tBeverages;Beverages;Seafood\tSoft drinks;Soft drinks;Fish\t18.0;18.0;31.0\t1;2;3\t20140228;20140301;20141231",
+]
+TABLE_NAMES = ['Region', 'Country', 'Customer', 'ProductCategory', 'Product', 'OrderDetail']
+
+
+def write_data_file(directory, lines=LINES, filename='data.csv'):
+    data_filename = os.path.join(directory, filename)
+    with open(data_filename, 'w') as f:
+        f.write(HEADER + "\n" + "\n".join(lines) + "\n")
+    return data_filename
+
+
+def run_steps(data_filename, normalized_database_filename):
+    mini_project2.step1_create_region_table(data_filename, normalized_database_filename)
+    mini_project2.step3_create_country_table(data_filename, normalized_database_filename)
+    mini_project2.step5_create_customer_table(data_filename, normalized_database_filename)
+    mini_project2.step7_create_productcategory_table(data_filename, normalized_database_filename)
+    mini_project2.step9_create_product_table(data_filename, normalized_database_filename)
+    mini_project2.step11_create_orderdetail_table(data_filename, normalized_database_filename)
+
+
+def read_tables(normalized_database_filename):
+    conn = sqlite3.connect(normalized_database_filename)
+    tables = {t: pd.read_sql_query("SELECT * FROM %s" % t, conn) for t in TABLE_NAMES}
+    conn.close()
+    return tables
+
+
+class TestIngest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.data_filename = write_data_file(cls.directory)
+        cls.steps_db = os.path.join(cls.directory, 'steps.db')
+        run_steps(cls.data_filename, cls.steps_db)
+        cls.expected = read_tables(cls.steps_db)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def assert_tables_match(self, normalized_database_filename):
+        tables = read_tables(normalized_database_filename)
+        for t in TABLE_NAMES:
+            assert tables[t].equals(self.expected[t]), t
+
+    def test_ingest_data_matches_steps(self):
+        normalized_database_filename = os.path.join(self.directory, 'ingest.db')
+        mini_project2.ingest_data(self.data_filename, normalized_database_filename)
+        self.assert_tables_match(normalized_database_filename)
+        assert len(self.expected['OrderDetail']) == 15
+
+    def test_ingest_data_reload(self):
+        normalized_database_filename = os.path.join(self.directory, 'reload.db')
+        mini_project2.ingest_data(self.data_filename, normalized_database_filename)
+        mini_project2.ingest_data(self.data_filename, normalized_database_filename)
+        self.assert_tables_match(normalized_database_filename)
+
+    def test_ingest_data_parallel(self):
+        normalized_database_filename = os.path.join(self.directory, 'parallel.db')
+        mini_project2.ingest_data(self.data_filename, normalized_database_filename, workers=2)
+        self.assert_tables_match(normalized_database_filename)
+
+    def test_ingest_data_streaming(self):
+        normalized_database_filename = os.path.join(self.directory, 'streaming.db')
+        with mini_project2.instrument(sql=False) as metrics:
+            mini_project2.ingest_data(self.data_filename, normalized_database_filename,
+                                      batch_size=4, commit_interval=8)
+        self.assert_tables_match(normalized_database_filename)
+        # the order lists come from a second pass over the file, not from the first one
+        assert metrics.records[-1]['rows_parsed'] == 10
+
+    def test_step11_parallel(self):
+        normalized_database_filename = os.path.join(self.directory, 'step11_parallel.db')
+        shutil.copy(self.steps_db, normalized_database_filename)
+        mini_project2.step11_create_orderdetail_table(self.data_filename, normalized_database_filename, workers=3)
+        self.assert_tables_match(normalized_database_filename)
+
+    def test_step11_streaming(self):
+        normalized_database_filename = os.path.join(self.directory, 'step11_streaming.db')
+        shutil.copy(self.steps_db, normalized_database_filename)
+        mini_project2.step11_create_orderdetail_table(self.data_filename, normalized_database_filename,
+                                                      batch_size=4, commit_interval=8)
+        self.assert_tables_match(normalized_database_filename)
+
+    def test_insert_order_details_commits_batches(self):
+        conn = sqlite3.connect(":memory:")
+        for _, create_table_sql in mini_project2.TABLES:
+            conn.execute(create_table_sql)
+        conn.execute("INSERT INTO Region VALUES (1, 'Central America')")
+        conn.execute("INSERT INTO Country VALUES (1, 'Mexico', 1)")
+        conn.execute("INSERT INTO ProductCategory VALUES (1, 'Beverages', 'Soft drinks')")
+        conn.execute("INSERT INTO Customer VALUES (1, 'Ana', 'Trujillo', 'Avda. 2222', 'Mexico D.F.', 1)")
+        conn.execute("INSERT INTO Product VALUES (1, 'Chai', 18.0, 1)")
+        conn.commit()
+        commits = []
+        conn.set_trace_callback(lambda sql: commits.append(sql) if sql == "COMMIT" else None)
+        rows = ((None, 1, 1, '2012-01-01', q) for q in range(10))
+        mini_project2._insert_order_details(conn, rows, batch_size=3, commit_interval=6)
+        assert conn.execute("SELECT count(*) FROM OrderDetail").fetchone()[0] == 10
+        # the last rows are left to the caller's commit
+        assert len(commits) == 1 and conn.in_transaction
+
+    def test_step11_dangling_product_rolled_back(self):
+        products = mini_project2.step10_create_product_to_productid_dictionary(self.steps_db)
+        dangling = {name: i + 100 for name, i in products.items()}
+        for i, kwargs in enumerate([{}, {'batch_size': 4, 'commit_interval': 8}]):
+            normalized_database_filename = os.path.join(self.directory, 'step11_dangling%d.db' % i)
+            shutil.copy(self.steps_db, normalized_database_filename)
+            with mock.patch.object(mini_project2, 'step10_create_product_to_productid_dictionary', return_value=dangling):
+                with self.assertRaises(mini_project2.ForeignKeyCheckError):
+                    mini_project2.step11_create_orderdetail_table(self.data_filename, normalized_database_filename, **kwargs)
+            conn = sqlite3.connect(normalized_database_filename)
+            assert conn.execute("SELECT count(*) FROM OrderDetail").fetchone()[0] == 0, kwargs
+            conn.close()
+
+    def test_data_byte_ranges(self):
+        ranges = mini_project2._data_byte_ranges(self.data_filename, 4)
+        with open(self.data_filename, 'rb') as f:
+            content = f.read()
+        assert ranges[0][0] == 0 and ranges[-1][1] == len(content)
+        for (_, end), (start, _) in zip(ranges, ranges[1:]):
+            assert end == start and content[start - 1:start] == b"\n"
+
+
+class TestAppendData(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.normalized_database_filename = os.path.join(self.directory, 'append.db')
+        self.week1 = write_data_file(self.directory, LINES[:3], 'week1.csv')
+        self.week2 = write_data_file(self.directory, LINES[:3] + [
+            "Liz Nixon\t89 Jefferson Way\tPortland\tUSA\tNorth America\tChai;Zaanse koeken\tBeverages;Confections\tSoft drinks;Sweets\t18.0;9.5\t4;2\t20170105;20170106",
+        ], 'week2.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_append_into_empty_database_matches_ingest(self):
+        ingest_db = os.path.join(self.directory, 'ingest.db')
+        mini_project2.ingest_data(self.week1, ingest_db)
+        assert mini_project2.append_data(self.week1, self.normalized_database_filename) == 10
+        expected = read_tables(ingest_db)
+        tables = read_tables(self.normalized_database_filename)
+        for t in TABLE_NAMES:
+            assert tables[t].equals(expected[t]), t
+
+    def test_append_keeps_ids_and_skips_loaded_rows(self):
+        mini_project2.ingest_data(self.week1, self.normalized_database_filename)
+        before = read_tables(self.normalized_database_filename)
+        assert mini_project2.append_data(self.week2, self.normalized_database_filename) == 2
+        after = read_tables(self.normalized_database_filename)
+        for t in TABLE_NAMES:
+            assert after[t].iloc[:len(before[t])].equals(before[t]), t
+        assert after['Region'].iloc[-1].tolist() == [4, 'North America']
+        assert after['Customer'].iloc[-1].tolist() == [4, 'Liz', 'Nixon', '89 Jefferson Way', 'Portland', 4]
+        assert after['OrderDetail'].iloc[-1].tolist() == [12, 4, 6, '2017-01-06', 2]
+        assert mini_project2.append_data(self.week2, self.normalized_database_filename) == 0
+        assert len(read_tables(self.normalized_database_filename)['OrderDetail']) == 12
+
+    def test_append_late_and_same_day_rows(self):
+        mini_project2.ingest_data(self.week1, self.normalized_database_filename)
+        late = write_data_file(self.directory, [
+            # One repeat of a loaded row and a second identical item, a same-day item and an older one
+            "Maria Anders\tObere Str. 57\tBerlin\tGermany\tWestern Europe\tChai;Chai;Konbu;Tofu\tBeverages;Beverages;Seafood;Produce"
+            "\tSoft drinks;Soft drinks;Fish;Dried fruit\t18.0;18.0;6.0;23.25\t3;3;5;8\t20120814;20120814;20161224;20110301",
+        ], 'late.csv')
+        assert mini_project2.append_data(late, self.normalized_database_filename) == 3
+        after = read_tables(self.normalized_database_filename)['OrderDetail']
+        assert after.iloc[10:].values.tolist() == [[11, 3, 1, '2012-08-14', 3], [12, 3, 3, '2016-12-24', 5], [13, 3, 5, '2011-03-01', 8]]
+        conn = sqlite3.connect(self.normalized_database_filename)
+        assert conn.execute("SELECT RowsAppended, RowsSkipped FROM LoadWatermark").fetchall() == [(3, 1)]
+        conn.close()
+
+    def test_failed_append_writes_nothing(self):
+        mini_project2.ingest_data(self.week1, self.normalized_database_filename)
+        before = read_tables(self.normalized_database_filename)
+        bad = write_data_file(self.directory, [
+            "Liz Nixon\t89 Jefferson Way\tPortland\tUSA\tNorth America\tChai\tBeverages\tSoft drinks\t18.0\t4\t20171340",
+        ], 'bad.csv')
+        with self.assertRaises(ValueError):
+            mini_project2.append_data(bad, self.normalized_database_filename)
+        after = read_tables(self.normalized_database_filename)
+        for t in TABLE_NAMES:
+            assert after[t].equals(before[t]), t
+        conn = sqlite3.connect(self.normalized_database_filename)
+        assert conn.execute("SELECT count(*) FROM LoadWatermark").fetchone()[0] == 0
+        conn.close()
+
+    def test_append_is_one_transaction(self):
+        mini_project2.ingest_data(self.week1, self.normalized_database_filename)
+        conn = sqlite3.connect(self.normalized_database_filename)
+        conn.execute(mini_project2.LOADWATERMARK_TABLE_SQL)
+        conn.execute("CREATE TRIGGER FailWatermark BEFORE INSERT ON LoadWatermark BEGIN SELECT RAISE(ABORT, 'disk full'); END")
+        conn.commit()
+        conn.close()
+        before = read_tables(self.normalized_database_filename)
+        with self.assertRaises(sqlite3.IntegrityError):
+            mini_project2.append_data(self.week2, self.normalized_database_filename)
+        after = read_tables(self.normalized_database_filename)
+        for t in TABLE_NAMES:
+            assert after[t].equals(before[t]), t
+
+    def test_append_keeps_journal(self):
+        mini_project2.ingest_data(self.week1, self.normalized_database_filename)
+        pragmas = []
+        with mini_project2.get_pool(self.normalized_database_filename).writer() as conn:
+            conn.set_trace_callback(lambda sql: pragmas.append(sql) if sql.startswith("PRAGMA") else None)
+            try:
+                assert mini_project2.append_data(self.week2, self.normalized_database_filename) == 2
+            finally:
+                conn.set_trace_callback(None)
+        assert "PRAGMA foreign_keys = 0" in pragmas
+        assert not [sql for sql in pragmas if 'journal_mode =' in sql or 'synchronous =' in sql]
+
+    def test_append_maintains_summary_tables(self):
+        mini_project2.ingest_data(self.week1, self.normalized_database_filename)
+        conn = mini_project2.create_connection(self.normalized_database_filename)
+        mini_project2.create_summary_tables(conn)
+        assert mini_project2.append_data(self.week2, self.normalized_database_filename) == 2
+        query = "SELECT CustomerID, ROUND(Total, 6), OrderCount FROM CustomerTotal ORDER BY CustomerID"
+        maintained = conn.execute(query).fetchall()
+        mini_project2.create_summary_tables(conn)
+        assert conn.execute(query).fetchall() == maintained
+        assert maintained[-1] == (4, 91.0, 2)
+        conn.close()
+
+    def test_append_maintains_date_dimension(self):
+        mini_project2.ingest_data(self.week1, self.normalized_database_filename)
+        conn = mini_project2.create_connection(self.normalized_database_filename)
+        mini_project2.create_date_dimension(conn)
+        assert mini_project2.append_data(self.week2, self.normalized_database_filename) == 2
+        assert conn.execute("SELECT DateKey FROM OrderDetail WHERE OrderID > 10").fetchall() == [(20170105,), (20170106,)]
+        assert conn.execute("SELECT count(*) FROM Date").fetchone()[0] == 10
+        conn.close()
+
+    def test_append_into_compact_storage(self):
+        mini_project2.ingest_data(self.week1, self.normalized_database_filename, compact=True)
+        assert mini_project2.append_data(self.week2, self.normalized_database_filename) == 2
+        after = read_tables(self.normalized_database_filename)
+        assert after['Product'].iloc[-1].tolist() == [6, 'Zaanse koeken', 9.5, 2]
+        assert after['OrderDetail'].iloc[-1].tolist() == [12, 4, 6, '2017-01-06', 2]
+        conn = mini_project2.create_connection(self.normalized_database_filename)
+        assert mini_project2.has_compact_storage(conn)
+        assert conn.execute("SELECT OrderDay FROM OrderDetailCompact WHERE OrderID = 12").fetchone()[0] == 17172
+        conn.close()
+
+
+class TestBulkLoad(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.conn = mini_project2.create_connection(os.path.join(self.directory, 'bulk.db'))
+        for _, create_table_sql in mini_project2.TABLES[:2]:
+            mini_project2.create_table(self.conn, create_table_sql)
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.directory)
+
+    def pragma(self, name):
+        return self.conn.execute("PRAGMA %s" % name).fetchone()[0]
+
+    def test_settings_restored(self):
+        with mini_project2.bulk_load(self.conn):
+            assert self.pragma('foreign_keys') == 0
+            assert self.pragma('synchronous') == 0
+            self.conn.execute("INSERT INTO Region (RegionID, Region) VALUES (1, 'Scandinavia')")
+            self.conn.execute("INSERT INTO Country (Country, RegionID) VALUES ('Norway', 1)")
+        assert self.pragma('foreign_keys') == 1
+        assert self.pragma('synchronous') == 2
+        assert self.pragma('journal_mode') == 'delete'
+
+    def test_durable(self):
+        with self.assertRaises(ZeroDivisionError):
+            with mini_project2.bulk_load(self.conn, durable=True):
+                assert self.pragma('foreign_keys') == 0
+                assert self.pragma('journal_mode') == 'delete'
+                assert self.pragma('synchronous') == 2
+                self.conn.execute("CREATE TABLE Extra (x)")
+                1 / 0
+        assert self.conn.execute("SELECT count(*) FROM sqlite_master WHERE name = 'Extra'").fetchone()[0] == 0
+        self.conn.execute("PRAGMA synchronous = OFF")
+        with mini_project2.bulk_load(self.conn, durable=True):
+            assert self.pragma('synchronous') == 1
+        assert self.pragma('synchronous') == 0
+
+    def test_violations_reported(self):
+        with self.assertRaises(mini_project2.ForeignKeyCheckError) as cm:
+            with mini_project2.bulk_load(self.conn):
+                self.conn.execute("INSERT INTO Country (Country, RegionID) VALUES ('Norway', 7)")
+        assert cm.exception.violations == [{'table': 'Country', 'rowid': 1, 'parent': 'Region', 'fkid': 0}]
+        assert self.pragma('foreign_keys') == 1
+        assert self.conn.execute("SELECT count(*) FROM Country").fetchone()[0] == 0
+
+    def test_failed_load_rolled_back(self):
+        with self.assertRaises(ValueError):
+            with mini_project2.bulk_load(self.conn):
+                self.conn.execute("INSERT INTO Region (RegionID, Region) VALUES (1, 'Scandinavia')")
+                self.conn.execute("INSERT INTO Country (Country, RegionID) VALUES ('Norway', 7)")
+                raise ValueError('bad row')
+        assert self.conn.execute("SELECT count(*) FROM Region").fetchone()[0] == 0
+        assert self.conn.execute("SELECT count(*) FROM Country").fetchone()[0] == 0
+        assert self.pragma('foreign_keys') == 1
+        assert self.pragma('synchronous') == 2
+
+
+class TestDimensionBuilder(unittest.TestCase):
+
+    def test_build(self):
+        builder = mini_project2.DimensionBuilder()
+        builder.update(['Tofu', 'Chai', 'Tofu', 'Ikura'])
+        builder.add('Chai', 'ignored')
+        assert list(builder) == ['Tofu', 'Chai', 'Ikura']
+        assert builder.build() == [(1, 'Chai', None), (2, 'Ikura', None), (3, 'Tofu', None)]
+        assert builder.ids == {'Chai': 1, 'Ikura': 2, 'Tofu': 3}
+        assert builder.by_id[3] == 'Tofu'
+
+    def test_build_sort_key_is_stable(self):
+        builder = mini_project2.DimensionBuilder()
+        builder.update([('Tofu', '23.25'), ('Chai', '18.0'), ('Tofu', '20.0')])
+        rows = builder.build(sort_key=lambda x: x[0])
+        assert [key for _, key, _ in rows] == [('Chai', '18.0'), ('Tofu', '23.25'), ('Tofu', '20.0')]
+
+
+class TestDateNormalizer(unittest.TestCase):
+
+    def test_normalize(self):
+        normalizer = mini_project2.DateNormalizer(maxsize=2)
+        assert normalizer('20120814') == '2012-08-14'
+        assert normalizer('20120814') == '2012-08-14'
+        assert normalizer.normalize_many(['20161224', '20120101', '20161224']) == ['2016-12-24', '2012-01-01', '2016-12-24']
+        stats = normalizer.stats()
+        assert stats['hits'] == 2 and stats['misses'] == 3 and stats['size'] == 2
+        assert stats['hit_rate'] == 0.4
+
+    def test_invalid_date(self):
+        normalizer = mini_project2.DateNormalizer()
+        with self.assertRaises(ValueError):
+            normalizer.normalize_many(['20121340'])
+
+
+if __name__ == '__main__':
+    unittest.main()
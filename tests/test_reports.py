@@ -0,0 +1,677 @@
+import asyncio
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+import numpy as np
+import pandas as pd
+import mini_project2
+from tests.test_ingest import run_steps, write_data_file
+
+
+class ReportTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.data_filename = write_data_file(cls.directory)
+        cls.normalized_database_filename = os.path.join(cls.directory, 'normalized.db')
+        mini_project2.ingest_data(cls.data_filename, cls.normalized_database_filename)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        self.conn = mini_project2.create_connection(self.normalized_database_filename)
+
+    def tearDown(self):
+        self.conn.close()
+
+
+class TestLookupRegistry(ReportTestCase):
+
+    def test_maps_are_cached_per_connection(self):
+        registry = mini_project2.LookupRegistry()
+        customers = registry.get(self.conn, 'Customer')
+        assert customers['Jose Pedro Freyre'] == 2
+        assert registry.get(self.conn, 'Customer') is customers
+        assert registry.stats() == {'hits': 1, 'misses': 1, 'connections': 1}
+
+    def test_maps_invalidate_on_change(self):
+        registry = mini_project2.LookupRegistry()
+        assert 'Baltic' not in registry.get(self.conn, 'Region')
+        other = mini_project2.create_connection(self.normalized_database_filename)
+        with other:
+            other.execute("INSERT INTO Region (Region) VALUES ('Baltic')")
+        assert registry.get(self.conn, 'Region')['Baltic'] == 5
+        with self.conn:
+            self.conn.execute("DELETE FROM Region WHERE Region = 'Baltic'")
+        assert 'Baltic' not in registry.get(self.conn, 'Region')
+        assert registry.misses == 3
+        other.close()
+
+    def test_step_dictionaries_accept_a_connection(self):
+        expected = mini_project2.step10_create_product_to_productid_dictionary(self.normalized_database_filename)
+        assert mini_project2.step10_create_product_to_productid_dictionary(self.conn) == expected
+        assert expected == {'Chai': 1, 'Ikura': 2, 'Konbu': 3, 'Pavlova': 4, 'Tofu': 5}
+
+    def test_ex1_uses_the_given_connection(self):
+        sql_statement = mini_project2.ex1(self.conn, 'Thomas Hardy')
+        df = pd.read_sql_query(sql_statement, self.conn)
+        assert df['ProductName'].tolist() == ['Pavlova', 'Tofu']
+
+
+class TestParameterizedReports(ReportTestCase):
+
+    def test_query_matches_ex_sql(self):
+        for name in ['Maria Anders', 'Yang Wang']:
+            expected = pd.read_sql_query(mini_project2.ex1(self.conn, name), self.conn)
+            assert mini_project2.ex1_query(self.conn, name).equals(expected)
+            expected = pd.read_sql_query(mini_project2.ex2(self.conn, name), self.conn)
+            assert mini_project2.ex2_query(self.conn, name).equals(expected)
+
+    def test_batch(self):
+        names = ['Yang Wang', 'Nobody', 'Maria Anders']
+        df = mini_project2.ex1_batch(self.conn, names)
+        expected = pd.concat([mini_project2.ex1_query(self.conn, 'Yang Wang'),
+                              mini_project2.ex1_query(self.conn, 'Maria Anders')], ignore_index=True)
+        assert df.equals(expected)
+        totals = mini_project2.ex2_batch(self.conn, names)
+        assert totals['Name'].tolist() == ['Yang Wang', 'Maria Anders']
+        assert totals['Total'].tolist() == [147.0, 459.25]
+        assert not self.conn.in_transaction
+
+    def test_batch_leaves_caller_transaction_open(self):
+        self.conn.execute("UPDATE Region SET Region = 'Changed' WHERE RegionID = 1")
+        totals = mini_project2.ex2_batch(self.conn, ['Maria Anders'])
+        assert totals['Total'].tolist() == [459.25]
+        assert self.conn.in_transaction
+        assert self.conn.execute("SELECT count(*) FROM sqlite_temp_master WHERE name = 'ReportCustomer'").fetchone()[0] == 0
+        self.conn.rollback()
+        assert self.conn.execute("SELECT count(*) FROM Region WHERE Region = 'Changed'").fetchone()[0] == 0
+
+
+class TestIndexes(ReportTestCase):
+
+    def index_names(self):
+        return [r[0] for r in self.conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'OrderDetail' ORDER BY name")]
+
+    def test_built_after_ingest(self):
+        assert self.index_names() == [name for name, _ in mini_project2.INDEXES]
+        plan = self.conn.execute("EXPLAIN QUERY PLAN " + mini_project2.EX1_SQL.format('?'), (1,)).fetchall()
+        assert any('USING INDEX idx_OrderDetail_CustomerID' in row[-1] for row in plan)
+
+    def test_ex1_keeps_order(self):
+        df = mini_project2.ex1_query(self.conn, 'Maria Anders')
+        assert df['ProductName'].tolist() == ['Chai', 'Ikura', 'Tofu', 'Chai']
+
+    def test_drop_and_create(self):
+        mini_project2.drop_indexes(self.conn)
+        assert self.index_names() == []
+        mini_project2.create_indexes(self.conn)
+        assert len(self.index_names()) == len(mini_project2.INDEXES)
+
+
+class TestSummaryTables(ReportTestCase):
+
+    def setUp(self):
+        # Reload: the tests below write to the shared database
+        mini_project2.ingest_data(self.data_filename, self.normalized_database_filename)
+        super().setUp()
+        mini_project2.drop_summary_tables(self.conn)
+        self.expected = self.reports()
+        mini_project2.create_summary_tables(self.conn)
+
+    def reports(self):
+        return [pd.read_sql_query(getattr(mini_project2, 'ex%d' % i)(self.conn), self.conn) for i in range(3, 7)]
+
+    def totals(self):
+        return {t: self.conn.execute("SELECT %s, ROUND(Total, 6), OrderCount FROM %s ORDER BY 1" % (key, t)).fetchall()
+                for t, key, _, _, _ in mini_project2.SUMMARY_TABLES}
+
+    def test_reports_match(self):
+        assert mini_project2.has_summary_tables(self.conn)
+        assert 'CustomerTotal' in mini_project2.ex3(self.conn)
+        for df, expected in zip(self.reports(), self.expected):
+            assert df.equals(expected)
+
+    def test_triggers_track_changes(self):
+        with self.conn:
+            self.conn.execute("INSERT INTO OrderDetail (CustomerID, ProductID, OrderDate, QuantityOrdered) VALUES (2, 1, '2017-01-01', 4)")
+            self.conn.execute("UPDATE OrderDetail SET QuantityOrdered = 1, ProductID = 3 WHERE OrderID = 1")
+            self.conn.execute("DELETE FROM OrderDetail WHERE CustomerID = 4")
+        maintained = self.totals()
+        mini_project2.create_summary_tables(self.conn)
+        assert maintained == self.totals()
+        assert 4 not in [row[0] for row in maintained['CustomerTotal']]
+        self.conn.execute("DELETE FROM OrderDetail")
+        assert self.totals() == {'CustomerTotal': [], 'CountryTotal': [], 'RegionTotal': []}
+        self.conn.rollback()
+
+    def test_loaders_keep_summaries(self):
+        self.conn.close()
+        mini_project2.ingest_data(self.data_filename, self.normalized_database_filename)
+        self.conn = mini_project2.create_connection(self.normalized_database_filename)
+        assert mini_project2.has_summary_tables(self.conn)
+        for df, expected in zip(self.reports(), self.expected):
+            assert df.equals(expected)
+
+
+class TestDateDimension(ReportTestCase):
+
+    def setUp(self):
+        mini_project2.ingest_data(self.data_filename, self.normalized_database_filename)
+        super().setUp()
+        mini_project2.drop_date_dimension(self.conn)
+        self.expected = self.reports()
+        mini_project2.create_date_dimension(self.conn)
+
+    def reports(self):
+        return [pd.read_sql_query(getattr(mini_project2, 'ex%d' % i)(self.conn), self.conn) for i in range(8, 11)]
+
+    def test_reports_match(self):
+        assert mini_project2.has_date_dimension(self.conn)
+        assert 'JOIN Date d' in mini_project2.ex9(self.conn)
+        for df, expected in zip(self.reports(), self.expected):
+            assert df.equals(expected)
+
+    def test_date_rows(self):
+        rows = self.conn.execute("SELECT * FROM Date ORDER BY DateKey").fetchall()
+        assert len(rows) == 13
+        assert rows[1] == (20120814, '2012-08-14', 2012, 'Q3', 8, 'August')
+        assert self.conn.execute("SELECT count(*) FROM OrderDetail WHERE DateKey IS NULL").fetchone()[0] == 0
+
+    def test_triggers_key_new_dates(self):
+        with self.conn:
+            self.conn.execute("INSERT INTO OrderDetail (CustomerID, ProductID, OrderDate, QuantityOrdered) VALUES (2, 1, '2017-11-30', 4)")
+            self.conn.execute("UPDATE OrderDetail SET OrderDate = '2018-04-01' WHERE OrderID = 1")
+        assert self.conn.execute("SELECT DateKey FROM OrderDetail WHERE OrderID IN (1, 16) ORDER BY OrderID").fetchall() == [(20180401,), (20171130,)]
+        assert self.conn.execute("SELECT Quarter, MonthName FROM Date WHERE DateKey = 20171130").fetchone() == ('Q4', 'November')
+
+    def test_loaders_keep_dimension(self):
+        self.conn.close()
+        mini_project2.ingest_data(self.data_filename, self.normalized_database_filename)
+        mini_project2.step11_create_orderdetail_table(self.data_filename, self.normalized_database_filename)
+        self.conn = mini_project2.create_connection(self.normalized_database_filename)
+        assert mini_project2.has_date_dimension(self.conn)
+        for df, expected in zip(self.reports(), self.expected):
+            assert df.equals(expected)
+
+    def test_drop(self):
+        mini_project2.drop_date_dimension(self.conn)
+        assert not mini_project2.has_date_dimension(self.conn)
+        assert 'DateKey' not in [column[1] for column in self.conn.execute("PRAGMA table_info(OrderDetail)")]
+        for df, expected in zip(self.reports(), self.expected):
+            assert df.equals(expected)
+
+
+class TestCompactStorage(ReportTestCase):
+
+    def setUp(self):
+        mini_project2.ingest_data(self.data_filename, self.normalized_database_filename)
+        super().setUp()
+        mini_project2.expand_storage(self.conn)
+        self.expected = self.reports()
+        mini_project2.compact_storage(self.conn)
+
+    def reports(self):
+        frames = [pd.read_sql_query(mini_project2.ex1(self.conn, 'Maria Anders'), self.conn)]
+        frames += [pd.read_sql_query(getattr(mini_project2, 'ex%d' % i)(self.conn), self.conn) for i in range(3, 12)]
+        return frames + [pd.read_sql_query("SELECT * FROM %s" % t, self.conn) for t in ['Product', 'OrderDetail']]
+
+    def assert_reports_match(self):
+        for df, expected in zip(self.reports(), self.expected):
+            assert df.equals(expected)
+
+    def test_reports_match(self):
+        assert mini_project2.has_compact_storage(self.conn)
+        assert 'OrderDetailCompact' in mini_project2.ex11(self.conn)
+        self.assert_reports_match()
+        assert self.conn.execute("SELECT OrderDay, ProductUnitPriceCents FROM OrderDetailCompact od "
+                                 "JOIN ProductCompact p ON p.ProductID = od.ProductID WHERE OrderID = 1").fetchone() == (15566, 1800)
+        assert self.conn.execute("PRAGMA page_size").fetchone()[0] == mini_project2.COMPACT_PAGE_SIZE
+
+    def test_writes_go_through_views(self):
+        with self.conn:
+            self.conn.execute("INSERT INTO Product VALUES (6, 'Chocolade', 12.75, 3)")
+            self.conn.execute("INSERT INTO OrderDetail (CustomerID, ProductID, OrderDate, QuantityOrdered) VALUES (2, 6, '2017-11-30', 4)")
+            self.conn.execute("UPDATE OrderDetail SET OrderDate = '2018-04-01' WHERE OrderID = 1")
+            self.conn.execute("DELETE FROM OrderDetail WHERE OrderID = 2")
+        assert self.conn.execute("SELECT OrderID, OrderDate, ProductUnitPrice FROM OrderDetail JOIN Product USING (ProductID) "
+                                 "WHERE OrderID IN (1, 2, 16)").fetchall() == [(1, '2018-04-01', 18.0), (16, '2017-11-30', 12.75)]
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.conn.execute("UPDATE Product SET ProductUnitPrice = 1.005 WHERE ProductID = 6")
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.conn.execute("UPDATE OrderDetail SET OrderDate = '20180401' WHERE OrderID = 1")
+        self.conn.rollback()
+
+    def test_expand(self):
+        mini_project2.expand_storage(self.conn)
+        assert not mini_project2.has_compact_storage(self.conn)
+        indexes = self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'OrderDetail' ORDER BY name")
+        assert [r[0] for r in indexes] == [name for name, _ in mini_project2.INDEXES]
+        self.assert_reports_match()
+
+    def test_conversions_keep_journal(self):
+        pragmas = []
+        self.conn.set_trace_callback(lambda sql: pragmas.append(sql) if sql.startswith("PRAGMA") else None)
+        mini_project2.expand_storage(self.conn)
+        mini_project2.compact_storage(self.conn)
+        self.conn.set_trace_callback(None)
+        assert pragmas.count("PRAGMA foreign_keys = 0") == 2
+        assert not [sql for sql in pragmas if 'journal_mode =' in sql or 'synchronous =' in sql]
+        self.assert_reports_match()
+
+    def test_loaders_keep_layout(self):
+        self.conn.close()
+        mini_project2.ingest_data(self.data_filename, self.normalized_database_filename)
+        mini_project2.step11_create_orderdetail_table(self.data_filename, self.normalized_database_filename)
+        self.conn = mini_project2.create_connection(self.normalized_database_filename)
+        assert mini_project2.has_compact_storage(self.conn)
+        self.assert_reports_match()
+
+    def test_needs_default_layout(self):
+        with self.assertRaises(sqlite3.Error):
+            mini_project2.create_summary_tables(self.conn)
+        with self.assertRaises(sqlite3.Error):
+            mini_project2.create_date_dimension(self.conn)
+        mini_project2.expand_storage(self.conn)
+        with self.conn:
+            self.conn.execute("UPDATE Product SET ProductUnitPrice = 1.005 WHERE ProductID = 1")
+        with self.assertRaises(sqlite3.Error):
+            mini_project2.compact_storage(self.conn)
+        assert not mini_project2.has_compact_storage(self.conn)
+
+class TestResultCache(ReportTestCase):
+
+    def test_hit_and_invalidation(self):
+        cache = mini_project2.ResultCache()
+        sql_statement = mini_project2.ex3(self.conn)
+        df = cache.read_sql_query(sql_statement, self.conn)
+        df.loc[0, 'Total'] = 0
+        cached = cache.read_sql_query(" ".join(sql_statement.split()) + ";", self.conn)
+        assert cached.equals(pd.read_sql_query(sql_statement, self.conn))
+        other = mini_project2.create_connection(self.normalized_database_filename)
+        with other:
+            other.execute("UPDATE OrderDetail SET QuantityOrdered = QuantityOrdered + 1 WHERE OrderID = 1")
+        assert cache.read_sql_query(sql_statement, self.conn).equals(pd.read_sql_query(sql_statement, self.conn))
+        with other:
+            other.execute("UPDATE OrderDetail SET QuantityOrdered = QuantityOrdered - 1 WHERE OrderID = 1")
+        other.close()
+        stats = cache.stats()
+        assert (stats['hits'], stats['misses'], stats['invalidations']) == (1, 2, 1)
+
+    def test_params_and_literals_are_part_of_the_key(self):
+        cache = mini_project2.ResultCache()
+        assert mini_project2._statement_shape("INSERT INTO t VALUES (NULL, 3, NULL)") == "INSERT INTO t VALUES (?, ?, ?)"
+        sql_statement = "SELECT ? || 'a  b' AS v"
+        assert cache.read_sql_query(sql_statement, self.conn, params=(1,))['v'][0] == '1a  b'
+        assert cache.read_sql_query(sql_statement, self.conn, params=(2,))['v'][0] == '2a  b'
+        assert cache.read_sql_query("SELECT ? || 'a b' AS v", self.conn, params=(2,))['v'][0] == '2a b'
+        assert cache.stats()['misses'] == 3
+
+    def test_eviction(self):
+        cache = mini_project2.ResultCache()
+        size = cache.read_sql_query("SELECT * FROM OrderDetail", self.conn).memory_usage(index=True, deep=True).sum()
+        cache = mini_project2.ResultCache(max_bytes=int(size) * 2)
+        for where in ['1', '2', '3', '1']:
+            cache.read_sql_query("SELECT * FROM OrderDetail WHERE %s" % where, self.conn)
+        stats = cache.stats()
+        assert (stats['hits'], stats['evictions'], stats['entries']) == (0, 2, 2)
+        assert stats['bytes'] <= stats['max_bytes']
+
+
+class TestAsyncReports(ReportTestCase):
+
+    ENDLESS_SQL = "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) SELECT count(*) FROM c"
+
+    def setUp(self):
+        super().setUp()
+        self.pool = mini_project2.ConnectionPool(self.normalized_database_filename, readers=2)
+
+    def tearDown(self):
+        self.pool.close()
+        super().tearDown()
+
+    def test_reports(self):
+        async def run():
+            async with mini_project2.AsyncReports(self.pool) as reports:
+                return await asyncio.gather(reports.ex1('Yang Wang'), reports.ex4(), reports.report('ex11'))
+        ex1, ex4, ex11 = asyncio.run(run())
+        assert ex1.equals(mini_project2.ex1_query(self.conn, 'Yang Wang'))
+        assert ex4.equals(pd.read_sql_query(mini_project2.ex4(self.conn), self.conn))
+        assert ex11.equals(pd.read_sql_query(mini_project2.ex11(self.conn), self.conn))
+
+    def test_stream(self):
+        async def run():
+            async with mini_project2.AsyncReports(self.pool) as reports:
+                chunks = [chunk async for chunk in reports.stream("SELECT * FROM OrderDetail", chunk_size=4)]
+                async for chunk in reports.stream("SELECT * FROM OrderDetail", chunk_size=1):
+                    break
+                return chunks, await reports.query("SELECT count(*) AS n FROM OrderDetail")
+        chunks, count = asyncio.run(run())
+        assert [len(chunk) for chunk in chunks] == [4, 4, 4, 3]
+        assert pd.concat(chunks, ignore_index=True).equals(pd.read_sql_query("SELECT * FROM OrderDetail", self.conn))
+        assert count['n'][0] == 15
+
+    def test_stream_slow_consumer(self):
+        async def run():
+            async with mini_project2.AsyncReports(self.pool, timeout=0.5) as reports:
+                chunks = []
+                async for chunk in reports.stream("SELECT * FROM OrderDetail", chunk_size=1):
+                    chunks.append(chunk)
+                    await asyncio.sleep(0.1)
+                return chunks
+        assert len(asyncio.run(run())) == 15
+
+    def test_timeout_before_statement_starts(self):
+        outcome, done = [], threading.Event()
+
+        def work(conn):
+            time.sleep(0.3)
+            try:
+                conn.execute("WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < 100000) "
+                             "SELECT count(*) FROM c").fetchone()
+                outcome.append('finished')
+            except sqlite3.OperationalError as e:
+                outcome.append(str(e))
+            done.set()
+
+        async def run():
+            async with mini_project2.AsyncReports(self.pool, timeout=0.1) as reports:
+                with self.assertRaises(asyncio.TimeoutError):
+                    await reports._run(work)
+        asyncio.run(run())
+        assert done.wait(5)
+        assert outcome == ['interrupted']
+
+    def test_timeout_interrupts_query(self):
+        async def run():
+            async with mini_project2.AsyncReports(self.pool, timeout=0.1) as reports:
+                with self.assertRaises(asyncio.TimeoutError):
+                    await reports.query(self.ENDLESS_SQL)
+                return await reports.ex3(timeout=5)
+        assert len(asyncio.run(run())) == 5
+
+    def test_read_only(self):
+        async def run():
+            async with mini_project2.AsyncReports(self.pool) as reports:
+                await reports.query("DELETE FROM OrderDetail")
+        with self.assertRaises(pd.errors.DatabaseError):
+            asyncio.run(run())
+        assert self.conn.execute("SELECT count(*) FROM OrderDetail").fetchone()[0] == 15
+
+
+class TestReportBundle(ReportTestCase):
+
+    def expected(self):
+        expected = {'ex%d' % i: pd.read_sql_query(getattr(mini_project2, 'ex%d' % i)(self.conn), self.conn)
+                    for i in range(3, 12)}
+        expected[('ex1', ('Yang Wang',))] = mini_project2.ex1_query(self.conn, 'Yang Wang')
+        return expected
+
+    def check_bundle(self, processes):
+        reports = ['ex%d' % i for i in range(3, 12)] + [('ex1', ['Yang Wang'])]
+        results, timings = mini_project2.run_report_bundle(self.normalized_database_filename, reports,
+                                                           workers=3, processes=processes)
+        expected = self.expected()
+        assert list(results) == list(expected) and list(timings) == list(expected)
+        for key, df in results.items():
+            assert df.equals(expected[key]), key
+            assert timings[key] >= 0
+
+    def test_threads(self):
+        self.check_bundle(processes=False)
+        assert self.conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+
+    def test_processes(self):
+        self.check_bundle(processes=True)
+
+
+class TestPartitionedReports(ReportTestCase):
+
+    def test_matches_sql(self):
+        for name in mini_project2.PARTITIONED_REPORTS:
+            expected = pd.read_sql_query(getattr(mini_project2, name)(self.conn), self.conn)
+            df = mini_project2.partitioned_report(self.normalized_database_filename, name, workers=2, partitions=4)
+            assert df.equals(expected), name
+
+    def test_near_rounding_boundary(self):
+        # Ana Trujillo's 2 x 23.25 + 7 x 6.0 = 88.5 goes through the term-by-term resum
+        assert mini_project2._near_rounding_boundary(88.5, 0)
+        assert mini_project2._near_rounding_boundary(88.49999999999999, 0)
+        assert not mini_project2._near_rounding_boundary(88.25, 0)
+        assert not mini_project2._near_rounding_boundary(88.5, 2)
+
+    def test_empty_table(self):
+        directory = os.path.join(self.directory, 'empty')
+        os.mkdir(directory)
+        normalized_database_filename = os.path.join(directory, 'normalized.db')
+        mini_project2.ingest_data(write_data_file(directory, []), normalized_database_filename)
+        df = mini_project2.partitioned_report(normalized_database_filename, 'ex9', workers=2)
+        assert df.columns.tolist() == ['Quarter', 'Year', 'CustomerID', 'Total', 'CustomerRank'] and len(df) == 0
+
+
+class TestColumnarSnapshot(ReportTestCase):
+
+    def test_reports_match_sql(self):
+        snapshot = mini_project2.export_snapshot(self.normalized_database_filename, os.path.join(self.directory, 'snapshot'))
+        assert len(snapshot) == 15 and isinstance(snapshot.OrderID, np.memmap)
+        for i in range(3, 11):
+            expected = pd.read_sql_query(getattr(mini_project2, 'ex%d' % i)(self.conn), self.conn)
+            assert snapshot.report('ex%d' % i).equals(expected), i
+
+    def test_load_into_memory(self):
+        directory = os.path.join(self.directory, 'in_memory')
+        mini_project2.export_snapshot(self.normalized_database_filename, directory)
+        snapshot = mini_project2.ColumnarSnapshot(directory, mmap=False)
+        assert not isinstance(snapshot.Day, np.memmap)
+        assert snapshot.labels['CustomerName'][2] == 'Jose Pedro Freyre'
+        assert str(snapshot.Day[:1].astype('datetime64[D]')[0]) == '2012-08-14'
+        assert snapshot.groups('ex5')[1][0] == (('Germany',), 459.25)
+
+
+class TestIterReport(ReportTestCase):
+
+    def test_report_sql_does_not_run_the_report(self):
+        misses = mini_project2.report_cache.stats()['misses']
+        sql_statement, params = mini_project2.report_sql(self.conn, 'ex4')
+        assert mini_project2.report_cache.stats()['misses'] == misses
+        assert sql_statement == mini_project2.ex4(self.conn) and params == ()
+        sql_statement, params = mini_project2.report_sql(self.conn, 'ex1', 'Yang Wang')
+        assert params == (5,) and '?' in sql_statement
+
+    def test_chunks(self):
+        chunks = list(mini_project2.iter_report(self.conn, 'ex1', 'Maria Anders', chunksize=3))
+        assert [len(chunk) for chunk in chunks] == [3, 1]
+        expected = mini_project2.ex1_query(self.conn, 'Maria Anders')
+        assert pd.concat(chunks, ignore_index=True).equals(expected)
+        for i in range(3, 12):
+            name = 'ex%d' % i
+            df = pd.concat(mini_project2.iter_report(self.conn, name, chunksize=2), ignore_index=True)
+            assert df.equals(pd.read_sql_query(getattr(mini_project2, name)(self.conn), self.conn)), name
+
+    def test_row_batches(self):
+        batches = list(mini_project2.iter_report(self.conn, 'ex3', chunksize=2, frames=False))
+        assert [len(batch) for batch in batches] == [2, 2, 1]
+        assert batches[0][0] == ('Maria Anders', 459.25)
+
+
+class TestGapReport(unittest.TestCase):
+
+    LINES = [
+        "Ana Trujillo\tAvda. 2222\tMexico D.F.\tMexico\tCentral America\tTofu;Konbu;Tofu\tProduce;Seafood;Produce\tDried fruit;Fish;Dried fruit\t23.25;6.0;23.25\t2;7;1\t20150301;20150301;20150301",
+        "Thomas Hardy\t120 Hanover Sq.\tLondon\tUK\tBritish Isles\tTofu;Tofu;Konbu;Tofu\tProduce;Produce;Seafood;Produce\tDried fruit;Dried fruit;Fish;Dried fruit\t23.25;23.25;6.0;23.25\t1;2;3;4\t20130121;20130111;20130111;20130101",
+        "Yang Wang\tHauptstr. 29\tBern\tSwitzerland\tWestern Europe\tKonbu\tSeafood\tFish\t6.0\t1\t20140228",
+    ]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        normalized_database_filename = os.path.join(self.directory, 'gaps.db')
+        mini_project2.ingest_data(write_data_file(self.directory, self.LINES), normalized_database_filename)
+        self.conn = mini_project2.create_connection(normalized_database_filename)
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.directory)
+
+    def test_ties_and_single_day_customers(self):
+        # Thomas's two 10-day gaps resolve to the earlier one; Ana ordered on one day only and, as
+        # with the correlated-subquery version, gets one row per zero gap; Yang has no gap
+        df = pd.read_sql_query(mini_project2.ex11(self.conn), self.conn)
+        assert df.columns.tolist() == ['CustomerID', 'FirstName', 'LastName', 'Country', 'OrderDate', 'PreviousOrderDate', 'MaxDaysWithoutOrder']
+        assert df.values.tolist() == [
+            [2, 'Thomas', 'Hardy', 'UK', '2013-01-11', '2013-01-01', 10.0],
+            [1, 'Ana', 'Trujillo', 'Mexico', '2015-03-01', '2015-03-01', 0.0],
+            [1, 'Ana', 'Trujillo', 'Mexico', '2015-03-01', '2015-03-01', 0.0],
+        ]
+
+
+class TestInstrumentation(ReportTestCase):
+
+    def test_steps(self):
+        normalized_database_filename = os.path.join(self.directory, 'instrumented.db')
+        log = os.path.join(self.directory, 'metrics.jsonl')
+        with mini_project2.instrument(log=log) as metrics:
+            run_steps(self.data_filename, normalized_database_filename)
+        steps = {r['name']: r for r in metrics.records if r['kind'] == 'step'}
+        assert steps['step5_create_customer_table']['rows_parsed'] == 5
+        assert steps['step5_create_customer_table']['rows_written'] == 5
+        assert steps['step11_create_orderdetail_table']['rows_written'] == 15
+        assert steps['step4_create_country_to_countryid_dictionary']['depth'] == 1
+        sql = {(r['step'], r['name']): r for r in metrics.records if r['kind'] == 'sql'}
+        insert = sql['step11_create_orderdetail_table', 'INSERT INTO OrderDetail (OrderID, CustomerID, ProductID, OrderDate, QuantityOrdered) VALUES (?, ?, ?, ?, ?)']
+        assert insert['calls'] == 15
+        with open(log) as f:
+            assert [json.loads(line) for line in f] == metrics.records
+
+    def test_reports(self):
+        mini_project2.report_cache.clear()
+        with mini_project2.instrument(sql=False) as metrics:
+            mini_project2.ex3(self.conn)
+            mini_project2.run_report(self.conn, 'ex4')
+        assert [(r['kind'], r['name'], r['rows_returned']) for r in metrics.records] == [('report', 'ex3', 5), ('report', 'ex4', 4)]
+        summary = metrics.summary()
+        assert summary['name'].tolist() == ['ex3', 'ex4'] and summary['calls'].tolist() == [1, 1]
+        mini_project2.ex3(self.conn)
+        assert len(metrics.records) == 2
+
+    def test_statement_shape(self):
+        assert mini_project2._statement_shape("INSERT INTO t VALUES (NULL, 3, NULL)") == "INSERT INTO t VALUES (?, ?, ?)"
+        sql_statement = "SELECT  *  FROM t WHERE a = 'it''s' AND b IN (1, 2.5e3) AND c1 = -7 AND d IS NULL"
+        assert mini_project2._statement_shape(sql_statement) == "SELECT * FROM t WHERE a = ? AND b IN (?, ?) AND c1 = -? AND d IS NULL"
+
+
+class TestQueryPlans(ReportTestCase):
+    # tests/query_plans.json is the expected plan of every report on the normalized schema;
+    # after an intended plan change rewrite it with `python benchmark.py --plans tests/query_plans.json --update-plans`
+
+    snapshot = os.path.join(os.path.dirname(__file__), 'query_plans.json')
+
+    def test_plans_match_snapshot(self):
+        regressions = mini_project2.check_query_plans(self.conn, self.snapshot)
+        assert regressions == {}, regressions
+
+    def test_dropped_index_is_flagged(self):
+        baseline = mini_project2.query_plans(self.conn)
+        self.conn.execute("DROP INDEX idx_OrderDetail_CustomerID")
+        self.conn.execute("DROP INDEX idx_OrderDetail_CustomerID_OrderDate")
+        try:
+            regressions = mini_project2.plan_regressions(baseline, mini_project2.query_plans(self.conn))
+        finally:
+            mini_project2.create_indexes(self.conn)
+        assert regressions['ex1'] == ['SCAN OD']
+        assert regressions['ex3'] == ['SCAN od', 'USE TEMP B-TREE FOR GROUP BY']
+        assert mini_project2.plan_regressions(baseline, mini_project2.query_plans(self.conn)) == {}
+
+    def test_plan_issues(self):
+        plan = ['MATERIALIZE tbl', '  CO-ROUTINE (subquery)', '    SCAN od USING INDEX idx_OrderDetail_CustomerID',
+                '  SCAN (subquery)', 'SCAN tbl', 'SEARCH c USING INTEGER PRIMARY KEY (rowid=?)', 'USE TEMP B-TREE FOR ORDER BY']
+        assert mini_project2.plan_issues(plan) == ['SCAN od USING INDEX idx_OrderDetail_CustomerID', 'USE TEMP B-TREE FOR ORDER BY']
+        plan = mini_project2.explain_report(self.conn, 'ex11')
+        assert '    SCAN (subquery)' in plan and '    SCALAR SUBQUERY' in plan
+
+
+class TestConnectionPool(ReportTestCase):
+
+    def test_readers_are_reused(self):
+        pool = mini_project2.ConnectionPool(self.normalized_database_filename, readers=2)
+        with pool.reader() as conn:
+            first = conn
+            assert conn.execute("SELECT count(*) FROM OrderDetail").fetchone()[0] == 15
+        with pool.reader() as conn:
+            assert conn is first
+        pool.close()
+
+    def test_reader_limit(self):
+        pool = mini_project2.ConnectionPool(self.normalized_database_filename, readers=1, timeout=0.01)
+        with pool.reader():
+            with self.assertRaises(mini_project2.sqlite3.OperationalError):
+                with pool.reader():
+                    pass
+        pool.close()
+
+    def test_writer_rolls_back_on_error(self):
+        pool = mini_project2.ConnectionPool(self.normalized_database_filename)
+        with self.assertRaises(ZeroDivisionError):
+            with pool.writer() as conn:
+                conn.execute("DELETE FROM OrderDetail")
+                1 / 0
+        with pool.reader() as conn:
+            assert conn.execute("SELECT count(*) FROM OrderDetail").fetchone()[0] == 15
+        pool.close()
+        with self.assertRaises(mini_project2.sqlite3.Error):
+            with pool.writer():
+                pass
+
+    def test_shared_pool_closed_by_delete_db(self):
+        normalized_database_filename = os.path.join(self.directory, 'pooled.db')
+        pool = mini_project2.get_pool(normalized_database_filename)
+        assert mini_project2.get_pool(normalized_database_filename) is pool
+        mini_project2.create_connection(normalized_database_filename, delete_db=True).close()
+        assert pool.closed
+        assert mini_project2.get_pool(normalized_database_filename) is not pool
+
+    def test_deleted_or_replaced_file_reopened(self):
+        normalized_database_filename = os.path.join(self.directory, 'replaced.db')
+        run_steps(self.data_filename, normalized_database_filename)
+        os.remove(normalized_database_filename)
+        run_steps(self.data_filename, normalized_database_filename)
+        with mini_project2.get_pool(normalized_database_filename).reader() as conn:
+            assert conn.execute("SELECT count(*) FROM OrderDetail").fetchone()[0] == 15
+        copy = os.path.join(self.directory, 'replacement.db')
+        shutil.copy(self.normalized_database_filename, copy)
+        conn = sqlite3.connect(copy)
+        conn.execute("DELETE FROM OrderDetail WHERE OrderID > 10")
+        conn.commit()
+        conn.close()
+        os.replace(copy, normalized_database_filename)
+        with mini_project2.get_pool(normalized_database_filename).reader() as conn:
+            assert conn.execute("SELECT count(*) FROM OrderDetail").fetchone()[0] == 10
+        mini_project2.close_pool(normalized_database_filename)
+
+    def test_shared_pools_bounded(self):
+        names = [os.path.join(self.directory, 'bounded%d.db' % i) for i in range(mini_project2.POOL_CACHE_SIZE + 2)]
+        first = mini_project2.get_pool(names[0])
+        with first.writer() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS T (x)")
+        for name in names[1:]:
+            mini_project2.get_pool(name)
+        assert len(mini_project2._pools) <= mini_project2.POOL_CACHE_SIZE
+        assert os.path.abspath(names[0]) not in mini_project2._pools
+        assert first._writer is None and not first.closed
+        with first.writer() as conn:
+            assert conn.execute("SELECT count(*) FROM T").fetchone()[0] == 0
+        first.close()
+        for name in names[1:]:
+            mini_project2.close_pool(name)
+
+
+if __name__ == '__main__':
+    unittest.main()